@@ -0,0 +1,514 @@
+from flagpy.flag_identifier import FlagIdentifier
+from PIL import Image
+from io import BytesIO
+import numpy as np
+import subprocess
+import tempfile
+import platform
+import argparse
+import flagpy
+import time
+import json
+import sys
+import os
+
+# the ways that a query is made to look different from the gallery flag it came from
+PERTURBATIONS = ("resize", "jpeg", "noise", "crop")
+
+# the methods that are benchmarked by default
+METHODS = ("mse", "hash", "ssim")
+
+def summarize(seconds):
+    '''
+    Summarizes a list of timings into their mean and percentiles, in milliseconds.
+
+    Parameters
+    ----------
+    seconds : list
+        The timings, in seconds
+
+    Returns
+    -------
+    dict
+        The count, mean_ms, p50_ms, p90_ms, p99_ms, and max_ms of the timings
+    '''
+    ms = np.asarray(seconds, dtype = np.float64) * 1000.0
+    return {
+        "count": len(ms),
+        "mean_ms": float(ms.mean()),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p90_ms": float(np.percentile(ms, 90)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "max_ms": float(ms.max())
+    }
+
+def flatten(results, prefix = ""):
+    '''
+    Flattens nested benchmark results into a dict of "a.b.c" paths to numbers.
+
+    Parameters
+    ----------
+    results : dict
+        The results, as returned by FlagBenchmark.run
+
+    prefix : str
+        The path of the given results within the whole results
+
+    Returns
+    -------
+    dict
+        Each number in the results by its path
+    '''
+    flat = {}
+    for key, value in results.items():
+        path = prefix + str(key)
+        if isinstance(value, dict):
+            flat.update(flatten(value, path + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[path] = value
+
+    return flat
+
+# the statistics stable enough to fail a comparison on; the tails (p90, p99, max) and
+# startup times vary too much between identical runs, so they are only reported
+GATED_STATISTICS = ("p50_ms", "mean_ms", "_qps")
+
+def is_gated(path):
+    '''
+    Returns whether the number at the given path (as returned by flatten) is stable
+    enough for a regression in it to fail a comparison.
+
+    Parameters
+    ----------
+    path : str
+        The path of the number
+
+    Returns
+    -------
+    bool
+        Whether or not the number is gated
+    '''
+    return not path.startswith("startup.") and path.endswith(GATED_STATISTICS)
+
+def compare(baseline, results, tolerance = 0.2, min_delta_ms = 0.5):
+    '''
+    Compares two sets of benchmark results and returns the timings that got slower (and
+    the throughputs that dropped) by more than the given fraction and by more than the
+    given number of milliseconds. Only the medians, means, and throughputs count as
+    regressions; the other timings that got worse are returned separately, to report.
+
+    Parameters
+    ----------
+    baseline : dict
+        The results of an earlier run
+
+    results : dict
+        The results of the run being checked
+
+    tolerance : float
+        How much worse (as a fraction of the baseline) a number can get before it counts
+        as a regression
+
+    min_delta_ms : float
+        How many milliseconds slower a timing (or each query of a throughput) has to get
+        before it counts as a regression, so that tiny timings don't fail on noise
+
+    Returns
+    -------
+    tuple
+        The regressions, and the other timings that got worse, each as a list of
+        (path, baseline value, new value) tuples
+    '''
+    old = flatten(baseline)
+    new = flatten(results)
+
+    regressions = []
+    changes = []
+    for path in sorted(set(old) & set(new)):
+        if path.endswith("_ms"):
+            worse = new[path] > old[path] * (1 + tolerance) and new[path] - old[path] > min_delta_ms
+        elif path.endswith("_qps"):
+            # comparing the time each query took, so that min_delta_ms applies too
+            worse = (new[path] < old[path] * (1 - tolerance) and new[path] > 0
+                and 1000.0 / new[path] - 1000.0 / old[path] > min_delta_ms)
+        else:
+            continue
+
+        if worse:
+            (regressions if is_gated(path) else changes).append((path, old[path], new[path]))
+
+    return regressions, changes
+
+# run in a fresh interpreter so that nothing is already imported or loaded
+STARTUP_SCRIPT = '''
+import time, json, sys
+start = time.perf_counter()
+import flagpy
+imported = time.perf_counter()
+identifier = flagpy.get_identifier()
+created = time.perf_counter()
+identifier.warmup(tuple(sys.argv[1].split(",")))
+warm = time.perf_counter()
+print(json.dumps([imported - start, created - imported, warm - created]))
+'''
+
+class FlagBenchmark:
+
+    def __init__(self, queries = 100, seed = 0, methods = METHODS, representation = "rgb", workers = 0):
+        '''
+        Initializes a FlagBenchmark object, which times flagpy on queries made from its
+        own gallery, so it doesn't need any network access. Each query is a gallery flag
+        that was resized, recompressed as a JPEG, made noisy, or cropped, and then saved
+        as the bytes of an image file.
+
+        Parameters
+        ----------
+        queries : int
+            The number of queries to time each method on
+
+        seed : int
+            The seed of the random perturbations, so that every run times the same queries
+
+        methods : tuple
+            The methods (any of mse, ssim, hash, dhash, phash, or cascade) to benchmark
+
+        representation : str
+            How the identifier keeps the gallery (see FlagIdentifier)
+
+        workers : int
+            The number of worker processes the identifier scores with
+        '''
+        self.queries = queries
+        self.seed = seed
+        self.methods = tuple(methods)
+        self.representation = representation
+        self.workers = workers
+
+    def warmup_methods(self, methods):
+        '''
+        Returns the methods that warmup accepts for the given benchmarked methods, which
+        replaces cascade with the hash and ssim methods it uses.
+
+        Parameters
+        ----------
+        methods : tuple
+            The benchmarked methods
+
+        Returns
+        -------
+        tuple
+            The methods to warm up
+        '''
+        warmup = []
+        for method in methods:
+            for needed in (("hash", "ssim") if method == "cascade" else (method,)):
+                if needed not in warmup:
+                    warmup.append(needed)
+
+        return tuple(warmup)
+
+    def make_queries(self, identifier):
+        '''
+        Makes the perturbed queries from the given identifier's gallery.
+
+        Parameters
+        ----------
+        identifier : FlagIdentifier
+            The identifier whose gallery the queries are made from
+
+        Returns
+        -------
+        list
+            A list of (country, perturbation, image bytes) tuples
+        '''
+        rng = np.random.default_rng(self.seed)
+        gallery = identifier.gallery
+
+        queries = []
+        for i, row in enumerate(rng.integers(0, len(gallery), self.queries)):
+            perturbation = PERTURBATIONS[i % len(PERTURBATIONS)]
+            flag = np.asarray(gallery.flags[int(row)])
+            queries.append((gallery.names[int(row)], perturbation, self.__perturb(flag, perturbation, rng)))
+
+        return queries
+
+    def __perturb(self, flag, perturbation, rng):
+        '''
+        Returns the bytes of an image file of the given flag with the given perturbation.
+
+        Parameters
+        ----------
+        flag : array
+            A (90, 180, 3) uint8 numpy array of the flag
+
+        perturbation : str
+            One of resize, jpeg, noise, or crop
+
+        rng : Generator
+            The random number generator to perturb with
+
+        Returns
+        -------
+        bytes
+            The image file, as a PNG (or a JPEG for the jpeg perturbation)
+        '''
+        img = Image.fromarray(flag)
+        image_format = "PNG"
+        options = {}
+
+        if perturbation == "resize":
+            scale = rng.uniform(0.5, 3.0)
+            img = img.resize((int(180 * scale), int(90 * scale)), Image.BILINEAR)
+        elif perturbation == "jpeg":
+            img = img.resize((360, 180), Image.BILINEAR)
+            image_format = "JPEG"
+            options["quality"] = int(rng.integers(30, 90))
+        elif perturbation == "noise":
+            noise = rng.normal(0, rng.uniform(5, 20), flag.shape)
+            img = Image.fromarray(np.clip(flag + noise, 0, 255).astype(np.uint8))
+        elif perturbation == "crop":
+            left, top, right, bottom = rng.integers(0, 9, 4)
+            img = img.crop((left, top, 180 - right, 90 - bottom))
+        else:
+            raise ValueError("perturbation must be one of: " + ", ".join(PERTURBATIONS))
+
+        output = BytesIO()
+        img.save(output, format = image_format, **options)
+        return output.getvalue()
+
+    def time_startup(self, repeats = 3):
+        '''
+        Times importing flagpy, creating its identifier, and warming up the benchmarked
+        methods, each in a fresh interpreter.
+
+        Parameters
+        ----------
+        repeats : int
+            The number of interpreters to time
+
+        Returns
+        -------
+        dict
+            The median import_ms, create_ms, and warmup_ms, and the process_ms that the
+            whole interpreter took
+        '''
+        # the interpreters import the same flagpy as this one
+        env = dict(os.environ)
+        root = os.path.dirname(os.path.dirname(os.path.abspath(flagpy.__file__)))
+        env["PYTHONPATH"] = os.pathsep.join([root] + [path for path in [env.get("PYTHONPATH")] if path])
+
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT, ",".join(self.warmup_methods(self.methods))],
+                env = env, check = True, capture_output = True, text = True).stdout
+            timings.append(json.loads(output.strip().splitlines()[-1]) + [time.perf_counter() - start])
+
+        medians = np.median(np.asarray(timings), axis = 0) * 1000.0
+        return {name: float(ms) for name, ms in zip(("import_ms", "create_ms", "warmup_ms", "process_ms"), medians)}
+
+    def time_identify(self, identifier, queries, method):
+        '''
+        Times identifying every query with the given method, both stage by stage and end
+        to end. The stages are decoding the image file, processing it (converting,
+        resizing, and standardizing its colors), and scoring it against the gallery.
+        Caches are skipped so that every query does all of the work.
+
+        Parameters
+        ----------
+        identifier : FlagIdentifier
+            The identifier to time
+
+        queries : list
+            The queries, as returned by make_queries
+
+        method : str
+            The method to identify with
+
+        Returns
+        -------
+        dict
+            The timings of each stage and of the whole identification, the single and
+            batched throughputs (in queries per second), and the accuracy
+        '''
+        util = identifier.util
+        identifier.warmup(self.warmup_methods((method,)))
+        identifier.identify(queries[0][2], method, cache = False)
+
+        stages = {"decode": [], "process": [], "score": []}
+        for _, _, image_bytes in queries:
+            start = time.perf_counter()
+            img = util.open_image(image_bytes)
+            img.load()
+            decoded = time.perf_counter()
+            flag = util.process_image(img)
+            processed = time.perf_counter()
+            identifier.identify(flag, method, cache = False)
+            scored = time.perf_counter()
+
+            stages["decode"].append(decoded - start)
+            stages["process"].append(processed - decoded)
+            stages["score"].append(scored - processed)
+
+        end_to_end = []
+        correct = 0
+        for country, _, image_bytes in queries:
+            start = time.perf_counter()
+            identified = identifier.identify(image_bytes, method, cache = False)
+            end_to_end.append(time.perf_counter() - start)
+            correct += identified == country
+
+        start = time.perf_counter()
+        identifier.identify_many([image_bytes for _, _, image_bytes in queries], method, cache = False)
+        batch_seconds = time.perf_counter() - start
+
+        results = {stage: summarize(seconds) for stage, seconds in stages.items()}
+        results["end_to_end"] = summarize(end_to_end)
+        results["throughput_qps"] = len(queries) / sum(end_to_end)
+        results["batch_throughput_qps"] = len(queries) / batch_seconds
+        results["accuracy"] = correct / len(queries)
+        return results
+
+    def time_closest(self, identifier, method, countries = 20):
+        '''
+        Times finding the closest flag to a sample of countries with the given method,
+        the first time (when their distances may still have to be computed) and again
+        right after.
+
+        Parameters
+        ----------
+        identifier : FlagIdentifier
+            The identifier to time
+
+        method : str
+            The method to compare flags with
+
+        countries : int
+            The number of countries to time
+
+        Returns
+        -------
+        dict
+            The timings of the first and repeated calls
+        '''
+        rng = np.random.default_rng(self.seed)
+        names = identifier.get_country_list()
+        sample = [names[int(i)] for i in rng.choice(len(names), min(countries, len(names)), replace = False)]
+
+        first = []
+        repeat = []
+        for country in sample:
+            start = time.perf_counter()
+            identifier.closest_flag(country, method)
+            first.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            identifier.closest_flag(country, method)
+            repeat.append(time.perf_counter() - start)
+
+        return {"first": summarize(first), "repeat": summarize(repeat)}
+
+    def run(self):
+        '''
+        Runs the whole benchmark. Everything flagpy caches on disk goes to a temporary
+        directory, so earlier runs (or earlier use of flagpy) never make a run faster.
+
+        Returns
+        -------
+        dict
+            The results, with a "meta" section describing the machine and settings, and
+            "startup", "identify", and "closest_flag" sections of timings
+        '''
+        old_cache_dir = os.environ.get("FLAGPY_CACHE_DIR")
+        with tempfile.TemporaryDirectory() as cache_dir:
+            os.environ["FLAGPY_CACHE_DIR"] = cache_dir
+            try:
+                results = {"startup": self.time_startup()}
+
+                identifier = FlagIdentifier(representation = self.representation, workers = self.workers)
+                try:
+                    queries = self.make_queries(identifier)
+                    results["identify"] = {method: self.time_identify(identifier, queries, method)
+                        for method in self.methods}
+                    results["closest_flag"] = {method: self.time_closest(identifier, method)
+                        for method in self.methods if method != "cascade"}
+                    version = identifier.gallery.version
+                finally:
+                    identifier.close()
+            finally:
+                if old_cache_dir is None:
+                    del os.environ["FLAGPY_CACHE_DIR"]
+                else:
+                    os.environ["FLAGPY_CACHE_DIR"] = old_cache_dir
+
+        results["meta"] = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "gallery_version": version,
+            "queries": self.queries,
+            "seed": self.seed,
+            "representation": self.representation,
+            "workers": self.workers
+        }
+        return results
+
+def main(args = None):
+    '''
+    Runs the benchmark, saves its results as JSON, and optionally compares them against
+    the results of an earlier run.
+
+    Parameters
+    ----------
+    args : list
+        The command line arguments (sys.argv is used if not given)
+
+    Returns
+    -------
+    int
+        1 if any median, mean, or throughput regressed compared to the baseline, and 0
+        otherwise
+    '''
+    parser = argparse.ArgumentParser(description = "Benchmarks flagpy on perturbed flags from its own gallery.")
+    parser.add_argument("--output", default = "benchmark.json", help = "the file to save the results to")
+    parser.add_argument("--baseline", help = "the results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type = float, default = 0.2, help = "how much slower counts as a regression")
+    parser.add_argument("--min-delta", type = float, default = 0.5, help = "how many milliseconds slower counts as a regression")
+    parser.add_argument("--queries", type = int, default = 100, help = "the number of queries per method")
+    parser.add_argument("--seed", type = int, default = 0, help = "the seed of the perturbations")
+    parser.add_argument("--methods", default = ",".join(METHODS), help = "the methods to benchmark (comma separated)")
+    parser.add_argument("--representation", default = "rgb", help = "how the gallery is kept (rgb or palette)")
+    parser.add_argument("--workers", type = int, default = 0, help = "the number of scoring processes")
+    args = parser.parse_args(args)
+
+    benchmark = FlagBenchmark(queries = args.queries, seed = args.seed, methods = args.methods.split(","),
+        representation = args.representation, workers = args.workers)
+    results = benchmark.run()
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent = 1)
+
+    for method, timings in results["identify"].items():
+        print(method, "p50", round(timings["end_to_end"]["p50_ms"], 2), "ms,",
+            round(timings["throughput_qps"], 1), "queries/s, accuracy", round(timings["accuracy"], 3))
+    print("saved results to", args.output)
+
+    if not args.baseline:
+        return 0
+
+    with open(args.baseline) as f:
+        regressions, changes = compare(json.load(f), results, args.tolerance, args.min_delta)
+
+    for path, old, new in changes:
+        print("slower (not gated):", path, round(old, 3), "->", round(new, 3))
+    for path, old, new in regressions:
+        print("regression:", path, round(old, 3), "->", round(new, 3))
+    if not regressions:
+        print("no regressions compared to", args.baseline)
+
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,35 +1,303 @@
 import tkinter as tk
 import flagpy as fp
+from flagpy.flag_cache import LRUCache
 from PIL import Image, ImageTk
+import numpy as np
+import threading
+import queue
 
 HEIGHT = 600
-WIDTH = 600
+WIDTH = 900
+
+# the methods that flags can be ranked by
+METHODS = ["mse", "ssim", "hash", "dhash", "phash"]
+
+# the number of most and least similar flags that are listed
+TOP_N = 10
 
 root = tk.Tk()
 root.title("Flag Visualizer")
-flag_df = fp.get_flag_df()
+
+# the flags resized for the window, by country and size, so that showing a flag again
+# (or going back to an earlier window size) doesn't resize it again
+flag_images = LRUCache(64)
+
+# the mse between each pair of flags that has been shown
+distances = {}
+
+# what each label is currently showing, so that redrawing skips what hasn't changed
+shown = {}
+
+# the update waiting for tk to be idle, if there is one
+pending_update = None
+
+# the ranking requests waiting for the background thread, which ranks flags off of
+# tk's thread so that the window never freezes while it does
+ranking_requests = queue.Queue()
+
+# bumped by every new ranking request, so that older requests know they are stale
+ranking_generation = 0
+
+# the (country, method) of the ranking that was requested last
+requested_key = None
+
+# the most recent ranking: the (country, method) it is for, and its closest and
+# farthest (country, score) lists
+ranking = {"key": None, "closest": [], "farthest": []}
+
+# the country of each row of the ranked list (None for the headers)
+listed = []
+
+# what to do with the right flag ("closest" or "farthest") once the ranking for the
+# left flag arrives, if a button was pressed before it did
+pending_pick = None
+
+def get_flag_image(country, width, height):
+    '''
+    Returns the flag of the given country resized to the given size, resizing it only
+    the first time.
+
+    Parameters
+    ----------
+    country : str
+        The name of the country
+
+    width : int
+        The width of the image
+
+    height : int
+        The height of the image
+
+    Returns
+    -------
+    PhotoImage
+        The resized flag
+    '''
+    key = country + "-" + str(width) + "x" + str(height)
+    image = flag_images.get(key)
+    if image is None:
+        img = fp.get_flag_img(country).resize((width, height), Image.LANCZOS)
+        image = ImageTk.PhotoImage(image = img)
+        flag_images.put(key, image)
+
+    return image
+
+def get_distance(countryA, countryB):
+    '''
+    Returns the mse between the flags of the two given countries, computing it only the
+    first time.
+
+    Parameters
+    ----------
+    countryA : str
+        The name of the first country
+
+    countryB : str
+        The name of the second country
+
+    Returns
+    -------
+    float
+        The mse between the two flags
+    '''
+    # mse is symmetric, so both orders share one entry
+    key = (countryA, countryB) if countryA <= countryB else (countryB, countryA)
+    if key not in distances:
+        distances[key] = fp.flag_dist(countryA, countryB)
+
+    return distances[key]
 
 def closest_flag(flag_left):
     '''
-    Sets the right flag to the flag that is most similar to the given flag.
+    Sets the right flag to the flag that is most similar to the given flag, according
+    to the chosen method, once it has been found.
 
     Parameters
     ----------
     flag_left : str
         The name of the country whose flag is being displayed on the left
     '''
-    chosen_flag_right.set(fp.closest_flag(flag_left))
+    pick_flag(flag_left, "closest")
 
 def farthest_flag(flag_left):
     '''
-    Sets the right flag to the flag that is least similar to the given flag.
+    Sets the right flag to the flag that is least similar to the given flag, according
+    to the chosen method, once it has been found.
+
+    Parameters
+    ----------
+    flag_left : str
+        The name of the country whose flag is being displayed on the left
+    '''
+    pick_flag(flag_left, "farthest")
+
+def pick_flag(flag_left, pick):
+    '''
+    Sets the right flag to the first flag of the given list of the ranking of the given
+    flag, right away if it has already been ranked and once it is otherwise.
 
     Parameters
     ----------
     flag_left : str
         The name of the country whose flag is being displayed on the left
+
+    pick : str
+        Either "closest" or "farthest"
+    '''
+    global pending_pick
+    if ranking["key"] == (flag_left, chosen_method.get()) and ranking[pick]:
+        chosen_flag_right.set(ranking[pick][0][0])
+    else:
+        # requesting first, since a new request forgets the pick of the last one
+        request_ranking()
+        pending_pick = pick
+
+def request_ranking(*args):
+    '''
+    Starts ranking every flag by how similar it is to the left flag (with the chosen
+    method) in the background. This is called whenever the left flag or the method
+    changes, and any ranking that is still waiting or running is abandoned (along
+    with the flag that was to be picked from it).
+    '''
+    global ranking_generation, requested_key, pending_pick
+    key = (chosen_flag_left.get(), chosen_method.get())
+
+    # the ranking is already shown, or on its way
+    if key == requested_key:
+        return
+    requested_key = key
+    pending_pick = None
+
+    ranking_generation += 1
+    status_label.configure(text = "ranking flags by " + key[1] + "...")
+    ranking_requests.put((ranking_generation, key))
+
+def rank_requested_flags():
+    '''
+    Ranks the flags of each request in turn. This runs on the background thread.
     '''
-    chosen_flag_right.set(fp.farthest_flag(flag_left))
+    while True:
+        rank_flags(*ranking_requests.get())
+
+def rank_flags(generation, key):
+    '''
+    Ranks every flag by how similar it is to the flag of the given country. This runs
+    on the background thread, and hands the ranking to tk's thread when it's done.
+
+    Parameters
+    ----------
+    generation : int
+        The ranking request this is for
+
+    key : tuple
+        The country and method to rank by
+    '''
+    # a newer request was made while this one was waiting
+    if generation != ranking_generation:
+        return
+
+    country, method = key
+    try:
+        countries = fp.get_country_list()
+        dists = fp.flag_dist_matrix([country], countries, method)[0]
+
+        # every flag but the country's own, from most and least similar (sorting each
+        # way separately so that ties are broken like closest_flag and farthest_flag)
+        similarity = -dists if method == "ssim" else dists
+        closest = [(countries[i], dists[i]) for i in np.argsort(similarity, kind = "stable")
+            if countries[i] != country][:TOP_N]
+        farthest = [(countries[i], dists[i]) for i in np.argsort(-similarity, kind = "stable")
+            if countries[i] != country][:TOP_N]
+        result = (closest, farthest, None)
+    except Exception as e:
+        result = (None, None, e)
+
+    try:
+        root.after(0, lambda: show_ranking(generation, key, *result))
+    except (RuntimeError, tk.TclError):
+        # the window was closed
+        pass
+
+def format_score(score, method):
+    '''
+    Formats the given score for the ranked list.
+
+    Parameters
+    ----------
+    score : float
+        The distance between two flags
+
+    method : str
+        The method the distance was found with
+
+    Returns
+    -------
+    str
+        The formatted score
+    '''
+    if method == "ssim":
+        return str(round(float(score), 3))
+    return str(int(score))
+
+def show_ranking(generation, key, closest, farthest, error):
+    '''
+    Shows the given ranking in the ranked list, unless a newer one was requested since.
+    This runs on tk's thread.
+
+    Parameters
+    ----------
+    generation : int
+        The ranking request this is for
+
+    key : tuple
+        The country and method the flags were ranked by
+
+    closest : list
+        The (country, score) tuples of the most similar flags
+
+    farthest : list
+        The (country, score) tuples of the least similar flags
+
+    error : Exception
+        The error raised while ranking, or None
+    '''
+    global pending_pick, requested_key
+    if generation != ranking_generation:
+        return
+
+    if error is not None:
+        # the same ranking can be requested again
+        status_label.configure(text = "couldn't rank flags: " + str(error))
+        requested_key = None
+        pending_pick = None
+        return
+
+    ranking["key"] = key
+    ranking["closest"] = closest
+    ranking["farthest"] = farthest
+
+    ranked_list.delete(0, tk.END)
+    listed.clear()
+    for title, flags in (("most similar to " + key[0], closest), ("least similar to " + key[0], farthest)):
+        ranked_list.insert(tk.END, title)
+        listed.append(None)
+        for rank, (country, score) in enumerate(flags, 1):
+            ranked_list.insert(tk.END, str(rank) + ". " + country + " (" + format_score(score, key[1]) + ")")
+            listed.append(country)
+
+    status_label.configure(text = "ranked by " + key[1])
+
+    if pending_pick is not None:
+        chosen_flag_right.set(ranking[pending_pick][0][0])
+        pending_pick = None
+
+def choose_listed(event):
+    '''
+    Sets the right flag to the flag that was clicked in the ranked list.
+    '''
+    selection = ranked_list.curselection()
+    if selection and listed[selection[0]] is not None:
+        chosen_flag_right.set(listed[selection[0]])
 
 def swap():
     '''
@@ -41,34 +309,42 @@ def swap():
 
 def update_flags():
     '''
-    Updates the size and value of the two flags. This function is called every
-    10 milliseconds to ensure that the flags are always updated.
+    Updates the size and value of the two flags and the distance between them. Only
+    what changed since the last update is drawn again.
     '''
+    global pending_update
+    pending_update = None
+
     # setting the width/height of the flags based on the dimensions of the canvas itself
-    flag_width = int(min(frame.winfo_width(), frame.winfo_height()) / 2.5)
-    flag_height = int(flag_width / 2)
-
-    # updating size/image of the left flag
-    img_left = Image.fromarray(flag_df["flag"].loc[chosen_flag_left.get()])
-    img_left = img_left.resize((flag_width, flag_height), Image.ANTIALIAS)
-    flag_img_left = ImageTk.PhotoImage(image = img_left)
-    flag_left.configure(image=flag_img_left)
-    flag_left.image = flag_img_left
-
-    # updating size/image of the right flag
-    img_right = Image.fromarray(flag_df["flag"].loc[chosen_flag_right.get()])
-    img_right = img_right.resize((flag_width, flag_height), Image.ANTIALIAS)
-    flag_img_right = ImageTk.PhotoImage(image = img_right)
-    flag_right.configure(image=flag_img_right)
-    flag_right.image = flag_img_right
+    flag_width = max(1, int(min(frame.winfo_width(), frame.winfo_height()) / 2.5))
+    flag_height = max(1, int(flag_width / 2))
+
+    # updating size/image of the flags
+    for name, label, chosen in (("left", flag_left, chosen_flag_left), ("right", flag_right, chosen_flag_right)):
+        state = (chosen.get(), flag_width, flag_height)
+        if shown.get(name) != state:
+            flag_img = get_flag_image(*state)
+            label.configure(image = flag_img)
+            label.image = flag_img
+            shown[name] = state
 
     # updating the "distance" label
-    dist = int(fp.flag_dist(chosen_flag_left.get(), chosen_flag_right.get()))
-    dist_label.configure(text = "mse: " + str(dist))
-    dist_label.text = "mse: " + str(dist)
+    pair = (chosen_flag_left.get(), chosen_flag_right.get())
+    if shown.get("dist") != pair:
+        dist = int(get_distance(*pair))
+        dist_label.configure(text = "mse: " + str(dist))
+        dist_label.text = "mse: " + str(dist)
+        shown["dist"] = pair
 
-    # rerunning this method every 10 milliseconds
-    root.after(10, update_flags)
+def schedule_update(*args):
+    '''
+    Updates the flags once tk is idle. This is called whenever a flag is chosen or the
+    window is resized, and several calls before tk is idle (ie. from swapping both
+    flags, or dragging the edge of the window) only update the flags once.
+    '''
+    global pending_update
+    if pending_update is None:
+        pending_update = root.after_idle(update_flags)
 
 # the canvas
 canvas = tk.Canvas(root, height = HEIGHT, width = WIDTH)
@@ -76,7 +352,11 @@ canvas.pack()
 
 # the frame
 frame = tk.Frame(root, bg="#80c1ff", bd = 10)
-frame.place(relx = 0.05, rely = 0.05, relw = 0.9, relh = 0.9)
+frame.place(relx = 0.03, rely = 0.05, relw = 0.6, relh = 0.9)
+
+# the panel of the most and least similar flags
+panel = tk.Frame(root, bg="#80c1ff", bd = 10)
+panel.place(relx = 0.66, rely = 0.05, relw = 0.31, relh = 0.9)
 
 # the chosen flag variables
 chosen_flag_left = tk.StringVar(root)
@@ -93,26 +373,15 @@ dropdown_left.place(relx = 0.05, rely = 0.8, relwidth = 0.4, anchor = "nw")
 dropdown_right = tk.OptionMenu(frame, chosen_flag_right, *fp.get_country_list())
 dropdown_right.place(relx = 0.95, rely = 0.8, relwidth = 0.4, anchor = "ne")
 
-# the flags
-root.update()
-flag_width = int(min(frame.winfo_width(), frame.winfo_height()) / 6)
-flag_height = int(flag_width / 2)
-
-img_left = Image.fromarray(flag_df["flag"].loc[chosen_flag_left.get()])
-img_left = img_left.resize((flag_width, flag_height), Image.ANTIALIAS)
-flag_img_left = ImageTk.PhotoImage(image = img_left)
-flag_left = tk.Label(frame, image = flag_img_left)
+# the flags, which are drawn once the window is shown
+flag_left = tk.Label(frame)
 flag_left.place(relx = 0.25, rely = 0.2, anchor = "center")
 
-img_right = Image.fromarray(flag_df["flag"].loc[chosen_flag_right.get()])
-img_right = img_right.resize((flag_width, flag_height), Image.ANTIALIAS)
-flag_img_right = ImageTk.PhotoImage(image = img_right)
-flag_right = tk.Label(frame, image = flag_img_right)
+flag_right = tk.Label(frame)
 flag_right.place(relx = 0.75, rely = 0.2, anchor = "center")
 
 # the dist between the two flags
-dist = int(fp.flag_dist(chosen_flag_left.get(), chosen_flag_right.get()))
-dist_label = tk.Label(frame, text = "mse: " + str(dist))
+dist_label = tk.Label(frame)
 dist_label.place(relx = 0.5, rely = 0.5, relwidth = 0.4, relheight = 0.1, anchor = "center")
 
 # closest flag button
@@ -127,7 +396,37 @@ button2.place(relx = 0.2, rely = 0.9, relwidth = 0.2, relheight = 0.1)
 swap_button = tk.Button(frame, text = "<-->", command = lambda: swap())
 swap_button.place(relx = 0.5, rely = 0.6, relwidth = 0.2, anchor = "center")
 
-# calling method to update the flags
-update_flags()
+# the dropdown menu to choose the method that flags are ranked by
+chosen_method = tk.StringVar(root)
+chosen_method.set("mse")
+dropdown_method = tk.OptionMenu(panel, chosen_method, *METHODS)
+dropdown_method.place(relx = 0, rely = 0, relwidth = 1)
+
+# what the ranking is doing
+status_label = tk.Label(panel, anchor = "w")
+status_label.place(relx = 0, rely = 0.08, relwidth = 1)
+
+# the ranked list of the most and least similar flags, which can be scrolled
+ranked_list = tk.Listbox(panel, activestyle = "none")
+ranked_scrollbar = tk.Scrollbar(panel, command = ranked_list.yview)
+ranked_list.configure(yscrollcommand = ranked_scrollbar.set)
+ranked_list.place(relx = 0, rely = 0.16, relwidth = 0.92, relheight = 0.84)
+ranked_scrollbar.place(relx = 0.92, rely = 0.16, relwidth = 0.08, relheight = 0.84)
+ranked_list.bind("<<ListboxSelect>>", choose_listed)
+
+# a daemon thread, so that a ranking that is still running doesn't keep the program
+# open once the window is closed
+threading.Thread(target = rank_requested_flags, daemon = True).start()
+
+# ranking the flags again whenever the left flag or the method changes
+chosen_flag_left.trace_add("write", request_ranking)
+chosen_method.trace_add("write", request_ranking)
+request_ranking()
+
+# updating the flags only when one is chosen or the window is resized
+chosen_flag_left.trace_add("write", schedule_update)
+chosen_flag_right.trace_add("write", schedule_update)
+frame.bind("<Configure>", schedule_update)
+schedule_update()
 
 root.mainloop()
\ No newline at end of file
@@ -1,7 +1,14 @@
 from bs4 import BeautifulSoup
-import pandas as pd
-import requests
+from concurrent.futures import ThreadPoolExecutor
 from flagpy.flag_util import FlagUtil
+from flagpy.flag_gallery import FlagGallery, INDEX_FILE, write_atomic
+import numpy as np
+import hashlib
+import json
+import os
+
+# the name of the file that records where each flag came from
+MANIFEST_FILE = "manifest.json"
 
 class FlagScraper:
 
@@ -14,50 +21,102 @@ class FlagScraper:
         self.util = FlagUtil()
 
         # a list of non-countries that are still on the Wikipedia page for some reason
-        self.states = ["Abkhazia", "The Republic Of Artsakh", "The Republic Of China", "The Cook Islands", 
+        self.states = ["Abkhazia", "The Republic Of Artsakh", "The Republic Of China", "The Cook Islands",
         "Kosovo", "Niue", "Northern Cyprus", "Western Sahara", "Somaliland", "Ossetia", "Transnistria"]
 
-    def get_flags(self):
+    def get_flags(self, directory = ".", max_workers = 16):
         '''
-        Scrapes the name of each country and its corresponding flag image. Instead of storing the
-        image directly into a DataFrame, it stores the image in a .pkl file and stores the name 
-        of the file in the DataFrame instead.
+        Scrapes the name of each country and its corresponding flag image, and saves them
+        as a packed gallery (see FlagGallery) in the given directory. The flag images are
+        downloaded and processed by several threads at once.
+
+        Next to the gallery, a manifest records the url and a hash of the image that each
+        flag came from. When the gallery is rebuilt, flags whose image hasn't changed are
+        reused instead of processed again. The new gallery replaces the old one in a single
+        step, so an identifier loading it never sees half of the new flags.
+
+        Parameters
+        ----------
+        directory : str
+            The directory to save the gallery to
+
+        max_workers : int
+            The most flag images that are downloaded and processed at the same time
+
+        Returns
+        -------
+        FlagGallery
+            The rebuilt gallery
         '''
-        html = requests.get("https://en.wikipedia.org/wiki/Gallery_of_sovereign_state_flags").text
+        # the page and every flag image go through flagpy's cache of downloaded files,
+        # so only the ones that changed since the last scrape are downloaded again
+        html = self.util.fetch("https://en.wikipedia.org/wiki/Gallery_of_sovereign_state_flags")
         soup = BeautifulSoup(html, "lxml")
-        
-        flags = soup.find_all("li", class_ = "gallerybox")
-        flag_df = pd.DataFrame(columns = ["country", "flag"])
-        
-        i = 1
-        
-        for flag in flags:
+
+        entries = []
+        for flag in soup.find_all("li", class_ = "gallerybox"):
             # getting the name of the country
             country = flag.find("div", class_ = "gallerytext").find("a").get("title")
             country = country.split("Flag of ")[1].title()
 
-            # replacing the spaces with underscores to be used in file names
-            country_filename = country.replace(" ", "_")
-
             # fixing an edge case with the country of Georgia
             if "Georgia" in country:
                 country = "Georgia"
 
-            # getting the url of the flag and converting to a 180 x 90 RGB image (as a numpy array)
-            img_url = "https:" + flag.find("img").get("src")
-            img = self.util.process_img(img_url)
-            
-            # if the country is actually a country, add it to the df
+            # if the country is actually a country, add it to the gallery
             if country not in self.states:
-                self.util.pickle_numpy(img, country_filename)
-
-                flag_df = flag_df.append({"country": country, "flag": 'flags/' + country_filename + '.pkl'}, ignore_index = True)
-                i += 1
-
-            if i % 25 == 0:
-                print("finished", i, "flags")
-            
-            
-        print("finished all 195 flags!")
-        flag_df = flag_df.set_index("country")
-        flag_df.to_csv("flag_df.csv")
\ No newline at end of file
+                entries.append((country, "https:" + flag.find("img").get("src")))
+
+        manifest = self.__load_manifest(directory)
+        old_gallery = None
+        if os.path.exists(os.path.join(directory, INDEX_FILE)):
+            old_gallery = FlagGallery.load(directory, mmap = False)
+
+        def load(entry):
+            # downloading the image (which is only a revalidation if it is cached) and
+            # processing it into a 180 x 90 RGB image, unless it is the same image as last time
+            country, url = entry
+            image_bytes = self.util.fetch(url)
+            record = {"url": url, "sha1": hashlib.sha1(image_bytes).hexdigest()}
+
+            if old_gallery is not None and country in old_gallery and manifest.get(country) == record:
+                return old_gallery.get(country), record, False
+            return self.util.process_img(image_bytes), record, True
+
+        with ThreadPoolExecutor(max_workers = max_workers) as pool:
+            results = list(pool.map(load, entries))
+
+        names = [country for country, _ in entries]
+        gallery = FlagGallery(names, np.stack([flag for flag, _, _ in results]).astype(np.uint8))
+        gallery.save(directory)
+
+        # the manifest is only written once the gallery is in place, so it never
+        # describes flags that weren't saved
+        manifest = {country: record for country, (_, record, _) in zip(names, results)}
+        write_atomic(os.path.join(directory, MANIFEST_FILE),
+            lambda f: f.write(json.dumps(manifest, indent = 1).encode("utf-8")))
+
+        changed = sum(processed for _, _, processed in results)
+        print("finished all", len(names), "flags!", changed, "of them were new or changed")
+        return gallery
+
+    def __load_manifest(self, directory):
+        '''
+        Loads the manifest saved by the last scrape into the given directory.
+
+        Parameters
+        ----------
+        directory : str
+            The directory that the gallery is saved in
+
+        Returns
+        -------
+        dict
+            A dict of each country to the url and sha1 hash of its flag image, which is
+            empty if there is no manifest
+        '''
+        try:
+            with open(os.path.join(directory, MANIFEST_FILE)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
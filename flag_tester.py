@@ -1,22 +1,63 @@
 from bs4 import BeautifulSoup
-import requests
 from string import ascii_lowercase
+from concurrent.futures import ThreadPoolExecutor
+from flagpy.flag_http_cache import HTTPCache
+from flagpy.flag_util import FlagUtil
 import flagpy as fp
+import numpy as np
+import argparse
+import time
+import json
+import csv
+import os
 
 class FlagTester:
 
-    def test(self, test_website = "cia", method = "mse"):
+    def __init__(self, offline = False, audit_rate = 0.1):
+        '''
+        Initializes this tester. Every page and flag image it downloads is kept in flagpy's
+        cache of downloaded files and only downloaded again if it has changed, so repeated
+        tests barely touch the network.
+
+        Parameters
+        ----------
+        offline : bool
+            Whether or not to only use pages and images that are already cached, without
+            any network access (an IOError is raised if there is no cache to use)
+
+        audit_rate : float
+            The fraction of cascade identifications that are also scored with the metric
+            on every flag while the cascade method is evaluated, to report how often its
+            shortlist missed the best flag
+        '''
+        if not 0 <= audit_rate <= 1:
+            raise ValueError("the audit rate must be between 0 and 1")
+        self.audit_rate = audit_rate
+        self.util = FlagUtil()
+        if offline:
+            cache = self.util.get_http_cache()
+            if cache is None:
+                raise IOError("can't test offline, because the cache of downloaded files couldn't be created")
+
+            # an offline cache of the tester's own over the same files, so that the shared
+            # cache (and everything else in flagpy that downloads) stays online
+            self.util = FlagUtil(http_cache = HTTPCache(cache.directory, cache.max_bytes, offline = True))
+
+    def test(self, test_website = "cia", method = "mse", max_workers = 8):
         '''
         Tests the given method on the given website of flags.
 
         Parameters
         ----------
         test_website : str
-            Either "cia" or "flagpedia", represents the website used to test the 
+            Either "cia" or "flagpedia", represents the website used to test the
             flagpy identifier
 
         method : str
-            The method being tested (one of mse, ssim, or hash)
+            The method being tested (one of mse, ssim, hash, dhash, phash, or cascade)
+
+        max_workers : int
+            The most flags that are downloaded and identified at the same time
 
         Returns
         -------
@@ -24,105 +65,367 @@ class FlagTester:
             The accuracy of the identifier, out of 1.0
         '''
         if test_website == "cia":
-            return self.__test_with_cia(method)
+            entries = self.__entries_from_cia()
         elif test_website == "flagpedia":
-            return self.__test_with_flagpedia(method)
+            entries = self.__entries_from_flagpedia()
         else:
             raise ValueError("The test website must be one of: flagpedia, cia")
 
-    def __test_with_cia(self, identify_type):
+        results = self.evaluate_entries(entries, methods = (method,), max_workers = max_workers)
+
+        # showing how often the cascade's shortlist missed the best flag, to help tune its k
+        if method == "cascade":
+            print("cascade stats:", results["methods"][method]["cascade_stats"])
+
+        return results["methods"][method]["accuracy"]
+
+    def evaluate(self, manifest, methods = ("mse",), aliases = None, max_workers = 8, output = None):
+        '''
+        Evaluates the given methods on a labelled corpus of flag images on disk. The
+        manifest is a CSV file with a path and a country column, where each path is
+        relative to the manifest's directory.
+
+        Parameters
+        ----------
+        manifest : str
+            The path of the manifest
+
+        methods : tuple
+            The methods (any of mse, ssim, hash, dhash, phash, or cascade) to evaluate
+
+        aliases : object
+            A dict of other names for countries to their names in the gallery (ie.
+            "Burma" to "Myanmar"), or the path of a JSON file of one
+
+        max_workers : int
+            The most images that are loaded and identified at the same time
+
+        output : str
+            The path to save the results to as JSON, or None to not save them
+
+        Returns
+        -------
+        dict
+            The results, as returned by evaluate_entries
+        '''
+        results = self.evaluate_entries(self.load_manifest(manifest), methods, aliases, max_workers)
+
+        if output:
+            with open(output, "w") as f:
+                json.dump(results, f, indent = 1)
+
+        return results
+
+    def load_manifest(self, manifest):
         '''
-        Tests the given method on the CIA website of country flags.
+        Loads the entries of the given manifest (see evaluate).
 
         Parameters
         ----------
+        manifest : str
+            The path of the manifest
+
+        Returns
+        -------
+        list
+            A list of (image path, country) tuples
+        '''
+        directory = os.path.dirname(os.path.abspath(manifest))
+        with open(manifest, newline = "") as f:
+            return [(os.path.join(directory, row["path"]), row["country"]) for row in csv.DictReader(f)]
+
+    def resolve_country(self, label, countries, aliases = None):
+        '''
+        Returns the name in the gallery of the country with the given label, or None if
+        it isn't in the gallery. Labels can be in any case, in "Korea, South" order,
+        missing a leading "The", or one of the given aliases.
+
+        Parameters
+        ----------
+        label : str
+            The name of the country in a corpus or on a website
+
+        countries : set
+            The names of every country in the gallery
+
+        aliases : dict
+            Other names for countries (in title case) to their names in the gallery
+
+        Returns
+        -------
+        str
+            The name of the country in the gallery, or None
+        '''
+        country = label.strip().title()
+
+        # reformatting country names (ie. Korea, South -> South Korea)
+        if "," in country:
+            split = [part.strip() for part in country.split(",", 1)]
+            country = split[1] + " " + split[0]
+
+        if aliases:
+            country = aliases.get(country, country)
+
+        # checking if adding "The " to the front of the country name helps
+        for candidate in (country, "The " + country):
+            if candidate in countries:
+                return candidate
+
+        return None
+
+    def evaluate_entries(self, entries, methods = ("mse",), aliases = None, max_workers = 8):
+        '''
+        Evaluates the given methods on the given labelled images. Each image is loaded
+        once by several threads at once, and then identified with every method, again
+        by several threads at once. Images whose label isn't a country in the gallery are
+        skipped.
+
+        Parameters
+        ----------
+        entries : list
+            A list of (image source, country) tuples, where the source is anything that
+            flagpy can identify (a url, a file path, bytes, ...)
+
+        methods : tuple
+            The methods (any of mse, ssim, hash, dhash, phash, or cascade) to evaluate
+
+        aliases : object
+            A dict of other names for countries to their names in the gallery, or the
+            path of a JSON file of one
+
+        max_workers : int
+            The most images that are loaded and identified at the same time
+
+        Returns
+        -------
+        dict
+            The "methods" evaluated (each with its accuracy, confusion matrix, and timings),
+            every evaluated image (with how long it took to load, and its prediction and
+            the wall clock time of scoring it for each method), and the entries that were "skipped".
+            The cascade method's results also have its "cascade_stats" (see
+            get_cascade_stats), audited at the tester's audit_rate
+        '''
+        identifier = fp.get_identifier()
+        countries = set(identifier.get_country_list())
+
+        # loading what each method needs first, so that it isn't counted against the first images
+        needed = set(methods) - {"cascade"}
+        if "cascade" in methods:
+            needed |= {identifier.cascade_prefilter, identifier.cascade_metric}
+        identifier.warmup(tuple(needed))
+        aliases = self.__load_aliases(aliases)
+
+        images = []
+        skipped = []
+        for source, label in entries:
+            country = self.resolve_country(label, countries, aliases)
+            if country is None:
+                skipped.append({"source": str(source), "label": label})
+            else:
+                images.append({"source": source, "country": country, "predictions": {}, "score_ms": {}})
+
+        def load(image):
+            start = time.perf_counter()
+            try:
+                flag = self.util.process_img(image["source"], cache = False)
+            except Exception as e:
+                flag = None
+                image["error"] = repr(e)
+            image["load_ms"] = (time.perf_counter() - start) * 1000.0
+            return flag
+
+        results = {"methods": {}, "images": images, "skipped": skipped}
+        with ThreadPoolExecutor(max_workers = max_workers) as pool:
+            # every method shares the same loaded images
+            flags = list(pool.map(load, images))
+            loaded = [i for i, flag in enumerate(flags) if flag is not None]
+
+            for method in methods:
+                def identify(i):
+                    # timing the wall clock rather than the thread's cpu time, so that scoring
+                    # done in worker processes (see set_workers) is counted too
+                    start = time.perf_counter()
+                    country = identifier.identify(flags[i], method, cache = False)
+                    return country, (time.perf_counter() - start) * 1000.0
+
+                # auditing the cascade's shortlists for this run only
+                if method == "cascade":
+                    audit_rate = identifier.cascade_audit_rate
+                    identifier.set_cascade_audit_rate(self.audit_rate)
+                    identifier.reset_cascade_stats()
+
+                start = time.perf_counter()
+                try:
+                    predictions = list(pool.map(identify, loaded))
+                finally:
+                    if method == "cascade":
+                        identifier.set_cascade_audit_rate(audit_rate)
+                seconds = time.perf_counter() - start
+
+                for i, (country, ms) in zip(loaded, predictions):
+                    images[i]["predictions"][method] = country
+                    images[i]["score_ms"][method] = ms
+
+                results["methods"][method] = self.__summarize(images, loaded, method, seconds)
+                if method == "cascade":
+                    results["methods"][method]["cascade_stats"] = identifier.get_cascade_stats()
+
+        for image in images:
+            image["source"] = str(image["source"])
+
+        return results
+
+    def __summarize(self, images, loaded, method, seconds):
+        '''
+        Summarizes how the given method did on the loaded images.
+
+        Parameters
+        ----------
+        images : list
+            Every evaluated image, with the method's predictions filled in
+
+        loaded : list
+            The indices of the images that loaded
+
         method : str
-            The method being tested (one of mse, ssim, or hash)
+            The method that was evaluated
+
+        seconds : float
+            How long identifying every image took
 
         Returns
         -------
-        float
-            The accuracy of the identifier, out of 1.0
+        dict
+            The accuracy, number of images that were correct, evaluated, and failed to
+            load, the confusion matrix (as a dict of each true country to the number of
+            times each country was predicted for it), and the timings of the method
         '''
-        html = requests.get("https://www.cia.gov/library/publications/the-world-factbook/docs/flagsoftheworld.html").text
+        confusion = {}
+        correct = 0
+        for i in loaded:
+            truth, predicted = images[i]["country"], images[i]["predictions"][method]
+            row = confusion.setdefault(truth, {})
+            row[predicted] = row.get(predicted, 0) + 1
+            correct += truth == predicted
+
+        ms = np.asarray([images[i]["score_ms"][method] for i in loaded], dtype = np.float64)
+        return {
+            "accuracy": correct / len(loaded) if loaded else None,
+            "correct": correct,
+            "total": len(loaded),
+            "errors": len(images) - len(loaded),
+            "confusion": confusion,
+            "seconds": seconds,
+            "images_per_second": len(loaded) / seconds if seconds else None,
+            "mean_score_ms": float(ms.mean()) if len(ms) else None,
+            "p90_score_ms": float(np.percentile(ms, 90)) if len(ms) else None
+        }
+
+    def __load_aliases(self, aliases):
+        '''
+        Loads the given aliases, with their names in title case so that they match
+        resolve_country.
+
+        Parameters
+        ----------
+        aliases : object
+            A dict of aliases, the path of a JSON file of one, or None
+
+        Returns
+        -------
+        dict
+            The aliases
+        '''
+        if aliases is None:
+            return {}
+        if isinstance(aliases, str):
+            with open(aliases) as f:
+                aliases = json.load(f)
+
+        return {alias.strip().title(): country for alias, country in aliases.items()}
+
+    def __entries_from_cia(self):
+        '''
+        Scrapes the CIA website of country flags.
+
+        Returns
+        -------
+        list
+            A list of (image url, country) tuples
+        '''
+        html = self.util.fetch("https://www.cia.gov/library/publications/the-world-factbook/docs/flagsoftheworld.html")
         soup = BeautifulSoup(html, "lxml")
-        
-        num_correct = 0
-        num_total = 0
-        
+
+        entries = []
         for letter in ascii_lowercase:
 
             # all of the flags on the website
             test_flags = soup.find_all("li", class_ = "flag appendix-entry ln-" + letter)
-            
+
             for flag in test_flags:
-                
-                flag_country = flag.find("span").get_text().title()
-
-                # reformatting country names (ie. Korea, South -> South Korea)
-                if "," in flag_country:
-                    split = flag_country.split(", ")
-                    flag_country = split[1] + " " + split[0]
-                    
-                
                 flag_img = flag.find("img").get("src").replace("..", "https://www.cia.gov/library/publications/the-world-factbook")
+                entries.append((flag_img, flag.find("span").get_text()))
 
-                # Checking if adding "The " to the front of the country name helps 
-                # with reformatting
-                if flag_country in fp.get_country_list() or "The " + flag_country in fp.get_country_list():
-                    num_total += 1
-                    identified_flag = fp.identify(flag_img, method = identify_type)
-                    if identified_flag == flag_country or identified_flag == "The " + flag_country:
-                        num_correct+=1
+        return entries
 
-                    if num_total % 25 == 0:
-                        print("tested", num_total, "flags so far")
-
-        return num_correct / num_total
-
-    def __test_with_flagpedia(self, identify_type):
+    def __entries_from_flagpedia(self):
         '''
-        Tests the given method on the flagpedia website of country flags.
-
-        Parameters
-        ----------
-        method : str
-            The method being tested (one of mse, ssim, or hash)
+        Scrapes the flagpedia website of country flags.
 
         Returns
         -------
-        float
-            The accuracy of the identifier, out of 1.0
+        list
+            A list of (image url, country) tuples
         '''
-        html = requests.get("https://flagpedia.net/index").text
+        html = self.util.fetch("https://flagpedia.net/index")
         soup = BeautifulSoup(html, "lxml")
-        
-        num_correct = 0
-        num_total = 0
 
         # all of the flags on the website
         test_flags = soup.find("ul", class_ = "flag-grid").find_all("li")
 
-        for flag in test_flags:
+        return [("https://flagpedia.net/" + flag.find("img").get("src"), flag.find("span").get_text())
+            for flag in test_flags]
+
+def main(args = None):
+    '''
+    Evaluates flagpy's methods on a labelled corpus of flag images on disk.
 
-            flag_country = flag.find("span").get_text().title()
+    Parameters
+    ----------
+    args : list
+        The command line arguments (sys.argv is used if not given)
+    '''
+    parser = argparse.ArgumentParser(description = "Evaluates flagpy on a labelled corpus of flag images.")
+    parser.add_argument("manifest", help = "a CSV file with a path and a country column")
+    parser.add_argument("--methods", default = "mse,hash,ssim", help = "the methods to evaluate (comma separated)")
+    parser.add_argument("--aliases", help = "a JSON file of other names for countries to their names in flagpy")
+    parser.add_argument("--workers", type = int, default = 8, help = "the most images worked on at once")
+    parser.add_argument("--offline", action = "store_true",
+        help = "only use images that are already in the cache of downloaded files")
+    parser.add_argument("--processes", type = int, default = 0, help = "the number of scoring processes")
+    parser.add_argument("--audit-rate", type = float, default = 0.1,
+        help = "the fraction of cascade identifications checked against the metric on every flag")
+    parser.add_argument("--output", help = "the file to save the results to")
+    args = parser.parse_args(args)
 
-            # reformatting country names (ie. Korea, South -> South Korea)
-            if "," in flag_country:
-                split = flag_country.split(", ")
-                flag_country = split[1] + " " + split[0]
+    fp.set_workers(args.processes)
+    results = FlagTester(offline = args.offline, audit_rate = args.audit_rate).evaluate(args.manifest, tuple(args.methods.split(",")), args.aliases,
+        args.workers, args.output)
 
-            flag_img = "https://flagpedia.net/" + flag.find("img").get("src")
+    for method, summary in results["methods"].items():
+        print(method, "accuracy", summary["accuracy"], "(" + str(summary["correct"]) + "/" + str(summary["total"]) + "),",
+            round(summary["images_per_second"] or 0, 1), "images/s")
+        if "cascade_stats" in summary:
+            print("    cascade stats:", summary["cascade_stats"])
 
-            # Checking if adding "The " to the front of the country name helps 
-            # with reformatting
-            if flag_country in fp.get_country_list() or "The " + flag_country in fp.get_country_list():
-                num_total += 1
-                identified_flag = fp.identify(flag_img, method = identify_type)
-                if identified_flag == flag_country or identified_flag == "The " + flag_country:
-                    num_correct+=1
+        # the countries that were most often mistaken for another
+        mistakes = sorted(((count, truth, predicted) for truth, row in summary["confusion"].items()
+            for predicted, count in row.items() if predicted != truth), reverse = True)
+        for count, truth, predicted in mistakes[:5]:
+            print("   ", truth, "->", predicted, count)
 
-                if num_total % 25 == 0:
-                    print("tested", num_total, "flags so far")
+    if results["skipped"]:
+        print("skipped", len(results["skipped"]), "images whose country isn't in flagpy")
 
-        return num_correct / num_total
\ No newline at end of file
+if __name__ == "__main__":
+    main()
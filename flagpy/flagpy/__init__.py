@@ -1,28 +1,192 @@
-from .flag_identifier import FlagIdentifier
+import threading
 
-# the identifier
-id = FlagIdentifier()
+# the identifier, which isn't created until flagpy is first used
+identifier = None
+identifier_lock = threading.Lock()
 
-def identify(url, method = "mse"):
+def get_identifier():
     '''
-    Uses the given method (either mse, ssim, or hash) to identify the flag that is most similar
-    to the image linked to the provided url.
+    Returns the FlagIdentifier shared by all of flagpy's functions, creating it the
+    first time it is needed.
+
+    Returns
+    -------
+    FlagIdentifier
+        The shared identifier
+    '''
+    global identifier
+    if identifier is None:
+        with identifier_lock:
+            if identifier is None:
+                from .flag_identifier import FlagIdentifier
+                identifier = FlagIdentifier()
+
+    return identifier
+
+def __getattr__(name):
+    # keeps flagpy.id and flagpy.FlagIdentifier working without importing
+    # anything until they are actually used
+    if name == "id":
+        return get_identifier()
+    elif name == "FlagIdentifier":
+        from .flag_identifier import FlagIdentifier
+        return FlagIdentifier
+    raise AttributeError("module 'flagpy' has no attribute " + repr(name))
+
+def warmup(methods = ("mse", "ssim", "hash", "dhash", "phash")):
+    '''
+    Loads the gallery and everything the given methods need right away, so that
+    later calls don't pay for it. This is useful for servers that would rather
+    start up slower than answer their first request slower.
+
+    Parameters
+    ----------
+    methods : tuple
+        The methods (any of mse, ssim, hash, dhash, or phash) to get ready
+    '''
+    get_identifier().warmup(methods)
+
+def set_workers(workers):
+    '''
+    Spreads mse and ssim scoring across the given number of processes. The workers
+    memory map the gallery instead of each loading their own copy, and results are
+    always the same as (and in the same order as) scoring in one process. This helps
+    most with identify_many, flag_dist_matrix, and identifying with ssim.
+
+    Parameters
+    ----------
+    workers : int
+        The number of worker processes (0 or 1 scores everything in this process)
+    '''
+    get_identifier().set_workers(workers)
+
+def identify(url, method = "mse", cache = True):
+    '''
+    Uses the given method (one of mse, ssim, hash, dhash, phash, or cascade) to identify the flag
+    that is most similar to the image linked to the provided url.
+
+    Parameters
+    ----------
+    url : object
+        The url linking to an image of a flag to be identified. It can also be a file path,
+        the contents of an image file (bytes or a memoryview), a PIL Image, or a numpy
+        array of pixels
+
+    method : str
+        The method (one of mse, ssim, hash, dhash, phash, or cascade) used to identify the flag
+        that the image is representing
+
+    cache : bool
+        Whether or not to use (and store) cached results for images that were seen before
+
+    Returns
+    -------
+    str
+        A string of the country name whose flag is most similar to the given flag image
+    '''
+    return get_identifier().identify(url, method = method, cache = cache)
+
+def identify_many(urls, method = "mse", max_workers = 8, cache = True):
+    '''
+    Identifies the flags in the images linked to by each of the given urls, downloading
+    several images at once and scoring them all together.
 
     Parameters
     ----------
-    url : str
-        The url linking to an image of a flag to be identified
+    urls : list
+        The urls linking to images of flags to be identified (or any other image sources
+        accepted by identify)
 
     method : str
-        The method (one of mse, ssim, or hash) used to identify the flag that the 
-        image is representing
+        The method (one of mse, ssim, hash, dhash, phash, or cascade) used to identify the flags
+
+    max_workers : int
+        The most images that are downloaded at the same time
+
+    cache : bool
+        Whether or not to use (and store) cached results for images that were seen before
+
+    Returns
+    -------
+    list
+        For each url (in the same order), the name of the country whose flag is most similar
+        to the one in its image, or the exception raised while downloading or processing it
+    '''
+    return get_identifier().identify_many(urls, method = method, max_workers = max_workers, cache = cache)
+
+async def aidentify(url, method = "mse"):
+    '''
+    Uses the given method (one of mse, ssim, hash, dhash, phash, or cascade) to identify
+    the flag that is most similar to the image linked to the provided url, without blocking
+    the event loop.
+
+    Parameters
+    ----------
+    url : object
+        The url linking to an image of a flag to be identified. It can also be a file path,
+        the contents of an image file (bytes or a memoryview), a PIL Image, or a numpy
+        array of pixels
+
+    method : str
+        The method (one of mse, ssim, hash, dhash, phash, or cascade) used to identify the flag
 
     Returns
     -------
     str
         A string of the country name whose flag is most similar to the given flag image
     '''
-    return id.identify(url, method = method)
+    return await get_identifier().aidentify(url, method = method)
+
+async def aidentify_many(urls, method = "mse", concurrency = 16):
+    '''
+    Identifies the flags in the images linked to by each of the given urls without blocking
+    the event loop, downloading at most concurrency images at once.
+
+    Parameters
+    ----------
+    urls : list
+        The urls linking to images of flags to be identified (or any other image sources
+        accepted by identify)
+
+    method : str
+        The method (one of mse, ssim, hash, dhash, phash, or cascade) used to identify the flags
+
+    concurrency : int
+        The most images that are downloaded at the same time
+
+    Returns
+    -------
+    list
+        For each url (in the same order), the name of the country whose flag is most similar
+        to the one in its image, or the exception raised while downloading or processing it
+    '''
+    return await get_identifier().aidentify_many(urls, method = method, concurrency = concurrency)
+
+def identify_topk(url, k = 5, method = "mse"):
+    '''
+    Uses the given method (one of mse, ssim, hash, dhash, phash, or cascade) to find the k
+    flags that are most similar to the image linked to the provided url, along with their
+    scores.
+
+    Parameters
+    ----------
+    url : object
+        The url linking to an image of a flag to be identified. It can also be a file path,
+        the contents of an image file (bytes or a memoryview), a PIL Image, or a numpy
+        array of pixels
+
+    k : int
+        The number of countries to return
+
+    method : str
+        The method (one of mse, ssim, hash, dhash, phash, or cascade) used to score the flags
+
+    Returns
+    -------
+    list
+        A list of (country, score) tuples of the k most similar flags, most similar first
+    '''
+    return get_identifier().identify_topk(url, k = k, method = method)
 
 def closest_flag(country, method = "mse"):
     '''
@@ -35,7 +199,7 @@ def closest_flag(country, method = "mse"):
         The name of the country
     
     method : str
-        The method (one of mse, ssim, or hash) used to find the flag that is
+        The method (one of mse, ssim, hash, dhash, or phash) used to find the flag that is
         most similar to the one of the given country
 
     Returns
@@ -44,7 +208,7 @@ def closest_flag(country, method = "mse"):
         A string of the country name whose flag is most similar to that of the given country
         name
     '''
-    return id.closest_flag(country, method = method)
+    return get_identifier().closest_flag(country, method = method)
 
 def farthest_flag(country, method = "mse"):
     '''
@@ -57,7 +221,7 @@ def farthest_flag(country, method = "mse"):
         The name of the country
 
     method : str
-        The method (one of mse, ssim, or hash) used to find the flag that is 
+        The method (one of mse, ssim, hash, dhash, or phash) used to find the flag that is 
         least similar to the one of the given country
 
     Returns
@@ -66,7 +230,7 @@ def farthest_flag(country, method = "mse"):
         A string of the country name whose flag is least similar to that of the given country
         name
     '''
-    return id.farthest_flag(country, method = method)
+    return get_identifier().farthest_flag(country, method = method)
 
 def display(country):
     '''
@@ -77,7 +241,7 @@ def display(country):
     country : str
         The name of the country whose flag is to be displayed
     '''
-    id.display(country)
+    get_identifier().display(country)
 
 def get_flag_img(country):
     '''
@@ -93,7 +257,7 @@ def get_flag_img(country):
     Image
         an image object representing the flag of the given country name.
     '''
-    return id.get_flag_img(country)
+    return get_identifier().get_flag_img(country)
 
 def get_flag_df():
     '''
@@ -104,7 +268,74 @@ def get_flag_df():
     DataFrame
         A DataFrame of all the country names and their corresponding flags
     '''
-    return id.get_flag_df()
+    return get_identifier().get_flag_df()
+
+def get_cascade_stats():
+    '''
+    Returns how many times the cascade method has been used, how many of those were
+    audited against its metric on every flag, and how many of the audited ones had a
+    best flag that the prefilter left off the shortlist. Audits only happen once an
+    audit rate above 0 is set with set_cascade_audit_rate.
+
+    Returns
+    -------
+    dict
+        The calls, audited, and misses counts, and the miss_rate
+    '''
+    return get_identifier().get_cascade_stats()
+
+def set_cascade_audit_rate(rate):
+    '''
+    Sets the fraction of cascade identifications that are also scored with the
+    cascade's metric on every flag, to count (in get_cascade_stats) how often the best
+    flag was left off the shortlist. Audited calls cost as much as using the metric
+    alone, so a small rate like 0.05 is usually enough to tune cascade_k.
+
+    Parameters
+    ----------
+    rate : float
+        The fraction of cascade identifications to audit, from 0 (none, the default)
+        to 1 (all)
+    '''
+    get_identifier().set_cascade_audit_rate(rate)
+
+def get_cache_stats():
+    '''
+    Returns how often identify found a cached result for an image it had seen before
+    (by the image's contents, not its url), and how often a downloaded image had
+    already been processed.
+
+    Returns
+    -------
+    dict
+        The hits, disk_hits, misses, entries, and hit_rate of the "results" and "images" caches
+    '''
+    return get_identifier().get_cache_stats()
+
+def enable_stats(enabled = True):
+    '''
+    Turns on (or off) recording how long each stage of identification takes (download,
+    decode, resize, quantize, and score) along with counters like the number of calls
+    and bytes downloaded. Recording costs next to nothing while it is turned off.
+
+    Parameters
+    ----------
+    enabled : bool
+        Whether or not to record
+    '''
+    get_identifier().stats.enable(enabled)
+
+def get_stats():
+    '''
+    Returns everything recorded since enable_stats was called.
+
+    Returns
+    -------
+    dict
+        The "timers" (the calls, total_ms, mean_ms, and max_ms of each stage) and the
+        "counters" that were recorded
+    '''
+    return get_identifier().stats.snapshot()
 
 def get_country_list():
     '''
@@ -115,12 +346,12 @@ def get_country_list():
     list
         A list of all the country names
     '''
-    return id.get_country_list()
+    return get_identifier().get_country_list()
 
 def flag_dist(countryA, countryB, method = "mse"):
     '''
     Gets the distance between the flags of the two given countries
-    using the given method (one of mse, ssim, or hash).
+    using the given method (one of mse, ssim, hash, dhash, or phash).
 
     Parameters
     ----------
@@ -131,8 +362,8 @@ def flag_dist(countryA, countryB, method = "mse"):
         The name of the second country
 
     method : str
-        The method (one of mse, ssim, or hash) used to find distance between the
-        flags of the two given countries. For both mse and hash, smaller values mean higher 
+        The method (one of mse, ssim, hash, dhash, or phash) used to find distance between the
+        flags of the two given countries. For mse and the hashes, smaller values mean higher 
         similarity and a value of 0 means the two flags are identical. For ssim, higher values mean 
         higher similarity and the value must be between -1 and 1. A value of 1 for ssim
         means the two flags are identical.
@@ -142,4 +373,29 @@ def flag_dist(countryA, countryB, method = "mse"):
     float
         The distance between the two flags of the two given countries
     '''
-    return id.flag_dist(countryA, countryB, method)
\ No newline at end of file
+    return get_identifier().flag_dist(countryA, countryB, method)
+
+def flag_dist_matrix(countriesA, countriesB, method = "mse"):
+    '''
+    Gets the distance between every flag of the first list of countries and every
+    flag of the second list using the given method (one of mse, ssim, hash, dhash, or phash).
+
+    Parameters
+    ----------
+    countriesA : list
+        The names of the first countries
+
+    countriesB : list
+        The names of the second countries
+
+    method : str
+        The method (one of mse, ssim, hash, dhash, or phash) used to find distance between
+        the flags, as in flag_dist
+
+    Returns
+    -------
+    array
+        A numpy array where the value at [i, j] is the distance between the flags of
+        countriesA[i] and countriesB[j]
+    '''
+    return get_identifier().flag_dist_matrix(countriesA, countriesB, method)
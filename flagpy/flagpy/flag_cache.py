@@ -0,0 +1,268 @@
+from collections import OrderedDict
+import numpy as np
+import threading
+import hashlib
+import os
+
+def content_key(*parts):
+    '''
+    Returns a digest of the given parts, which can be bytes-like objects (like the
+    contents of an image or a numpy array of its pixels) or strings.
+
+    Parameters
+    ----------
+    parts : tuple
+        The parts that make up the key
+
+    Returns
+    -------
+    str
+        The hex digest of the parts
+    '''
+    digest = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        elif isinstance(part, np.ndarray):
+            part = np.ascontiguousarray(part).data
+
+        # prefixing each part with its length so that different splits never collide
+        part = memoryview(part).cast("B")
+        digest.update(len(part).to_bytes(8, "little"))
+        digest.update(part)
+
+    return digest.hexdigest()
+
+class LRUCache:
+
+    def __init__(self, max_entries = 1024, directory = None, max_disk_bytes = 64 << 20):
+        '''
+        Initializes an LRUCache object that keeps the max_entries most recently used
+        values in memory. If a directory is given, every value is also saved there, so
+        values that were evicted (or cached by an earlier process) are still found.
+        Values saved to disk must be numpy arrays or strings. Once the saved values
+        take up more than max_disk_bytes, the least recently used files are removed.
+
+        Parameters
+        ----------
+        max_entries : int
+            The most values kept in memory
+
+        directory : str
+            The directory that values are saved to, or None to only keep them in memory
+
+        max_disk_bytes : int
+            The most bytes of values kept in the directory
+        '''
+        self.max_entries = max_entries
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+
+        # the bytes saved to the directory, which is only counted (by listing it) when
+        # the first value is saved and whenever it seems to have grown too big
+        self.disk_bytes = None
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.counts = {"hits": 0, "disk_hits": 0, "misses": 0}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        '''
+        Returns the value stored under the given key, or None if there isn't one.
+
+        Parameters
+        ----------
+        key : str
+            The key of the value, as returned by content_key
+
+        Returns
+        -------
+        object
+            The cached value, or None
+        '''
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.counts["hits"] += 1
+                return self.entries[key]
+
+        value = self.__load(key)
+        with self.lock:
+            if value is None:
+                self.counts["misses"] += 1
+            else:
+                self.counts["disk_hits"] += 1
+                self.__remember(key, value)
+
+        return value
+
+    def put(self, key, value):
+        '''
+        Stores the given value under the given key.
+
+        Parameters
+        ----------
+        key : str
+            The key of the value, as returned by content_key
+
+        value : object
+            The value to store
+        '''
+        with self.lock:
+            self.__remember(key, value)
+
+        self.__save(key, value)
+
+    def clear(self):
+        '''
+        Removes every value kept in memory and resets the counts (values saved to disk
+        are kept).
+        '''
+        with self.lock:
+            self.entries.clear()
+            self.counts = {"hits": 0, "disk_hits": 0, "misses": 0}
+
+    def stats(self):
+        '''
+        Returns how many lookups were found in memory, found on disk, and missed, along
+        with how many values are in memory and the hit rate.
+
+        Returns
+        -------
+        dict
+            The hits, disk_hits, misses, entries, and hit_rate
+        '''
+        with self.lock:
+            stats = dict(self.counts)
+            stats["entries"] = len(self.entries)
+
+        lookups = stats["hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["hits"] + stats["disk_hits"]) / lookups if lookups else None
+        return stats
+
+    def __remember(self, key, value):
+        '''
+        Stores the given value in memory, evicting the least recently used value if
+        there are too many. The lock must be held.
+
+        Parameters
+        ----------
+        key : str
+            The key of the value
+
+        value : object
+            The value to store
+        '''
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last = False)
+
+    def __path(self, key):
+        return os.path.join(self.directory, key + ".npy")
+
+    def __load(self, key):
+        '''
+        Returns the value saved to disk under the given key, or None.
+
+        Parameters
+        ----------
+        key : str
+            The key of the value
+
+        Returns
+        -------
+        object
+            The saved value, or None
+        '''
+        if not self.directory:
+            return None
+
+        path = self.__path(key)
+        try:
+            value = np.load(path, allow_pickle = False)
+        except (OSError, ValueError):
+            return None
+
+        # marking the file as just used, so that it is evicted last
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        # strings are saved as 0-dimensional arrays
+        return value.item() if value.dtype.kind == "U" else value
+
+    def __save(self, key, value):
+        '''
+        Saves the given value to disk, if this cache has a directory, and then evicts
+        old files if the directory is too big. The value is written to a temporary file
+        first so that a reader never sees half of it.
+
+        Parameters
+        ----------
+        key : str
+            The key of the value
+
+        value : object
+            The value to save
+        '''
+        if not self.directory:
+            return
+
+        path = self.__path(key)
+        tmp_path = path + ".tmp." + str(os.getpid()) + "." + str(threading.get_ident())
+        try:
+            with open(tmp_path, "wb") as f:
+                np.save(f, np.asarray(value), allow_pickle = False)
+                size = f.tell()
+            os.replace(tmp_path, path)
+        except OSError:
+            # not being able to save a value only costs time later
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        with self.lock:
+            if self.disk_bytes is not None:
+                self.disk_bytes += size
+            too_big = self.disk_bytes is None or self.disk_bytes > self.max_disk_bytes
+
+        if too_big:
+            self.evict()
+
+    def evict(self):
+        '''
+        Removes the least recently used files from the directory until it holds at most
+        max_disk_bytes of values. Files saved by other processes sharing the directory
+        are counted (and removed) too.
+        '''
+        with self.lock:
+            try:
+                names = os.listdir(self.directory)
+            except OSError:
+                return
+
+            entries = []
+            for name in names:
+                if name.endswith(".npy"):
+                    try:
+                        stat = os.stat(os.path.join(self.directory, name))
+                    except OSError:
+                        # removed by another process since the directory was listed
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, name))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, name in sorted(entries):
+                if total <= self.max_disk_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+                total -= size
+
+            self.disk_bytes = total
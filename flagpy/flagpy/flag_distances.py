@@ -0,0 +1,212 @@
+import numpy as np
+import threading
+import os
+
+class DistanceMatrix:
+
+    def __init__(self, size, path = None):
+        '''
+        Initializes a DistanceMatrix object holding the distance between every pair of
+        flags in a gallery for one method. Distances are only filled in as they are needed,
+        so unknown distances are stored as NaN. If a path is given, the matrix is loaded
+        from it (if it exists) and saved back to it whenever a whole row is computed.
+        A matrix can be shared by several threads at once.
+
+        Parameters
+        ----------
+        size : int
+            The number of flags in the gallery
+
+        path : str
+            The .npy file that the matrix is stored in, or None to keep it in memory only
+        '''
+        self.path = path
+        self.values = None
+
+        # guards values, which one thread can fill in while another reads or changes it
+        self.lock = threading.Lock()
+
+        # bumped by every update, so that rows computed before one are thrown away
+        self.updates = 0
+
+        if path and os.path.exists(path):
+            try:
+                values = np.load(path, allow_pickle = False)
+                if values.shape == (size, size):
+                    self.values = values
+            except (OSError, ValueError):
+                # a damaged cache file is just recomputed
+                pass
+
+        if self.values is None:
+            self.values = np.full((size, size), np.nan)
+
+    def get(self, i, j):
+        '''
+        Returns the stored distance between the i-th and j-th flags.
+
+        Parameters
+        ----------
+        i : int
+            The row of the first flag
+
+        j : int
+            The row of the second flag
+
+        Returns
+        -------
+        float
+            The distance between the two flags, or NaN if it has not been computed
+        '''
+        return self.values[i, j]
+
+    def set(self, i, j, dist):
+        '''
+        Stores the distance between the i-th and j-th flags. Every method is symmetric,
+        so the distance is stored both ways.
+
+        Parameters
+        ----------
+        i : int
+            The row of the first flag
+
+        j : int
+            The row of the second flag
+
+        dist : float
+            The distance between the two flags
+        '''
+        with self.lock:
+            self.values[i, j] = dist
+            self.values[j, i] = dist
+
+    def has_row(self, i):
+        '''
+        Returns whether or not every distance from the i-th flag has been computed.
+
+        Parameters
+        ----------
+        i : int
+            The row of the flag
+
+        Returns
+        -------
+        bool
+            Whether or not the i-th row is complete
+        '''
+        return not np.isnan(self.values[i]).any()
+
+    def row(self, i, compute_rows):
+        '''
+        Returns the distances between the i-th flag and every flag, computing them
+        with the given function if any of them are missing.
+
+        Parameters
+        ----------
+        i : int
+            The row of the flag
+
+        compute_rows : function
+            A function that takes a list of rows and returns the distances from each
+            of those flags to every flag
+
+        Returns
+        -------
+        array
+            A numpy array of the distances between the i-th flag and every flag
+        '''
+        return self.rows([i], compute_rows)[0]
+
+    def rows(self, rows, compute_rows):
+        '''
+        Returns the distances between each of the given flags and every flag. All of
+        the missing rows are computed with a single call of the given function, which
+        is made without holding the lock so that other threads aren't kept waiting.
+
+        Parameters
+        ----------
+        rows : list
+            The rows of the flags
+
+        compute_rows : function
+            A function that takes a list of rows and returns the distances from each
+            of those flags to every flag
+
+        Returns
+        -------
+        array
+            A (len(rows), N) numpy array of distances
+        '''
+        while True:
+            with self.lock:
+                missing = [i for i in dict.fromkeys(rows) if not self.has_row(i)]
+                if not missing:
+                    return self.values[rows]
+                updates = self.updates
+
+            dists = np.asarray(compute_rows(missing), dtype = np.float64)
+
+            with self.lock:
+                # the gallery changed while the rows were computed, so they may be for
+                # the wrong flags and are computed again
+                if updates != self.updates:
+                    continue
+
+                for i, row in zip(missing, dists):
+                    self.values[i, :] = row
+                    self.values[:, i] = row
+                values = self.values[rows]
+
+            self.save()
+            return values
+
+    def update(self, row, action):
+        '''
+        Updates the matrix after one flag of the gallery was added, replaced, or removed.
+        The distances to a new or replaced flag become unknown, and every other distance
+        is kept.
+
+        Parameters
+        ----------
+        row : int
+            The row that changed
+
+        action : str
+            One of "add", "replace", or "remove"
+        '''
+        if action not in ("add", "replace", "remove"):
+            raise ValueError("action must be one of: add, replace, remove")
+
+        with self.lock:
+            if action == "add":
+                values = np.full((len(self.values) + 1, len(self.values) + 1), np.nan)
+                values[:-1, :-1] = self.values
+                self.values = values
+            elif action == "replace":
+                self.values[row, :] = np.nan
+                self.values[:, row] = np.nan
+            else:
+                self.values = np.delete(np.delete(self.values, row, axis = 0), row, axis = 1)
+            self.updates += 1
+
+    def save(self):
+        '''
+        Saves the matrix to its path, if it has one. The matrix is written to a temporary
+        file first so that a reader never sees a half written matrix.
+        '''
+        if not self.path:
+            return
+
+        with self.lock:
+            values = self.values.copy()
+            path = self.path
+
+        tmp_path = path + ".tmp." + str(os.getpid()) + "." + str(threading.get_ident())
+        try:
+            with open(tmp_path, "wb") as f:
+                np.save(f, values)
+            os.replace(tmp_path, path)
+        except OSError:
+            # not being able to cache the matrix only costs time
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
@@ -0,0 +1,470 @@
+from .flag_palette import Palette, PaletteImages
+import numpy as np
+import hashlib
+import pickle
+import json
+import csv
+import os
+
+# the directory that the bundled gallery is stored in
+GALLERY_DIR = os.path.dirname(__file__)
+
+# the name of the file that indexes the gallery
+INDEX_FILE = "gallery.json"
+
+def write_atomic(path, write):
+    '''
+    Writes a file by writing it to a temporary file in the same directory first and then
+    renaming it, so that a reader never sees half of it.
+
+    Parameters
+    ----------
+    path : str
+        The path of the file
+
+    write : function
+        A function that takes the open (binary) temporary file and writes to it
+    '''
+    tmp_path = path + ".tmp." + str(os.getpid())
+    try:
+        with open(tmp_path, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def update_rows(values, row, action, new_rows = None):
+    '''
+    Returns the given array (of something kept for each flag in a gallery) with one
+    row added to the end, replaced, or removed, to match a change to the gallery.
+
+    Parameters
+    ----------
+    values : array
+        An array with one row per flag
+
+    row : int
+        The row that changed
+
+    action : str
+        One of "add", "replace", or "remove"
+
+    new_rows : array
+        The new values of the row, with a leading axis of length 1 (not needed to remove)
+
+    Returns
+    -------
+    array
+        The updated array (which may be the same array, changed in place)
+    '''
+    if action == "add":
+        return np.concatenate([values, np.asarray(new_rows, dtype = values.dtype)])
+    elif action == "replace":
+        # memory mapped or otherwise read-only arrays are copied before changing them
+        if not values.flags.writeable:
+            values = np.array(values)
+        values[row] = new_rows[0]
+        return values
+    elif action == "remove":
+        return np.delete(values, row, axis = 0)
+    else:
+        raise ValueError("action must be one of: add, replace, remove")
+
+class FlagGallery:
+
+    def __init__(self, names, flags, directory = None):
+        '''
+        Initializes a FlagGallery object with a list of country names and a single
+        stacked array of their flags, where row i of the array is the flag of the
+        i-th country.
+
+        Parameters
+        ----------
+        names : list
+            The names of the countries, in the same order as the flags
+
+        flags : array
+            A (N, 90, 180, 3) uint8 numpy array of the flags of the countries (or a
+            PaletteImages of them)
+
+        directory : str
+            The directory that the gallery is stored in, or None if it is only in memory
+        '''
+        if len(names) != len(flags):
+            raise ValueError("there must be exactly one flag for every country name")
+
+        self.names = list(names)
+        self.flags = flags
+        self.directory = directory
+
+        # whether or not the directory holds exactly this gallery, which stops being
+        # true once a flag is added, replaced, or removed
+        self.saved = directory is not None
+
+        # mapping each country name to its row in the flag array
+        self.index = {name: i for i, name in enumerate(self.names)}
+
+        # the content hash of the gallery, computed the first time it is needed
+        self.__version = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, country):
+        return country in self.index
+
+    @property
+    def version(self):
+        '''
+        A hash of the names and flags in this gallery. Anything derived from the gallery
+        can be stored under this hash, so that it is never used with a different gallery.
+
+        Returns
+        -------
+        str
+            The hex digest of the gallery's contents
+        '''
+        if self.__version is None:
+            digest = hashlib.sha1(json.dumps(self.names).encode("utf-8"))
+            digest.update(np.ascontiguousarray(self.flags, dtype = np.uint8).data)
+            self.__version = digest.hexdigest()
+
+        return self.__version
+
+    def row(self, country):
+        '''
+        Returns the row of the flag array that stores the flag of the given country.
+
+        Parameters
+        ----------
+        country : str
+            The name of the country
+
+        Returns
+        -------
+        int
+            The row of the given country's flag
+        '''
+        try:
+            return self.index[country]
+        except KeyError:
+            raise KeyError(country) from None
+
+    def get(self, country):
+        '''
+        Returns the flag of the given country as a numpy array.
+
+        Parameters
+        ----------
+        country : str
+            The name of the country
+
+        Returns
+        -------
+        array
+            A (90, 180, 3) uint8 numpy array of the country's flag
+        '''
+        return np.asarray(self.flags[self.row(country)])
+
+    def is_palette(self):
+        '''
+        Returns whether or not the flags of this gallery are stored as palette indices.
+
+        Returns
+        -------
+        bool
+            True if the flags are a PaletteImages
+        '''
+        return isinstance(self.flags, PaletteImages)
+
+    def to_palette(self):
+        '''
+        Returns this gallery with every flag stored as a (90, 180) uint8 map of indices
+        into the 216 'web safe' colors instead of as RGB pixels, which takes a third of the
+        memory. The flags still read as RGB pixels, so nothing else has to change.
+
+        Returns
+        -------
+        FlagGallery
+            The same gallery with its flags stored as palette indices
+        '''
+        if self.is_palette():
+            return self
+
+        palette = Palette()
+        indices = np.concatenate([palette.encode(self.flags[start:start + 64])
+            for start in range(0, len(self.flags), 64)])
+
+        # only flags made entirely of 'web safe' colors can be stored without losing anything
+        for start in range(0, len(self.flags), 64):
+            if not np.array_equal(palette.decode(indices[start:start + 64]), self.flags[start:start + 64]):
+                raise ValueError("every flag must only use 'web safe' colors to be stored as a palette")
+
+        return FlagGallery(self.names, PaletteImages(indices, palette), self.directory)
+
+    def add(self, country, flag):
+        '''
+        Adds a country and its flag to the end of the gallery.
+
+        Parameters
+        ----------
+        country : str
+            The name of the country
+
+        flag : array
+            A (90, 180, 3) uint8 numpy array of the country's (processed) flag
+
+        Returns
+        -------
+        int
+            The row of the new flag
+        '''
+        if country in self.index:
+            raise ValueError(country + " is already in the gallery")
+
+        flag = self.__encode(flag)
+        self.__set_values(np.concatenate([np.asarray(self.__values()), flag[None]]))
+        self.names.append(country)
+        self.index[country] = len(self.names) - 1
+        self.__changed()
+
+        return len(self.names) - 1
+
+    def replace(self, country, flag):
+        '''
+        Replaces the flag of a country that is already in the gallery.
+
+        Parameters
+        ----------
+        country : str
+            The name of the country
+
+        flag : array
+            A (90, 180, 3) uint8 numpy array of the country's new (processed) flag
+
+        Returns
+        -------
+        int
+            The row of the replaced flag
+        '''
+        row = self.row(country)
+        flag = self.__encode(flag)
+
+        # copying the flags out of the memory mapped file before changing one
+        values = self.__values()
+        if not values.flags.writeable:
+            values = np.array(values)
+        values[row] = flag
+        self.__set_values(values)
+        self.__changed()
+
+        return row
+
+    def remove(self, country):
+        '''
+        Removes a country and its flag from the gallery. Every flag after it moves up a row.
+
+        Parameters
+        ----------
+        country : str
+            The name of the country
+
+        Returns
+        -------
+        int
+            The row that the removed flag was in
+        '''
+        row = self.row(country)
+        self.__set_values(np.delete(self.__values(), row, axis = 0))
+        del self.names[row]
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.__changed()
+
+        return row
+
+    def __values(self):
+        # the array the flags are actually stored in (palette indices or RGB pixels)
+        return self.flags.indices if self.is_palette() else self.flags
+
+    def __set_values(self, values):
+        if self.is_palette():
+            self.flags = PaletteImages(values, self.flags.palette)
+        else:
+            self.flags = values
+
+    def __encode(self, flag):
+        '''
+        Returns the given flag in the form that this gallery stores its flags in.
+
+        Parameters
+        ----------
+        flag : array
+            A (90, 180, 3) uint8 numpy array of a flag
+
+        Returns
+        -------
+        array
+            The flag as RGB pixels or palette indices
+        '''
+        flag = np.asarray(flag, dtype = np.uint8)
+        if flag.shape != tuple(self.flags.shape[1:]):
+            raise ValueError("flags must have the shape " + str(tuple(self.flags.shape[1:])))
+
+        if not self.is_palette():
+            return flag
+
+        indices = self.flags.palette.encode(flag)
+        if not np.array_equal(self.flags.palette.decode(indices), flag):
+            raise ValueError("every flag must only use 'web safe' colors to be stored as a palette")
+        return indices
+
+    def __changed(self):
+        # the version is computed again the next time it is needed
+        self.__version = None
+        self.saved = False
+
+    @classmethod
+    def load(cls, directory = GALLERY_DIR, mmap = True, palette = False):
+        '''
+        Loads the gallery stored in the given directory. By default the flags are memory
+        mapped, so nothing is copied until a flag is actually used.
+
+        Parameters
+        ----------
+        directory : str
+            The directory that the gallery was saved to
+
+        mmap : bool
+            Whether or not to memory map the flags instead of reading them into memory
+
+        palette : bool
+            Whether or not to store the flags as palette indices (see to_palette), even
+            if they were saved as RGB pixels
+
+        Returns
+        -------
+        FlagGallery
+            The gallery stored in the given directory
+        '''
+        for attempt in range(2):
+            with open(os.path.join(directory, INDEX_FILE)) as f:
+                index = json.load(f)
+
+            # a gallery is saved either as RGB pixels or as palette indices
+            name = index["palette"] if "palette" in index else index["flags"]
+            try:
+                flags = np.load(os.path.join(directory, name), mmap_mode = "r" if mmap else None, allow_pickle = False)
+                break
+            except FileNotFoundError:
+                # the gallery was saved (twice) since the index was read, so reading the
+                # new index once more finds flags that are still there
+                if attempt:
+                    raise
+
+        if "palette" in index:
+            flags = PaletteImages(flags)
+
+        gallery = cls(index["names"], flags, directory)
+        return gallery.to_palette() if palette else gallery
+
+    def save(self, directory = GALLERY_DIR):
+        '''
+        Saves this gallery to the given directory as a single .npy file of all the flags
+        (as RGB pixels, or as palette indices if that's how they are stored) and a small
+        json index of the country names.
+
+        The flags are saved under a new name for each version of the gallery, and the
+        index is swapped in with a single rename once they are complete, so an identifier
+        loading the gallery at the same time sees either the old gallery or the new one.
+        The flags of the gallery that was just replaced are kept for anyone who read the
+        old index but hasn't loaded its flags yet, and only older versions are removed (an
+        identifier that already memory mapped them can keep using them).
+
+        Parameters
+        ----------
+        directory : str
+            The directory to save the gallery to
+        '''
+        if self.is_palette():
+            key, values = "palette", self.flags.indices
+        else:
+            key, values = "flags", self.flags
+        name = key + "-" + self.version[:16] + ".npy"
+
+        index_path = os.path.join(directory, INDEX_FILE)
+        try:
+            with open(index_path) as f:
+                old_index = json.load(f)
+        except (OSError, ValueError):
+            old_index = {}
+
+        write_atomic(os.path.join(directory, name), lambda f: np.save(f, np.ascontiguousarray(values, dtype = np.uint8)))
+        previous = [old_index[old_key] for old_key in ("flags", "palette") if old_index.get(old_key, name) != name]
+        index = {"names": self.names, key: name, "previous": previous}
+        write_atomic(index_path, lambda f: f.write(json.dumps(index, indent = 1).encode("utf-8")))
+        self.directory = directory
+        self.saved = True
+
+        # removing the flags of the versions before the one that was replaced
+        for old_name in old_index.get("previous", []):
+            if old_name != name and old_name not in previous:
+                try:
+                    os.remove(os.path.join(directory, old_name))
+                except OSError:
+                    pass
+
+    @classmethod
+    def from_pickles(cls, csv_file):
+        '''
+        Builds a gallery out of a csv file of countries and the .pkl files that their
+        flags are stored in (the format that older versions of FlagScraper wrote). The
+        .pkl file names are relative to the directory of the csv file.
+
+        Parameters
+        ----------
+        csv_file : str
+            The name of the csv file that lists the countries and their .pkl files
+
+        Returns
+        -------
+        FlagGallery
+            A gallery of all the flags listed in the csv file
+        '''
+        directory = os.path.dirname(os.path.abspath(csv_file))
+        names = []
+        flags = []
+
+        with open(csv_file, newline = "") as f:
+            for line in csv.DictReader(f):
+                with open(os.path.join(directory, line["flag"]), "rb") as pkl:
+                    flags.append(pickle.load(pkl))
+                names.append(line["country"])
+
+        return cls(names, np.stack(flags).astype(np.uint8))
+
+def main(args = None):
+    '''
+    Converts the .pkl files listed in a csv file (see FlagGallery.from_pickles) into a
+    packed gallery. The module is part of the flagpy package, so this is run with
+    python -m flagpy.flag_gallery.
+
+    Parameters
+    ----------
+    args : list
+        The command line arguments (sys.argv is used if not given)
+    '''
+    import argparse
+    parser = argparse.ArgumentParser(prog = "python -m flagpy.flag_gallery",
+        description = "Converts a csv file of countries and their .pkl flags into a packed gallery.")
+    parser.add_argument("csv_file", help = "a csv file with a country and a flag (.pkl file) column")
+    parser.add_argument("--output", help = "the directory to save the gallery to (the csv file's directory by default)")
+    args = parser.parse_args(args)
+
+    directory = args.output or os.path.dirname(os.path.abspath(args.csv_file))
+    os.makedirs(directory, exist_ok = True)
+    FlagGallery.from_pickles(args.csv_file).save(directory)
+
+if __name__ == "__main__":
+    main()
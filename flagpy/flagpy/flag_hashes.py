@@ -0,0 +1,259 @@
+from PIL import Image
+from .flag_gallery import update_rows
+import numpy as np
+import os
+
+# the name of the imagehash function used by each hash method (imagehash
+# is only imported once an image actually has to be hashed)
+HASH_FUNCTIONS = {
+    "hash": "average_hash",
+    "dhash": "dhash",
+    "phash": "phash"
+}
+
+# the name of the file that the hashes of the gallery are stored in
+HASH_FILE = "flag_hashes.npz"
+
+# the number of bits set in each possible byte
+BYTE_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype = np.uint8)
+
+def popcount(words):
+    '''
+    Returns the number of bits that are set in each row of the given uint64 words.
+
+    Parameters
+    ----------
+    words : array
+        A (N, W) uint64 numpy array
+
+    Returns
+    -------
+    array
+        A numpy array of N ints, the number of bits set in each row
+    '''
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words).sum(axis = 1, dtype = np.int64)
+
+    # older versions of numpy have to count the bits a byte at a time
+    return BYTE_POPCOUNT[words.view(np.uint8)].sum(axis = 1, dtype = np.int64)
+
+class HashIndex:
+
+    def __init__(self, hashes, version = None):
+        '''
+        Initializes a HashIndex object with the precomputed hashes of every flag in a
+        gallery, stored as packed uint64 words so that a query can be compared against
+        all of them with an XOR and a popcount.
+
+        Parameters
+        ----------
+        hashes : dict
+            A dict of hash methods (as in HASH_FUNCTIONS) to (N, W) uint64 numpy arrays,
+            where row i holds the packed hash of the i-th flag
+
+        version : str
+            The version of the gallery that the hashes were computed from, if it is known
+        '''
+        self.hashes = hashes
+        self.version = version
+
+    @staticmethod
+    def hash_image(image, method = "hash"):
+        '''
+        Returns the packed hash of the given image using the given hash method.
+
+        Parameters
+        ----------
+        image : array
+            A (height, width, 3) uint8 numpy array of the image
+
+        method : str
+            The hash method (one of hash, dhash, or phash)
+
+        Returns
+        -------
+        array
+            A numpy array of uint64 words holding the bits of the hash
+        '''
+        import imagehash
+        hash_function = getattr(imagehash, HASH_FUNCTIONS[method])
+        bits = hash_function(Image.fromarray(np.asarray(image))).hash.flatten()
+
+        # padding the bits out to a whole number of 64 bit words
+        bits = np.concatenate([bits, np.zeros(-len(bits) % 64, dtype = bool)])
+        return np.packbits(bits).view(np.uint64)
+
+    @classmethod
+    def build(cls, flags, methods = tuple(HASH_FUNCTIONS)):
+        '''
+        Hashes every flag in the given stacked array of flags.
+
+        Parameters
+        ----------
+        flags : array
+            A (N, height, width, 3) uint8 numpy array of flags
+
+        methods : tuple
+            The hash methods to compute
+
+        Returns
+        -------
+        HashIndex
+            An index of the hashes of the given flags
+        '''
+        return cls({method: np.stack([cls.hash_image(flag, method) for flag in flags])
+            for method in methods})
+
+    @classmethod
+    def load(cls, gallery):
+        '''
+        Loads the hashes stored next to the given gallery. If they are missing or out
+        of date, they are computed from the gallery and saved for next time.
+
+        Parameters
+        ----------
+        gallery : FlagGallery
+            The gallery that the hashes belong to
+
+        Returns
+        -------
+        HashIndex
+            An index of the hashes of the flags in the gallery
+        '''
+        path = os.path.join(gallery.directory, HASH_FILE) if gallery.directory else None
+
+        if path and os.path.exists(path):
+            with np.load(path, allow_pickle = False) as stored:
+                hashes = {method: stored[method] for method in stored.files}
+
+            # the hashes are only used with the exact gallery they were computed from
+            version = str(hashes.pop("version")) if "version" in hashes else None
+            if set(hashes) == set(HASH_FUNCTIONS) and version == gallery.version:
+                return cls(hashes, version)
+
+        index = cls.build(gallery.flags)
+        index.version = gallery.version
+
+        # hashes of a gallery that was changed since it was saved don't belong in its directory
+        if path and gallery.saved:
+            try:
+                index.save(gallery.directory)
+            except OSError:
+                # the gallery might be installed somewhere read-only
+                pass
+
+        return index
+
+    def update(self, flags, row, action, version = None):
+        '''
+        Updates the hashes after one flag of the gallery was added, replaced, or removed,
+        only hashing the flag that changed.
+
+        Parameters
+        ----------
+        flags : array
+            The gallery's flags after the change
+
+        row : int
+            The row that changed
+
+        action : str
+            One of "add", "replace", or "remove"
+
+        version : str
+            The version of the gallery after the change
+        '''
+        for method in self.hashes:
+            new_rows = self.hash_image(flags[row], method)[None] if action != "remove" else None
+            self.hashes[method] = update_rows(self.hashes[method], row, action, new_rows)
+
+        self.version = version
+
+    def save(self, directory):
+        '''
+        Saves the hashes to the given directory.
+
+        Parameters
+        ----------
+        directory : str
+            The directory to save the hashes to
+        '''
+        arrays = dict(self.hashes)
+        if self.version is not None:
+            arrays["version"] = np.array(self.version)
+
+        # writing to a temporary file first so that a reader never sees half of the hashes
+        path = os.path.join(directory, HASH_FILE)
+        tmp_path = path + ".tmp." + str(os.getpid())
+        try:
+            with open(tmp_path, "wb") as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def distances(self, words, method = "hash"):
+        '''
+        Returns the hash distance (the number of differing bits) between the given
+        packed hash and the hash of every flag.
+
+        Parameters
+        ----------
+        words : array
+            A packed hash, as returned by hash_image
+
+        method : str
+            The hash method that the given hash was computed with
+
+        Returns
+        -------
+        array
+            A numpy array of the hash distance to each flag
+        '''
+        return popcount(np.bitwise_xor(self.hashes[method], words))
+
+    def distances_many(self, words, method = "hash"):
+        '''
+        Returns the hash distance between each of the given packed hashes and the hash
+        of every flag.
+
+        Parameters
+        ----------
+        words : array
+            A (Q, W) numpy array of packed hashes, as returned by hash_image
+
+        method : str
+            The hash method that the given hashes were computed with
+
+        Returns
+        -------
+        array
+            A (Q, N) numpy array of the hash distance between each hash and each flag
+        '''
+        xor = np.bitwise_xor(self.hashes[method][None], np.asarray(words)[:, None])
+        return popcount(xor.reshape(-1, xor.shape[2])).reshape(xor.shape[:2])
+
+    def distance(self, i, j, method = "hash"):
+        '''
+        Returns the hash distance between the i-th and j-th flags.
+
+        Parameters
+        ----------
+        i : int
+            The row of the first flag
+
+        j : int
+            The row of the second flag
+
+        method : str
+            The hash method to compare the flags with
+
+        Returns
+        -------
+        int
+            The hash distance between the two flags
+        '''
+        hashes = self.hashes[method]
+        return int(popcount(np.bitwise_xor(hashes[i:i + 1], hashes[j]))[0])
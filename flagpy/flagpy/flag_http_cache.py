@@ -0,0 +1,323 @@
+import threading
+import hashlib
+import json
+import os
+
+class HTTPCache:
+
+    def __init__(self, directory, max_bytes = 256 << 20, offline = False):
+        '''
+        Initializes an HTTPCache object that keeps downloaded files on disk. A cached
+        file is revalidated with the server (using its ETag and Last-Modified headers)
+        every time it is fetched, so an unchanged file costs a request but not its body.
+        Once the cache holds more than max_bytes, the least recently used files are
+        removed. In offline mode, files are only ever served from the cache.
+
+        Parameters
+        ----------
+        directory : str
+            The directory that the cached files are stored in
+
+        max_bytes : int
+            The most bytes of files kept in the cache
+
+        offline : bool
+            Whether or not to only serve files from the cache, without any network access
+        '''
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.lock = threading.Lock()
+        self.counts = {"hits": 0, "revalidated": 0, "downloaded": 0, "bytes_downloaded": 0}
+
+        # the bytes of files in the cache, which is only counted (by listing the directory)
+        # when the first file is stored and whenever it seems to have grown too big
+        self.cached_bytes = None
+
+    def __paths(self, url):
+        '''
+        Returns the paths of the body and the headers of the cached copy of the given url.
+
+        Parameters
+        ----------
+        url : str
+            The url of the file
+
+        Returns
+        -------
+        tuple
+            The paths of the body and headers files
+        '''
+        name = os.path.join(self.directory, hashlib.sha1(url.encode("utf-8")).hexdigest())
+        return name + ".body", name + ".json"
+
+    def __load(self, url):
+        '''
+        Returns the cached body and headers of the given url, or (None, None) if it is
+        not cached.
+
+        Parameters
+        ----------
+        url : str
+            The url of the file
+
+        Returns
+        -------
+        tuple
+            The body (bytes) and the headers (dict) of the cached file
+        '''
+        body_path, headers_path = self.__paths(url)
+        try:
+            with open(headers_path) as f:
+                headers = json.load(f)
+            with open(body_path, "rb") as f:
+                body = f.read()
+        except (OSError, ValueError):
+            return None, None
+
+        # a cached file for a different url (which would need a sha1 collision) is ignored
+        if headers.get("url") != url or headers.get("size") != len(body):
+            return None, None
+
+        return body, headers
+
+    def __store(self, url, body, response_headers):
+        '''
+        Saves the given body and its validators, and then evicts old files if the cache
+        seems to be too big. Each file is written to a temporary file first, so a reader never
+        sees half of one.
+
+        Parameters
+        ----------
+        url : str
+            The url of the file
+
+        body : bytes
+            The body of the response
+
+        response_headers : dict
+            The headers of the response
+        '''
+        body_path, headers_path = self.__paths(url)
+        headers = {
+            "url": url,
+            "size": len(body),
+            "etag": response_headers.get("ETag"),
+            "last_modified": response_headers.get("Last-Modified")
+        }
+
+        suffix = ".tmp." + str(os.getpid()) + "." + str(threading.get_ident())
+        try:
+            with open(body_path + suffix, "wb") as f:
+                f.write(body)
+            with open(headers_path + suffix, "w") as f:
+                json.dump(headers, f)
+            os.replace(body_path + suffix, body_path)
+            os.replace(headers_path + suffix, headers_path)
+        except OSError:
+            # not being able to cache a file only costs a download next time
+            for path in (body_path + suffix, headers_path + suffix):
+                if os.path.exists(path):
+                    os.remove(path)
+            return
+
+        # a file that replaced an older copy is counted twice until the next listing,
+        # which only makes that listing happen a little sooner
+        with self.lock:
+            if self.cached_bytes is not None:
+                self.cached_bytes += len(body)
+            too_big = self.cached_bytes is None or self.cached_bytes > self.max_bytes
+
+        if too_big:
+            self.evict()
+
+    def __touch(self, url):
+        '''
+        Marks the cached copy of the given url as just used.
+
+        Parameters
+        ----------
+        url : str
+            The url of the file
+        '''
+        try:
+            os.utime(self.__paths(url)[0])
+        except OSError:
+            pass
+
+    def evict(self):
+        '''
+        Removes the least recently used files until the cache holds at most max_bytes,
+        and counts the bytes that are left. Files stored by other processes sharing the
+        directory are counted (and removed) too.
+        '''
+        with self.lock:
+            try:
+                names = os.listdir(self.directory)
+            except OSError:
+                return
+
+            entries = []
+            for name in names:
+                if name.endswith(".body"):
+                    try:
+                        stat = os.stat(os.path.join(self.directory, name))
+                    except OSError:
+                        # removed by another process since the directory was listed
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, name[:-len(".body")]))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, name in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                for extension in (".body", ".json"):
+                    try:
+                        os.remove(os.path.join(self.directory, name + extension))
+                    except OSError:
+                        pass
+                total -= size
+
+            self.cached_bytes = total
+
+    def fetch(self, session, url):
+        '''
+        Returns the body of the given url, from the cache if the server says the cached
+        copy is still current, and downloaded with the given session otherwise. Responses
+        other than 200 are returned but never cached.
+
+        Parameters
+        ----------
+        session : Session
+            The requests session to download with
+
+        url : str
+            The url to fetch
+
+        Returns
+        -------
+        bytes
+            The body of the response
+        '''
+        body, request_headers = self.__prepare(url)
+        if request_headers is None:
+            return body
+
+        response = session.get(url, headers = request_headers)
+        return self.__finish(url, body, response.status_code, response.content, response.headers)
+
+    async def afetch(self, session, url):
+        '''
+        Does the same as fetch, but downloads with an aiohttp session without blocking
+        the event loop.
+
+        Parameters
+        ----------
+        session : ClientSession
+            The aiohttp session to download with
+
+        url : str
+            The url to fetch
+
+        Returns
+        -------
+        bytes
+            The body of the response
+        '''
+        body, request_headers = self.__prepare(url)
+        if request_headers is None:
+            return body
+
+        async with session.get(url, headers = request_headers) as response:
+            content = await response.read()
+            return self.__finish(url, body, response.status, content, response.headers)
+
+    def __prepare(self, url):
+        '''
+        Looks up the cached copy of the given url before it is fetched.
+
+        Parameters
+        ----------
+        url : str
+            The url to fetch
+
+        Returns
+        -------
+        tuple
+            The cached body (or None), and the headers to request the url with, or None
+            if the cached body should be used without asking the server (offline mode)
+        '''
+        body, headers = self.__load(url)
+
+        if self.offline:
+            if body is None:
+                raise IOError("offline, and " + url + " is not in the cache")
+            self.__touch(url)
+            self.__count("hits")
+            return body, None
+
+        # asking the server to only send the body if it has changed
+        request_headers = {}
+        if body is not None:
+            if headers.get("etag"):
+                request_headers["If-None-Match"] = headers["etag"]
+            if headers.get("last_modified"):
+                request_headers["If-Modified-Since"] = headers["last_modified"]
+
+        return body, request_headers
+
+    def __finish(self, url, body, status, content, response_headers):
+        '''
+        Handles the server's response to a fetch of the given url.
+
+        Parameters
+        ----------
+        url : str
+            The url that was fetched
+
+        body : bytes
+            The cached body of the url, or None
+
+        status : int
+            The HTTP status code of the response
+
+        content : bytes
+            The body of the response
+
+        response_headers : dict
+            The headers of the response
+
+        Returns
+        -------
+        bytes
+            The cached body if the server said it is current, and the response's otherwise
+        '''
+        if status == 304 and body is not None:
+            self.__touch(url)
+            self.__count("revalidated")
+            return body
+
+        self.__count("downloaded")
+        self.__count("bytes_downloaded", len(content))
+        if status == 200:
+            self.__store(url, content, response_headers)
+
+        return content
+
+    def __count(self, name, amount = 1):
+        with self.lock:
+            self.counts[name] += amount
+
+    def stats(self):
+        '''
+        Returns how many fetches were served from the cache while offline (hits), were
+        confirmed current by the server (revalidated), or had to be downloaded, along
+        with the number of bytes downloaded.
+
+        Returns
+        -------
+        dict
+            The hits, revalidated, downloaded, and bytes_downloaded counts
+        '''
+        with self.lock:
+            return dict(self.counts)
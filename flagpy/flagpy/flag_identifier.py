@@ -1,48 +1,235 @@
-import pandas as pd
 from PIL import Image
 import numpy as np
-from skimage import metrics
-import imagehash
 from .flag_util import FlagUtil
-import operator
+from .flag_gallery import FlagGallery, GALLERY_DIR
+from .flag_metrics import MSEScorer, MSEPyramid, SSIMScorer
+from .flag_palette import PaletteScorer
+from .flag_hashes import HashIndex, HASH_FUNCTIONS
+from .flag_distances import DistanceMatrix
+from .flag_workers import WorkerPool
+from .flag_cache import LRUCache, content_key
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+import asyncio
+import random
 import os
 
 class FlagIdentifier:
 
-    def __init__(self):
+    def __init__(self, cascade_k = 20, cascade_prefilter = "hash", cascade_metric = "ssim", cascade_audit_rate = 0.0,
+        use_pyramid = True, workers = 0, representation = "rgb", result_cache_size = 1024, disk_cache = False,
+        directory = GALLERY_DIR):
         '''
-        Initializes a FlagIdentifier object that has a FlagUtil object and DataFrame of 
+        Initializes a FlagIdentifier object that has a FlagUtil object and a gallery of 
         countries and their flags.
+
+        Parameters
+        ----------
+        cascade_k : int
+            The number of flags that the cascade method's prefilter passes on to its metric
+
+        cascade_prefilter : str
+            The cheap method (one of mse, hash, dhash, or phash) that the cascade method
+            uses to shortlist flags
+
+        cascade_metric : str
+            The method (one of mse, ssim, hash, dhash, or phash) that the cascade method
+            uses to pick the best flag out of the shortlist
+
+        cascade_audit_rate : float
+            The fraction of cascade identifications (from 0 to 1) that are also checked
+            against the metric on every flag, to count how often the best flag was
+            left out of the shortlist
+
+        use_pyramid : bool
+            Whether or not mse identification searches lower resolution copies of the
+            flags first, so that most flags are never compared at full resolution (the
+            answer is always the same either way)
+
+        workers : int
+            The number of processes that mse and ssim scoring is spread across for
+            batches, all-pairs distances, and single ssim identifications (0 or 1
+            scores everything in this process)
+
+        representation : str
+            How the gallery's flags are kept in memory, either "rgb" (3 bytes a pixel) or
+            "palette" (a 1 byte index into the 216 'web safe' colors a pixel, with mse
+            looked up from a table of the distances between them). Both give the same results.
+
+        result_cache_size : int
+            The most identification results kept in memory, by the contents of the image,
+            the method, and the gallery (0 keeps none)
+
+        disk_cache : bool
+            Whether or not identification results are also saved to the cache directory
+            (up to 64 MB of them), so that they are kept between runs
+
+        directory : str
+            The directory that the gallery is loaded from (flagpy's bundled gallery by
+            default), ie. one that a changed gallery was saved to with save_gallery
         '''
         self.util = FlagUtil()
+
+        # the settings of the cascade method, which can be changed at any time
+        self.cascade_k = cascade_k
+        self.cascade_prefilter = cascade_prefilter
+        self.cascade_metric = cascade_metric
+        self.cascade_audit_rate = cascade_audit_rate
+
+        # how often the cascade method has been used, and how often an audit found
+        # that the best flag was not on the shortlist
+        self.cascade_stats = {"calls": 0, "audited": 0, "misses": 0}
+        self.cascade_lock = threading.Lock()
         
-        # reading in a df of file names which store numpy arrays
-        self.flag_df = pd.read_csv(os.path.join(os.path.dirname(__file__), "flag_df.csv"), index_col = "country")
+        if representation != "rgb" and representation != "palette":
+            raise ValueError("representation must be one of: rgb, palette")
+
+        # memory mapping the packed gallery of flags
+        self.gallery = FlagGallery.load(directory, palette = representation == "palette")
+
+        # scores images against the whole gallery at once
+        if self.gallery.is_palette():
+            self.mse_scorer = PaletteScorer(self.gallery.flags.indices, self.gallery.flags.palette)
+        else:
+            self.mse_scorer = MSEScorer(self.gallery.flags)
+        self.ssim_scorer = SSIMScorer(self.gallery.flags)
+
+        # finds the lowest mse flag by ruling out flags at lower resolutions first
+        self.use_pyramid = use_pyramid
+        self.mse_pyramid = MSEPyramid(self.mse_scorer, self.gallery.flags)
+
+        # the precomputed hashes of every flag in the gallery, loaded the first
+        # time a hash method is used
+        self.hashes = None
+
+        # the results of earlier identifications, by the contents of their images
+        try:
+            cache_dir = self.util.get_cache_dir("results") if disk_cache else None
+        except OSError:
+            cache_dir = None
+        self.result_cache = LRUCache(result_cache_size, cache_dir)
 
-        # converting the files to numpy arrays
-        self.flag_df["flag"] = self.flag_df["flag"].apply(self.util.makeArray)
+        # the worker processes, which are started the first time they are needed
+        self.workers = workers
+        self.pool = None
+
+        # the distances between every pair of flags, one matrix per method, which
+        # are loaded or created the first time each method is used
+        self.distances = {}
+        self.distances_lock = threading.Lock()
+
+        # stage timers and counters (see Instrumentation), shared with this identifier's
+        # FlagUtil so that downloading and processing images are recorded alongside scoring
+        self.stats = self.util.stats
 
     def get_flag_df(self):
         '''
-        Returns a copy of this FlagIdentifier's flag DataFrame.
+        Returns a DataFrame of this FlagIdentifier's countries and their flags.
 
         Returns
         -------
         DataFrame
-            A copy of this FlagIdentifier's flag DataFrame
+            A DataFrame of this FlagIdentifier's countries and their flags
+        '''
+        import pandas as pd
+        flag_df = pd.DataFrame({"flag": list(self.gallery.flags)}, index = pd.Index(self.gallery.names, name = "country"))
+        return flag_df
+
+    def get_hashes(self):
+        '''
+        Returns the precomputed hashes of every flag in the gallery, loading them the
+        first time they are needed.
+
+        Returns
+        -------
+        HashIndex
+            The hashes of every flag in the gallery
+        '''
+        if self.hashes is None:
+            self.hashes = HashIndex.load(self.gallery)
+
+        return self.hashes
+
+    def get_pool(self):
+        '''
+        Returns the pool of worker processes, creating it the first time it is needed,
+        or None if everything is scored in this process.
+
+        Returns
+        -------
+        WorkerPool
+            The pool of worker processes, or None
+        '''
+        if self.pool is None and self.workers and self.workers > 1:
+            try:
+                cache_dir = self.util.get_cache_dir("ssim")
+            except OSError:
+                cache_dir = None
+            self.pool = WorkerPool(self.gallery, self.workers, cache_dir)
+
+        return self.pool
+
+    def set_workers(self, workers):
+        '''
+        Changes the number of processes that scoring is spread across, shutting down the
+        current worker processes (if there are any).
+
+        Parameters
+        ----------
+        workers : int
+            The number of worker processes (0 or 1 scores everything in this process)
+        '''
+        self.close()
+        self.workers = workers
+
+    def close(self):
+        '''
+        Shuts down the worker processes, if any were started.
+        '''
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+    def warmup(self, methods = ("mse", "ssim", "hash", "dhash", "phash")):
+        '''
+        Loads everything that the given methods need ahead of time (reading the gallery
+        into memory, loading the hashes, and importing the libraries each method uses)
+        so that the first call using them isn't any slower than the rest.
+
+        Parameters
+        ----------
+        methods : tuple
+            The methods (any of mse, ssim, hash, dhash, or phash) to get ready
         '''
-        return self.flag_df.copy()
+        for method in methods:
+            self.__check_method(method)
+
+        # reading every page of the memory mapped gallery
+        if self.gallery.is_palette():
+            np.asarray(self.gallery.flags.indices).sum(dtype = np.uint64)
+        else:
+            np.asarray(self.gallery.flags).sum(dtype = np.uint64)
+
+        if any(method in HASH_FUNCTIONS for method in methods):
+            self.get_hashes()
+            HashIndex.hash_image(self.gallery.flags[0])
+        if "ssim" in methods:
+            self.ssim_scorer.get_stats()
+        if "mse" in methods and self.use_pyramid:
+            self.mse_pyramid.get_pyramid()
+
+        self.util.get_session()
 
     def get_country_list(self):
         '''
-        Returns a list of all 195 current countries stored in this FlagIdentifier's DataFrame
+        Returns a list of all 195 current countries stored in this FlagIdentifier's gallery
 
         Return
         ------
         list
-            A list of all the countries in this FlagIdentifier's DataFrame
+            A list of all the countries in this FlagIdentifier's gallery
         '''
-        return list(self.get_flag_df().index.values)
+        return list(self.gallery.names)
 
     def display(self, country):
         '''
@@ -69,11 +256,11 @@ class FlagIdentifier:
         Image
             An Image object of the flag of the given country
         '''
-        return Image.fromarray(self.flag_df["flag"].loc[country.title()])
+        return Image.fromarray(self.gallery.get(country.title()))
 
     def flag_dist(self, countryA, countryB, method = "mse"):
         '''
-        Uses the given method (one of mse, ssim, or hash) to find the distance
+        Uses the given method (one of mse, ssim, hash, dhash, or phash) to find the distance
         between the two flags of the two given countries.
 
         Parameters
@@ -85,8 +272,8 @@ class FlagIdentifier:
             The name of the second country
 
         method : str
-            The method (one of mse, ssim, or hash) used to find distance between the
-            flags of the two given countries. For both mse and hash, smaller values mean higher 
+            The method (one of mse, ssim, hash, dhash, or phash) used to find distance between the
+            flags of the two given countries. For mse and the hashes, smaller values mean higher 
             similarity and a value of 0 means the two flags are identical. For ssim, higher values mean 
             higher similarity and the value must be between -1 and 1. A value of 1 for ssim
             means the two flags are identical.
@@ -96,44 +283,474 @@ class FlagIdentifier:
         float
             The distance between the two flags of the two given countries
         '''
-        flagA = self.flag_df["flag"].loc[countryA.title()]
-        flagB = self.flag_df["flag"].loc[countryB.title()]
+        self.__check_method(method)
+        i = self.gallery.row(countryA.title())
+        j = self.gallery.row(countryB.title())
+
+        # only computing the distance if it is not already known
+        distances = self.__get_distances(method)
+        dist = distances.get(i, j)
+        if np.isnan(dist):
+            flagA = self.gallery.flags[i]
+            flagB = self.gallery.flags[j]
+            if method == "mse":
+                dist = self.__mse(flagA, flagB)
+            elif method == "ssim":
+                dist = self.__ssim(flagA, flagB)
+            else:
+                dist = self.get_hashes().distance(i, j, method)
+            distances.set(i, j, dist)
+
+        return int(dist) if method in HASH_FUNCTIONS else dist
+
+    def flag_dist_matrix(self, countriesA, countriesB, method = "mse"):
+        '''
+        Uses the given method (one of mse, ssim, hash, dhash, or phash) to find the distance
+        between every flag of the first list of countries and every flag of the second list.
+
+        Parameters
+        ----------
+        countriesA : list
+            The names of the first countries
+
+        countriesB : list
+            The names of the second countries
+
+        method : str
+            The method (one of mse, ssim, hash, dhash, or phash) used to find distance between
+            the flags, as in flag_dist
+
+        Returns
+        -------
+        array
+            A (len(countriesA), len(countriesB)) numpy array where the value at [i, j] is
+            the distance between the flags of countriesA[i] and countriesB[j]
+        '''
+        self.__check_method(method)
+        rowsA = [self.gallery.row(c.title()) for c in countriesA]
+        rowsB = [self.gallery.row(c.title()) for c in countriesB]
+
+        dists = self.__get_distances(method).rows(rowsA, lambda rows: self.__reference_rows(rows, method))
+        dists = dists[:, rowsB]
+        return dists.astype(int) if method in HASH_FUNCTIONS else dists
+
+    def __check_method(self, method, cascade = False):
+        '''
+        Raises a ValueError if the given method is not supported.
+
+        Parameters
+        ----------
+        method : str
+            The method being checked
+
+        cascade : bool
+            Whether or not the cascade method is allowed (it can only identify images,
+            not compare two flags)
+        '''
+        if cascade and method == "cascade":
+            return
+
+        if method != "mse" and method != "ssim" and method not in HASH_FUNCTIONS:
+            if cascade:
+                raise ValueError("method must be one of: mse, ssim, hash, dhash, phash, cascade")
+            raise ValueError("method must be one of: mse, ssim, hash, dhash, phash")
+
+    def __higher_is_better(self, method):
+        '''
+        Returns whether higher scores mean more similar flags for the given method.
+        This is only true for ssim (and the cascade method when its metric is ssim).
+
+        Parameters
+        ----------
+        method : str
+            The method the scores were computed with
+
+        Returns
+        -------
+        bool
+            True if higher scores are better
+        '''
+        if method == "cascade":
+            method = self.cascade_metric
+
+        return method == "ssim"
+
+    def get_cascade_stats(self):
+        '''
+        Returns how many times the cascade method has been used, how many of those
+        were audited against the metric on every flag, and how many of the audited
+        ones had a best flag that the prefilter left off the shortlist.
+
+        Returns
+        -------
+        dict
+            The calls, audited, and misses counts, and the miss_rate (misses out of
+            audited, or None if nothing has been audited)
+        '''
+        with self.cascade_lock:
+            stats = dict(self.cascade_stats)
+
+        stats["miss_rate"] = stats["misses"] / stats["audited"] if stats["audited"] else None
+        return stats
+
+    def set_cascade_audit_rate(self, rate):
+        '''
+        Changes the fraction of cascade identifications that are also checked against
+        the metric on every flag (see get_cascade_stats).
+
+        Parameters
+        ----------
+        rate : float
+            The fraction of cascade identifications to audit, from 0 (none) to 1 (all)
+        '''
+        if not 0 <= rate <= 1:
+            raise ValueError("the cascade audit rate must be between 0 and 1")
+        self.cascade_audit_rate = rate
+
+    def reset_cascade_stats(self):
+        '''
+        Resets the counts returned by get_cascade_stats.
+        '''
+        with self.cascade_lock:
+            self.cascade_stats = {"calls": 0, "audited": 0, "misses": 0}
+
+    def __get_distances(self, method):
+        '''
+        Returns the matrix of distances between every pair of flags for the given method,
+        loading it from the cache the first time (or creating it if it is not cached). The
+        cached matrix is stored under the gallery's version, so a changed gallery never
+        uses old distances.
+
+        Parameters
+        ----------
+        method : str
+            The method the distances are measured with
+
+        Returns
+        -------
+        DistanceMatrix
+            The distances between every pair of flags
+        '''
+        with self.distances_lock:
+            if method not in self.distances:
+                self.distances[method] = DistanceMatrix(len(self.gallery), self.__distances_path(method))
+
+            return self.distances[method]
+
+    def __distances_path(self, method):
+        '''
+        Returns the path that the distances for the given method are cached in for the
+        current version of the gallery, or None if there is no cache directory.
+
+        Parameters
+        ----------
+        method : str
+            The method the distances are measured with
+
+        Returns
+        -------
+        str
+            The path of the cached matrix
+        '''
+        try:
+            return os.path.join(self.util.get_cache_dir("distances"), method + "-" + self.gallery.version + ".npy")
+        except OSError:
+            return None
+
+    def add_flag(self, country, image):
+        '''
+        Adds a country and its flag to the gallery. Everything derived from the gallery
+        (hashes, ssim statistics, lower resolution copies, and distances) is updated by
+        only computing what involves the new flag. The change stays in memory until
+        save_gallery is called.
+
+        Parameters
+        ----------
+        country : str
+            The name of the country
+
+        image : object
+            An image of the flag, from any source accepted by identify
+        '''
+        self.__change_gallery("add", country.title(), self.util.process_img(image, cache = False))
+
+    def replace_flag(self, country, image):
+        '''
+        Replaces the flag of a country in the gallery, updating only what involves that
+        flag. The change stays in memory until save_gallery is called.
+
+        Parameters
+        ----------
+        country : str
+            The name of the country
+
+        image : object
+            An image of the new flag, from any source accepted by identify
+        '''
+        self.__change_gallery("replace", country.title(), self.util.process_img(image, cache = False))
+
+    def remove_flag(self, country):
+        '''
+        Removes a country and its flag from the gallery, dropping its row (and column) from
+        everything derived from the gallery. The change stays in memory until save_gallery
+        is called.
+
+        Parameters
+        ----------
+        country : str
+            The name of the country
+        '''
+        self.__change_gallery("remove", country.title())
+
+    def __change_gallery(self, action, country, flag = None):
+        '''
+        Adds, replaces, or removes one flag of the gallery and updates everything derived
+        from it. This shouldn't be called while other threads are using this identifier.
+
+        Parameters
+        ----------
+        action : str
+            One of "add", "replace", or "remove"
+
+        country : str
+            The name of the country
+
+        flag : array
+            The processed flag to add or replace, or None to remove
+        '''
+        # the stored hashes are loaded first (while they still match the gallery on disk)
+        # so that only the changed flag is hashed
+        hashes = self.get_hashes()
+
+        # the workers have the old gallery, so new ones are started when they are next needed
+        self.close()
+
+        if action == "add":
+            row = self.gallery.add(country, flag)
+        elif action == "replace":
+            row = self.gallery.replace(country, flag)
+        else:
+            row = self.gallery.remove(country)
+
+        flags = self.gallery.flags
+        self.mse_scorer.update(flags, row, action)
+        self.ssim_scorer.update(flags, row, action)
+        self.mse_pyramid.update(flags, row, action)
+        hashes.update(flags, row, action, self.gallery.version)
+
+        # the matrices that are already loaded get the distances to the new flag right
+        # away, and are cached under the gallery's new version
+        with self.distances_lock:
+            loaded = list(self.distances.items())
+        for method, distances in loaded:
+            distances.update(row, action)
+            distances.path = self.__distances_path(method)
+            if action == "remove":
+                distances.save()
+            else:
+                distances.row(row, lambda rows: self.__reference_rows(rows, method))
+
+    def save_gallery(self, directory = None):
+        '''
+        Saves the gallery (with any flags that were added, replaced, or removed) and its
+        hashes, so that a FlagIdentifier created with the same directory loads it.
+
+        Parameters
+        ----------
+        directory : str
+            The directory to save the gallery to (the one it was loaded from if not given)
+        '''
+        directory = directory or self.gallery.directory
+        self.gallery.save(directory)
+        if self.hashes is not None:
+            self.hashes.save(directory)
+
+    def __scores(self, flag, method):
+        '''
+        Returns the distance between the given flag and every flag in the gallery using
+        the given method.
+
+        Parameters
+        ----------
+        flag : array
+            A numpy array representing the flag
+
+        method : str
+            The method (one of mse, ssim, hash, dhash, or phash) used to find the distances
+
+        Returns
+        -------
+        array
+            A numpy array of the distance to each flag, in the order of the gallery
+        '''
         if method == "mse":
-            return self.__mse(flagA, flagB)
+            return self.mse_scorer.score(flag)
         elif method == "ssim":
-            return self.__ssim(flagA, flagB)
-        elif method == "hash":
-            return self.__hash(flagA, flagB)
+            # a single ssim identification is worth splitting between the workers
+            if self.get_pool() is not None:
+                return self.pool.score_images(method, np.asarray(flag)[None], self.ssim_scorer)[0]
+            return self.ssim_scorer.score(flag)
+        elif method in HASH_FUNCTIONS:
+            return self.get_hashes().distances(HashIndex.hash_image(flag, method), method)
+        elif method == "cascade":
+            return self.__cascade_scores(flag)
         else:
-            raise ValueError("method must be one of: mse, ssim, hash")
+            raise ValueError("method must one of: mse, hash, dhash, phash, ssim, cascade")
 
-    def __mse(self, imageA, imageB):
+    def __subset_scores(self, flag, method, rows):
         '''
-        Returns the mean-squared error between the two given images. Lower values mean
-        a higher similarity between the two images (0 is perfect similarity).
+        Returns the distance between the given flag and only the given rows of the
+        gallery using the given method.
 
         Parameters
         ----------
-        imageA : array
-            A numpy array representing the first image
+        flag : array
+            A numpy array representing the flag
 
-        imageB : array
-            A numpy array representing the second image
+        method : str
+            The method (one of mse, ssim, hash, dhash, or phash) used to find the distances
+
+        rows : array
+            The rows of the gallery to compare the flag to
 
         Returns
         -------
-        float
-            The mean-squared error between the two given images
+        array
+            A numpy array of the distance to the flag in each of the given rows
         '''
-        # credit to: https://www.pyimagesearch.com/2014/09/15/python-compare-two-images/
-        err = np.sum((imageA.astype("float") - imageB.astype("float")) ** 2)
-        err /= float(imageA.shape[0] * imageA.shape[1])
+        if method == "mse":
+            return self.mse_scorer.score(flag, rows)
+        elif method == "ssim":
+            return self.ssim_scorer.score(flag, rows)
+        else:
+            return self.__scores(flag, method)[rows]
 
-        return err
+    def __cascade_scores(self, flag):
+        '''
+        Scores the given flag with the cascade method. The cheap prefilter method scores
+        every flag in the gallery, and only the cascade_k best of those are scored with
+        the (more expensive) metric. Flags that didn't make the shortlist get the worst
+        possible score. Some calls (cascade_audit_rate of them) are also scored with the
+        metric on every flag to check whether the shortlist held the real best flag.
+
+        Parameters
+        ----------
+        flag : array
+            A numpy array representing the flag
+
+        Returns
+        -------
+        array
+            A numpy array of the score of each flag, in the order of the gallery
+        '''
+        prefilter, metric = self.cascade_prefilter, self.cascade_metric
+        if prefilter == "ssim" or prefilter == "cascade" or metric == "cascade":
+            raise ValueError("the cascade prefilter must be one of: mse, hash, dhash, phash, "
+                "and its metric can't be cascade")
+        self.__check_method(prefilter)
+        self.__check_method(metric)
+
+        shortlist = self.__topk(self.__scores(flag, prefilter), self.cascade_k, prefilter)
+        higher = self.__higher_is_better(metric)
+
+        scores = np.full(len(self.gallery), -np.inf if higher else np.inf)
+        scores[shortlist] = self.__subset_scores(flag, metric, shortlist)
+
+        audited = missed = False
+        if self.cascade_audit_rate > 0 and random.random() < self.cascade_audit_rate:
+            full = self.__scores(flag, metric)
+            best = np.argmax(full) if higher else np.argmin(full)
+            audited = True
+            missed = best not in shortlist
+
+        with self.cascade_lock:
+            self.cascade_stats["calls"] += 1
+            self.cascade_stats["audited"] += audited
+            self.cascade_stats["misses"] += missed
+
+        return scores
 
-    def __hash(self, imageA, imageB):
+    def __reference_scores(self, i, method):
         '''
-        Returns the hash distance between the two given images. Lower values mean
+        Returns the distance between the i-th flag of the gallery and every flag in the
+        gallery using the given method. The hash methods use the precomputed hash of the
+        flag instead of hashing it again.
+
+        Parameters
+        ----------
+        i : int
+            The row of the flag in the gallery
+
+        method : str
+            The method (one of mse, ssim, hash, dhash, or phash) used to find the distances
+
+        Returns
+        -------
+        array
+            A numpy array of the distance to each flag, in the order of the gallery
+        '''
+        if method in HASH_FUNCTIONS:
+            hashes = self.get_hashes()
+            return hashes.distances(hashes.hashes[method][i], method)
+
+        return self.__scores(self.gallery.flags[i], method)
+
+    def __reference_rows(self, rows, method):
+        '''
+        Returns the distance between each of the given flags of the gallery and every flag
+        in the gallery using the given method, splitting the work between the worker
+        processes if there are any.
+
+        Parameters
+        ----------
+        rows : list
+            The rows of the flags in the gallery
+
+        method : str
+            The method (one of mse, ssim, hash, dhash, or phash) used to find the distances
+
+        Returns
+        -------
+        array
+            A (len(rows), N) numpy array where row q is the distance from the flag in
+            rows[q] to each flag in the gallery
+        '''
+        if (method == "mse" or method == "ssim") and len(rows) > 1 and self.get_pool() is not None:
+            return self.pool.score_rows(method, rows, self.ssim_scorer)
+
+        return np.stack([self.__reference_scores(i, method) for i in rows])
+
+    def __scores_many(self, flags, method):
+        '''
+        Returns the distance between each of the given flags and every flag in the gallery
+        using the given method, scoring the whole batch at once.
+
+        Parameters
+        ----------
+        flags : array
+            A (Q, 90, 180, 3) numpy array of the flags
+
+        method : str
+            The method (one of mse, ssim, hash, dhash, or phash) used to find the distances
+
+        Returns
+        -------
+        array
+            A (Q, N) numpy array where row q is the distance from the q-th flag to each flag
+            in the gallery
+        '''
+        if (method == "mse" or method == "ssim") and self.get_pool() is not None:
+            return self.pool.score_images(method, flags, self.ssim_scorer)
+        elif method == "mse":
+            return self.mse_scorer.score_many(flags)
+        elif method in HASH_FUNCTIONS:
+            return self.get_hashes().distances_many(np.stack([HashIndex.hash_image(flag, method) for flag in flags]), method)
+        else:
+            return np.stack([self.__scores(flag, method) for flag in flags])
+
+    def __mse(self, imageA, imageB):
+        '''
+        Returns the mean-squared error between the two given images. Lower values mean
         a higher similarity between the two images (0 is perfect similarity).
 
         Parameters
@@ -146,12 +763,14 @@ class FlagIdentifier:
 
         Returns
         -------
-        int
-            The hash distance between the two given images
+        float
+            The mean-squared error between the two given images
         '''
-        firsthash = imagehash.average_hash(Image.fromarray(imageA))
-        otherhash = imagehash.average_hash(Image.fromarray(imageB))
-        return firsthash - otherhash
+        # credit to: https://www.pyimagesearch.com/2014/09/15/python-compare-two-images/
+        err = np.sum((imageA.astype("float") - imageB.astype("float")) ** 2)
+        err /= float(imageA.shape[0] * imageA.shape[1])
+
+        return err
 
     def __ssim(self, imageA, imageB):
         '''
@@ -172,7 +791,7 @@ class FlagIdentifier:
         float
             The structural similarity index measure (ssim) between the two given images
         '''
-        return metrics.structural_similarity(imageA, imageB, multichannel=True)
+        return self.ssim_scorer.score_pair(imageA, imageB)
 
 
     def closest_flag(self, country, method = "mse"):
@@ -186,7 +805,7 @@ class FlagIdentifier:
             The name of the country
 
         method : str
-            The method (one of mse, ssim, or hash) used to find the flag that is
+            The method (one of mse, ssim, hash, dhash, or phash) used to find the flag that is
             most similar to that of the given country
 
         Returns
@@ -195,12 +814,12 @@ class FlagIdentifier:
             The name of the country whose flag is most similar to that of the given
             country
         '''
-        if method == "mse" or method == "hash":
-            return self.__abstract_compare_flags(country.title(), operator.lt, method)
+        if method == "mse" or method in HASH_FUNCTIONS:
+            return self.__abstract_compare_flags(country.title(), np.argmin, method)
         elif method == "ssim":
-            return self.__abstract_compare_flags(country.title(), operator.gt, method)
+            return self.__abstract_compare_flags(country.title(), np.argmax, method)
         else:
-            raise ValueError("method must be one of: mse, ssim, or hash")
+            raise ValueError("method must be one of: mse, ssim, hash, dhash, or phash")
 
 
     def farthest_flag(self, country, method = "mse"):
@@ -214,7 +833,7 @@ class FlagIdentifier:
             The name of the country
 
         method : str
-            The method (one of mse, ssim, or hash) used to find the flag that is
+            The method (one of mse, ssim, hash, dhash, or phash) used to find the flag that is
             least similar to that of the given country
 
         Returns
@@ -223,16 +842,16 @@ class FlagIdentifier:
             The name of the country whose flag is least similar to that of the given
             country
         '''
-        if method == "mse" or method == "hash":
-            return self.__abstract_compare_flags(country.title(), operator.gt, method)
+        if method == "mse" or method in HASH_FUNCTIONS:
+            return self.__abstract_compare_flags(country.title(), np.argmax, method)
         elif method == "ssim":
-            return self.__abstract_compare_flags(country.title(), operator.lt, method)
+            return self.__abstract_compare_flags(country.title(), np.argmin, method)
         else:
-            raise ValueError("method must be one of: mse, ssim, or hash")
+            raise ValueError("method must be one of: mse, ssim, hash, dhash, or phash")
 
-    def __abstract_compare_flags(self, country, op, method):
+    def __abstract_compare_flags(self, country, pick, method):
         '''
-        Finds the country whose flag is "closest" (according to the given operation)
+        Finds the country whose flag is "closest" (according to the given pick function)
         to the flag of the given country. Uses the given method to calculate the distance
         between flags.
 
@@ -241,11 +860,11 @@ class FlagIdentifier:
         country : str
             The name of the country
 
-        op : operator
-            The operator used to find the "closest" flag
+        pick : function
+            Either np.argmin or np.argmax, used to pick the "closest" flag
 
         method : str
-            The method (one of mse, ssim, or hash) used to find the distance between
+            The method (one of mse, ssim, hash, dhash, or phash) used to find the distance between
             flags
 
         Returns
@@ -254,80 +873,414 @@ class FlagIdentifier:
             The name of the country whose flag is "closest" to the flag of the given
             country
         '''
-        best_dist = -1
-        max_country = 0
-        for c in self.flag_df.index:
-            dist = self.flag_dist(country, c, method = method)
-            if (op(dist, best_dist) or best_dist == -1) and c != country:
-                best_dist = dist
-                max_country = c
-                
-        return max_country
+        i = self.gallery.row(country)
+        distances = self.__get_distances(method)
+        self.stats.count("compare.calls")
 
-    def identify(self, url, method = "mse"):
+        with self.stats.timer("compare"):
+            # the whole row is computed (and cached) rather than searched for with the
+            # pyramid, so that every later call for this country is just a lookup
+            dists = distances.row(i, lambda rows: self.__reference_rows(rows, method)).copy()
+
+            # making sure the country's own flag is never picked
+            dists[i] = np.inf if pick is np.argmin else -np.inf
+            return self.gallery.names[int(pick(dists))]
+
+    def identify(self, url, method = "mse", cache = True):
         '''
         Returns the name of the country whose flag is most similar to the flag 
         in the image represented by the given url.
 
         Parameters
         ----------
-        url : str
-            The url that links to an image of a flag to be identified
+        url : object
+            The url that links to an image of a flag to be identified. It can also be
+            a file path, the contents of an image file (bytes or a memoryview), a PIL
+            Image, or a numpy array of pixels, which are used without any download
 
         method : str
-            The method (one of mse, ssim, or hash) used to find the flag that 
+            The method (one of mse, ssim, hash, dhash, phash, or cascade) used to find the flag that 
             is most similar to the one in the image of the given url
 
+        cache : bool
+            Whether or not to use (and store) cached processed images and results
+
         Returns
         -------
         str
             The name of the country whose flag is most similar to the one 
             represented by the url
         '''
-        if method == "mse":
-            return self.__abstract_identify(url, self.__mse, operator.lt)
-        elif method == "ssim":
-            return self.__abstract_identify(url, self.__ssim, operator.gt)
-        elif method == "hash":
-            return self.__abstract_identify(url, self.__hash, operator.lt)
-        else:
-            raise ValueError("method must one of: mse, hash, ssim")
+        self.__check_method(method, cascade = True)
+        self.stats.count("identify.calls")
 
-    def __abstract_identify(self, url, dist_func, op):
+        with self.stats.timer("identify"):
+            flag = self.util.process_img(url, cache = cache)
+
+            key = self.__result_key(flag, method) if cache else None
+            if key is not None:
+                country = self.result_cache.get(key)
+                if country is not None:
+                    self.stats.count("result_cache.hits")
+                    return country
+                self.stats.count("result_cache.misses")
+
+            with self.stats.timer("score"):
+                if method == "mse" and self.use_pyramid:
+                    country = self.gallery.names[self.mse_pyramid.search(flag)[0]]
+                else:
+                    scores = self.__scores(flag, method)
+                    best = np.argmax(scores) if self.__higher_is_better(method) else np.argmin(scores)
+                    country = self.gallery.names[int(best)]
+
+            if key is not None:
+                self.result_cache.put(key, country)
+            return country
+
+    def __result_key(self, flag, method):
         '''
-        Returns the name of the country whose flag is most similar to the
-        image represented by the url. Uses the given dist_func and operator to find the 
-        closest flag.
+        Returns the key that the result of identifying the given processed flag is cached
+        under. It covers the flag's pixels, the method (and the cascade settings, if the
+        method is cascade), and the gallery's version.
 
         Parameters
         ----------
-        url : str
-            The url that links to an image of a flag to be identified
+        flag : array
+            A processed flag
 
-        dist_func : function
-            A distance function (either mse, ssim, or hash) to find the closest
-            flag to the one in the url
+        method : str
+            The method used to identify the flag
 
-        op : operator
-            The operator used to find the flag closest to the one represented
-            by the url
-        
         Returns
         -------
         str
-            The name of the country whose flag is most similar to the one in the 
-            image of the url
+            The key of the result
         '''
-        flag = self.util.process_img(url)
-        
-        best_dist = -1
-        closest_index = 0
-        for c in self.flag_df.index:
-            cur_flag = self.flag_df["flag"].loc[c]
-            dist = dist_func(flag, cur_flag)
-
-            if op(dist, best_dist) or best_dist == -1:
-                best_dist = dist
-                closest_index = c
-                
-        return closest_index
\ No newline at end of file
+        if method == "cascade":
+            method = "cascade-" + "-".join([str(self.cascade_k), self.cascade_prefilter, self.cascade_metric])
+
+        return content_key(np.asarray(flag, dtype = np.uint8), method, self.gallery.version)
+
+    def get_cache_stats(self):
+        '''
+        Returns the hits, misses, and sizes of the cache of identification results and
+        the cache of processed images.
+
+        Returns
+        -------
+        dict
+            The stats of the "results" cache and the "images" cache
+        '''
+        return {"results": self.result_cache.stats(), "images": self.util.image_cache.stats()}
+
+    def clear_caches(self):
+        '''
+        Empties the in-memory caches of identification results and processed images.
+        '''
+        self.result_cache.clear()
+        self.util.image_cache.clear()
+
+    def profile_identify(self, url, method = "mse", limit = 25):
+        '''
+        Identifies the flag in the image represented by the given url under cProfile,
+        skipping every cache so that the whole pipeline runs. The stages of the call are
+        recorded in stats too.
+
+        Parameters
+        ----------
+        url : object
+            The url that links to an image of a flag (or any other image source accepted
+            by identify)
+
+        method : str
+            The method (one of mse, ssim, hash, dhash, phash, or cascade) used to identify the flag
+
+        limit : int
+            The most functions listed in the report
+
+        Returns
+        -------
+        tuple
+            The name of the identified country, and the cProfile report (a str) sorted
+            by cumulative time
+        '''
+        return self.stats.profile(self.identify, url, method, cache = False, limit = limit)
+
+    def identify_topk(self, url, k = 5, method = "mse"):
+        '''
+        Returns the k countries whose flags are most similar to the flag in the image
+        represented by the given url, along with their scores.
+
+        Parameters
+        ----------
+        url : object
+            The url that links to an image of a flag to be identified. It can also be
+            a file path, the contents of an image file (bytes or a memoryview), a PIL
+            Image, or a numpy array of pixels, which are used without any download
+
+        k : int
+            The number of countries to return
+
+        method : str
+            The method (one of mse, ssim, hash, dhash, phash, or cascade) used to score the flags
+
+        Returns
+        -------
+        list
+            A list of (country, score) tuples of the k most similar flags, most similar first
+        '''
+        self.__check_method(method, cascade = True)
+        if k < 1:
+            raise ValueError("k must be at least 1")
+
+        scores = self.__scores(self.util.process_img(url), method)
+
+        # the cascade method only scores the flags on its shortlist
+        if method == "cascade":
+            k = min(k, self.cascade_k)
+        return [(self.gallery.names[i], scores[i].item()) for i in self.__topk(scores, k, method)]
+
+    def __topk(self, scores, k, method):
+        '''
+        Returns the indices of the k best scores, best first. Only the k best scores are
+        sorted, and ties are broken in gallery order just like identify.
+
+        Parameters
+        ----------
+        scores : array
+            A numpy array of the score of each flag
+
+        k : int
+            The number of indices to return
+
+        method : str
+            The method the scores were computed with
+
+        Returns
+        -------
+        array
+            A numpy array of the indices of the k best scores
+        '''
+        # making lower keys always better
+        keys = -scores if self.__higher_is_better(method) else scores
+        k = min(k, len(keys))
+
+        # everything strictly better than the k-th best key is in, and the rest
+        # are filled with the earliest flags that tie with it
+        kth = keys[np.argpartition(keys, k - 1)[k - 1]]
+        better = np.flatnonzero(keys < kth)
+        ties = np.flatnonzero(keys == kth)[:k - len(better)]
+        best = np.concatenate([better, ties])
+
+        return best[np.lexsort((best, keys[best]))]
+
+    def identify_many(self, urls, method = "mse", max_workers = 8, cache = True):
+        '''
+        Identifies the flags in the images represented by each of the given urls. The
+        images are downloaded over a shared pool of connections by several threads at
+        once, and processed as soon as they arrive. All of them are then scored against
+        the gallery together.
+
+        Parameters
+        ----------
+        urls : list
+            The urls that link to images of flags to be identified (or any other image
+            sources accepted by identify)
+
+        method : str
+            The method (one of mse, ssim, hash, dhash, phash, or cascade) used to find the flag that 
+            is most similar to the one in each image
+
+        max_workers : int
+            The most images that are downloaded at the same time
+
+        cache : bool
+            Whether or not to use (and store) cached processed images and results
+
+        Returns
+        -------
+        list
+            For each url (in the same order), the name of the country whose flag is most
+            similar to the one in its image, or the exception raised while downloading
+            or processing it
+        '''
+        self.__check_method(method, cascade = True)
+        flags = [None] * len(urls)
+
+        with ThreadPoolExecutor(max_workers = max_workers) as pool:
+            futures = {pool.submit(self.util.process_img, url, cache): i for i, url in enumerate(urls)}
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    flags[i] = future.result()
+                except Exception as e:
+                    # one bad image shouldn't fail the rest of the batch
+                    flags[i] = e
+
+        return self.__identify_batch(flags, method, cache)
+
+    def identify_flags(self, flags, method = "mse", cache = True):
+        '''
+        Identifies each of the given flags that have already been processed (as returned
+        by FlagUtil.process_img), scoring them against the gallery all at once. This lets
+        callers that gather images themselves, like a server batching requests, skip
+        straight to scoring.
+
+        Parameters
+        ----------
+        flags : list
+            A list of processed flags (or exceptions, which are passed straight through)
+
+        method : str
+            The method (one of mse, ssim, hash, dhash, phash, or cascade) used to identify the flags
+
+        cache : bool
+            Whether or not to use (and store) cached results
+
+        Returns
+        -------
+        list
+            For each flag (in the same order), the name of the country whose flag is most
+            similar to it, or the exception that was given in its place
+        '''
+        self.__check_method(method, cascade = True)
+        return self.__identify_batch(flags, method, cache)
+
+    def __identify_batch(self, flags, method, cache = True):
+        '''
+        Identifies each of the given processed flags, scoring the ones without a cached
+        result against the gallery all at once. Exceptions in place of flags are passed
+        straight through.
+
+        Parameters
+        ----------
+        flags : list
+            A list of processed flags (or exceptions)
+
+        method : str
+            The method (one of mse, ssim, hash, dhash, phash, or cascade) used to identify the flags
+
+        cache : bool
+            Whether or not to use (and store) cached results
+
+        Returns
+        -------
+        list
+            For each flag (in the same order), the name of the country whose flag is most
+            similar to it, or the exception that was given in its place
+        '''
+        results = list(flags)
+        rows = [i for i, flag in enumerate(flags) if not isinstance(flag, BaseException)]
+        self.stats.count("identify_batch.calls")
+        self.stats.count("identify_batch.images", len(rows))
+
+        keys = {}
+        if cache:
+            for i in rows:
+                keys[i] = self.__result_key(flags[i], method)
+                results[i] = self.result_cache.get(keys[i])
+            self.stats.count("result_cache.hits", sum(results[i] is not None for i in rows))
+            rows = [i for i in rows if results[i] is None]
+            self.stats.count("result_cache.misses", len(rows))
+
+        if rows:
+            with self.stats.timer("score_batch"):
+                scores = self.__scores_many(np.stack([flags[i] for i in rows]), method)
+            best = np.argmax(scores, axis = 1) if self.__higher_is_better(method) else np.argmin(scores, axis = 1)
+            for i, b in zip(rows, best):
+                results[i] = self.gallery.names[int(b)]
+                if cache:
+                    self.result_cache.put(keys[i], results[i])
+
+        return results
+
+    async def aidentify(self, url, method = "mse", session = None, executor = None):
+        '''
+        Returns the name of the country whose flag is most similar to the flag in the
+        image represented by the given url, without blocking the event loop. The image
+        is downloaded asynchronously, and processing and scoring it are run in an executor.
+
+        Parameters
+        ----------
+        url : object
+            The url that links to an image of a flag to be identified. It can also be
+            a file path, the contents of an image file (bytes or a memoryview), a PIL
+            Image, or a numpy array of pixels, which are used without any download
+
+        method : str
+            The method (one of mse, ssim, hash, dhash, phash, or cascade) used to find the flag that 
+            is most similar to the one in the image of the given url
+
+        session : aiohttp.ClientSession
+            The session to download the image with (a new one is used if not given)
+
+        executor : Executor
+            The executor that processing and scoring are run in (the loop's default if not given)
+
+        Returns
+        -------
+        str
+            The name of the country whose flag is most similar to the one 
+            represented by the url
+        '''
+        result = (await self.aidentify_many([url], method, session = session, executor = executor))[0]
+        if isinstance(result, BaseException):
+            raise result
+
+        return result
+
+    async def aidentify_many(self, urls, method = "mse", concurrency = 16, session = None, executor = None):
+        '''
+        Identifies the flags in the images represented by each of the given urls without
+        blocking the event loop. At most concurrency images are downloaded at once, each
+        image is processed in the executor as soon as it arrives, and then all of them
+        are scored against the gallery together in the executor.
+
+        Parameters
+        ----------
+        urls : list
+            The urls that link to images of flags to be identified (or any other image
+            sources accepted by identify)
+
+        method : str
+            The method (one of mse, ssim, hash, dhash, phash, or cascade) used to find the flag that 
+            is most similar to the one in each image
+
+        concurrency : int
+            The most images that are downloaded at the same time
+
+        session : aiohttp.ClientSession
+            The session to download the images with (a new one is used if not given)
+
+        executor : Executor
+            The executor that processing and scoring are run in (the loop's default if not given)
+
+        Returns
+        -------
+        list
+            For each url (in the same order), the name of the country whose flag is most
+            similar to the one in its image, or the exception raised while downloading
+            or processing it
+        '''
+        self.__check_method(method, cascade = True)
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def load(source):
+            # only urls need to be downloaded, everything else goes straight to processing
+            if self.util.is_url(source):
+                async with semaphore:
+                    source = await self.util.afetch(source, session)
+            return await loop.run_in_executor(executor, self.util.process_img, source)
+
+        own_session = session is None
+        if own_session:
+            session = self.util.make_async_session(concurrency)
+
+        try:
+            flags = await asyncio.gather(*[load(url) for url in urls], return_exceptions = True)
+        finally:
+            if own_session and session is not None:
+                await session.close()
+
+        return await loop.run_in_executor(executor, self.__identify_batch, flags, method)
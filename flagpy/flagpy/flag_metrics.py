@@ -0,0 +1,552 @@
+from .flag_gallery import update_rows
+import numpy as np
+import threading
+
+class MSEScorer:
+
+    def __init__(self, flags, chunk_bytes = 1 << 19):
+        '''
+        Initializes an MSEScorer object that scores images against every flag in the given
+        stacked array of flags at once. The flags are scored a few at a time so that the
+        scratch buffers stay small, and the buffers are reused between calls.
+
+        Parameters
+        ----------
+        flags : array
+            A (N, height, width, 3) uint8 numpy array of the flags to score against
+
+        chunk_bytes : int
+            Roughly how many bytes of flags are scored in each step
+        '''
+        self.flags = flags.reshape(len(flags), -1)
+        self.pixels = flags.shape[1] * flags.shape[2]
+        self.chunk = max(1, chunk_bytes // max(1, self.flags.shape[1]))
+
+        # the smallest dtype that can hold a whole flag's sum of squared differences
+        self.acc_dtype = np.uint32 if self.flags.shape[1] * 255 ** 2 < 2 ** 32 else np.uint64
+
+        # each thread gets its own scratch buffers
+        self.buffers = threading.local()
+
+    def __get_buffers(self):
+        '''
+        Returns the scratch buffers of the current thread, creating them the first time.
+
+        Returns
+        -------
+        tuple
+            An int16 buffer for the differences and a buffer of the accumulation dtype
+            for their magnitudes
+        '''
+        buffers = getattr(self.buffers, "arrays", None)
+        if buffers is None:
+            shape = (self.chunk, self.flags.shape[1])
+            buffers = (np.empty(shape, dtype = np.int16), np.empty(shape, dtype = self.acc_dtype))
+            self.buffers.arrays = buffers
+
+        return buffers
+
+    def update(self, flags, row, action):
+        '''
+        Points this scorer at the flags of a gallery that just had one flag added,
+        replaced, or removed. Nothing is kept for each flag, so nothing is recomputed.
+
+        Parameters
+        ----------
+        flags : array
+            The gallery's flags after the change
+
+        row : int
+            The row that changed
+
+        action : str
+            One of "add", "replace", or "remove"
+        '''
+        self.flags = flags.reshape(len(flags), -1)
+
+    def score(self, image, rows = None):
+        '''
+        Returns the mean-squared error between the given image and every flag (or only
+        the flags in the given rows). The values are exactly the same as comparing the
+        image to each flag one at a time with floating point numbers, since every squared
+        difference and every sum of them is an integer that fits in the accumulation dtype.
+
+        Parameters
+        ----------
+        image : array
+            A (height, width, 3) uint8 numpy array of the image to score
+
+        rows : array
+            The rows of the flags to score against, or None for every flag
+
+        Returns
+        -------
+        array
+            A float64 numpy array of the mean-squared error between the image and each flag
+        '''
+        return self.score_many(np.asarray(image)[None], rows)[0]
+
+    def score_many(self, images, rows = None):
+        '''
+        Returns the mean-squared error between each of the given images and every flag.
+        Each chunk of flags is compared against every image before moving on to the next
+        chunk, so the flags are only read through once for the whole batch.
+
+        Parameters
+        ----------
+        images : array
+            A (Q, height, width, 3) uint8 numpy array of the images to score
+
+        rows : array
+            The rows of the flags to score against, or None for every flag
+
+        Returns
+        -------
+        array
+            A (Q, N) float64 numpy array of the mean-squared error between each image and each flag
+        '''
+        queries = np.asarray(images).reshape(len(images), -1).astype(np.int16)
+        diff, mag = self.__get_buffers()
+        rows = np.arange(len(self.flags)) if rows is None else np.asarray(rows, dtype = np.intp)
+        sse = np.empty((len(queries), len(rows)), dtype = np.float64)
+
+        for start in range(0, len(rows), self.chunk):
+            stop = min(start + self.chunk, len(rows))
+            n = stop - start
+
+            # plain slices of the flags stay views, so only subsets get copied
+            if len(rows) == len(self.flags):
+                flags = self.flags[start:stop]
+            else:
+                flags = self.flags[rows[start:stop]]
+
+            for q, query in enumerate(queries):
+                # |flag - image| fits in a byte, so a whole flag's worth of squares
+                # (at most 48600 * 255^2 for 180 x 90 flags) fits in a uint32
+                np.subtract(flags, query, out = diff[:n])
+                np.abs(diff[:n], out = mag[:n], casting = "unsafe")
+                sse[q, start:stop] = np.einsum("ij,ij->i", mag[:n], mag[:n])
+
+        return sse / float(self.pixels)
+
+class MSEPyramid:
+
+    def __init__(self, scorer, flags, levels = 2, batch = 8):
+        '''
+        Initializes an MSEPyramid object that finds the flag with the lowest mean-squared
+        error to an image without scoring every flag at full resolution. Besides the full
+        resolution flags, it keeps each flag at lower resolutions (180 x 90, then 90 x 45,
+        then 45 x 22 by default), where every pixel is the sum of a block of pixels.
+
+        The squared error between two block sums, divided by the size of the block, is
+        never more than the squared error over the pixels in that block. So the error at
+        a lower resolution is a lower bound for the real error. Flags are checked in order
+        of their lowest resolution bound, are only scored at the next resolution up if
+        their bound can still beat the best flag found so far, and the search stops as
+        soon as no remaining bound can. The result is exactly the same as scoring every
+        flag at full resolution.
+
+        Parameters
+        ----------
+        scorer : MSEScorer
+            The scorer used for the full resolution flags
+
+        flags : array
+            A (N, height, width, 3) uint8 numpy array of the same flags as the scorer
+
+        levels : int
+            How many lower resolutions to keep (each one is half the size of the last)
+
+        batch : int
+            How many flags are promoted to the next resolution at a time
+        '''
+        self.scorer = scorer
+        self.flags = flags
+        self.levels = levels
+        self.batch = batch
+
+        # the block sums of every flag at each lower resolution, built the first time
+        # they are needed
+        self.pyramid = None
+
+    def downsample(self, images):
+        '''
+        Returns every lower resolution of the given images, where each pixel is the sum of
+        a square block of pixels (a row or column left over at an odd size is dropped).
+
+        Parameters
+        ----------
+        images : array
+            A (n, height, width, 3) numpy array of images
+
+        Returns
+        -------
+        list
+            A numpy array of block sums for each lower resolution, from largest to smallest
+        '''
+        levels = []
+        current = np.asarray(images, dtype = np.int64)
+        for level in range(self.levels):
+            n, height, width, channels = current.shape
+            current = current[:, :height // 2 * 2, :width // 2 * 2]
+            current = current.reshape(n, height // 2, 2, width // 2, 2, channels).sum(axis = (2, 4))
+            levels.append(current)
+
+        return levels
+
+    def get_pyramid(self):
+        '''
+        Returns the lower resolutions of every flag, building them the first time.
+
+        Returns
+        -------
+        list
+            A numpy array of block sums for each lower resolution, from largest to smallest
+        '''
+        if self.pyramid is None:
+            pyramid = [[] for level in range(self.levels)]
+            for start in range(0, len(self.flags), 64):
+                for level, sums in enumerate(self.downsample(self.flags[start:start + 64])):
+                    pyramid[level].append(sums)
+
+            # block sums of 4 ** levels pixels fit in 16 bits for a few levels
+            dtype = np.uint16 if 4 ** self.levels * 255 < 2 ** 16 else np.uint32
+            self.pyramid = [np.concatenate(sums).astype(dtype) for sums in pyramid]
+
+        return self.pyramid
+
+    def update(self, flags, row, action):
+        '''
+        Updates the lower resolutions of the flags after one flag of the gallery was
+        added, replaced, or removed, only downsampling the flag that changed.
+
+        Parameters
+        ----------
+        flags : array
+            The gallery's flags after the change
+
+        row : int
+            The row that changed
+
+        action : str
+            One of "add", "replace", or "remove"
+        '''
+        self.flags = flags
+        if self.pyramid is None:
+            return
+
+        levels = self.downsample(flags[row:row + 1]) if action != "remove" else [None] * self.levels
+        self.pyramid = [update_rows(sums, row, action, level) for sums, level in zip(self.pyramid, levels)]
+
+    def __bounds(self, level, image_levels, rows):
+        '''
+        Returns the lower bound of the mean-squared error between the image and each of
+        the given flags at the given lower resolution.
+
+        Parameters
+        ----------
+        level : int
+            The lower resolution to use (0 is the largest)
+
+        image_levels : list
+            The lower resolutions of the image, as returned by downsample
+
+        rows : array
+            The rows of the flags
+
+        Returns
+        -------
+        array
+            A float64 numpy array of the lower bounds
+        '''
+        diff = self.get_pyramid()[level][rows].astype(np.int64) - image_levels[level]
+        squares = np.einsum("ijkl,ijkl->i", diff, diff)
+
+        # every block holds 4 ** (level + 1) pixels
+        return squares / float(4 ** (level + 1)) / float(self.scorer.pixels)
+
+    def search(self, image):
+        '''
+        Returns the flag with the lowest mean-squared error to the given image. Ties go to
+        the earliest flag, just like np.argmin over every flag's score.
+
+        Parameters
+        ----------
+        image : array
+            A (height, width, 3) uint8 numpy array of the image
+
+        Returns
+        -------
+        tuple
+            The row of the best flag and its mean-squared error
+        '''
+        image_levels = [level[0] for level in self.downsample(np.asarray(image)[None])]
+        coarsest = self.levels - 1
+
+        bounds = self.__bounds(coarsest, image_levels, slice(None))
+        order = np.argsort(bounds, kind = "stable")
+
+        best, best_mse = -1, np.inf
+        for start in range(0, len(order), self.batch):
+            rows = order[start:start + self.batch]
+
+            # the bounds are sorted, so once one can't beat the best flag none of the rest can
+            rows = rows[bounds[rows] <= best_mse]
+            if len(rows) == 0:
+                break
+
+            # promoting the rows through each higher resolution
+            for level in range(coarsest - 1, -1, -1):
+                rows = rows[self.__bounds(level, image_levels, rows) <= best_mse]
+
+            if len(rows):
+                for row, mse in zip(rows, self.scorer.score(image, rows)):
+                    if mse < best_mse or (mse == best_mse and row < best):
+                        best, best_mse = row, mse
+
+        return int(best), best_mse
+
+class SSIMScorer:
+
+    def __init__(self, flags, win_size = 7, chunk = 16):
+        '''
+        Initializes an SSIMScorer object that finds the structural similarity index measure
+        (ssim) between images and every flag in the given stacked array of flags at once.
+        It gives the same values as scikit-image's structural_similarity with its default
+        settings on uint8 color images (a 7 x 7 uniform window, sample covariance, and a
+        data range of 255, averaged over the color channels), up to floating point rounding.
+
+        Every windowed sum that ssim needs is computed exactly with integers. The windowed
+        statistics of each flag never change, so they are computed once (the first time
+        they are needed) and kept for every later call.
+
+        Parameters
+        ----------
+        flags : array
+            A (N, height, width, 3) uint8 numpy array of the flags to score against
+
+        win_size : int
+            The side length of the square window that the local statistics are taken over
+
+        chunk : int
+            How many flags are scored at a time
+        '''
+        self.flags = flags
+        self.win_size = win_size
+        self.chunk = chunk
+
+        # the windowed statistics of each flag, computed the first time they are needed
+        self.sums = None
+        self.spreads = None
+
+        # ssim is written here in terms of window sums instead of window means, which
+        # scales the constants from scikit-image's defaults by the window area squared
+        self.area = win_size ** 2
+        self.cov_norm = self.area / (self.area - 1)
+        self.c1 = (0.01 * 255) ** 2 * self.area ** 2
+        self.c2 = (0.03 * 255) ** 2 * self.area ** 2
+
+    def window_sums(self, images):
+        '''
+        Returns the sum of each window of the given images, for every window that lies
+        completely inside the image. These are exactly the windows whose centers are
+        kept when ssim is averaged, so the image borders never matter.
+
+        Parameters
+        ----------
+        images : array
+            A (n, height, width, channels) numpy array of values no bigger than 255^2
+
+        Returns
+        -------
+        array
+            A (n, height - win_size + 1, width - win_size + 1, channels) int32 numpy array
+            of the window sums
+        '''
+        w = self.win_size
+        height, width = images.shape[1], images.shape[2]
+
+        # adding up shifted copies, first down the columns and then along the rows
+        rows = images[:, :height - w + 1].astype(np.int32)
+        for k in range(1, w):
+            rows += images[:, k:height - w + 1 + k]
+
+        sums = rows[:, :, :width - w + 1].copy()
+        for k in range(1, w):
+            sums += rows[:, :, k:width - w + 1 + k]
+
+        return sums
+
+    def window_stats(self, images):
+        '''
+        Returns the window sums of the given images and their spreads, the window
+        area times the window sums of the squared images minus the squared window sums
+        (which is the window variance scaled by the window area squared).
+
+        Parameters
+        ----------
+        images : array
+            A (n, height, width, channels) uint8 numpy array
+
+        Returns
+        -------
+        tuple
+            The window sums (as uint16) and spreads (as uint32) of the images
+        '''
+        images = np.asarray(images, dtype = np.uint16)
+        sums = self.window_sums(images)
+        square_sums = self.window_sums(images * images)
+
+        spreads = self.area * square_sums.astype(np.int64) - sums.astype(np.int64) ** 2
+        return sums.astype(np.uint16), spreads.astype(np.uint32)
+
+    def get_stats(self):
+        '''
+        Returns the window sums and spreads of every flag, computing them the first time.
+
+        Returns
+        -------
+        tuple
+            The window sums and spreads of every flag
+        '''
+        if self.sums is None:
+            stats = [self.window_stats(self.flags[start:start + self.chunk])
+                for start in range(0, len(self.flags), self.chunk)]
+
+            self.spreads = np.concatenate([spreads for _, spreads in stats])
+            self.sums = np.concatenate([sums for sums, _ in stats])
+
+        return self.sums, self.spreads
+
+    def update(self, flags, row, action):
+        '''
+        Updates the window statistics of the flags after one flag of the gallery was
+        added, replaced, or removed, only computing the statistics of the flag that changed.
+
+        Parameters
+        ----------
+        flags : array
+            The gallery's flags after the change
+
+        row : int
+            The row that changed
+
+        action : str
+            One of "add", "replace", or "remove"
+        '''
+        self.flags = flags
+        if self.sums is None:
+            return
+
+        sums, spreads = self.window_stats(flags[row:row + 1]) if action != "remove" else (None, None)
+        self.sums = update_rows(self.sums, row, action, sums)
+        self.spreads = update_rows(self.spreads, row, action, spreads)
+
+    def __compare(self, flags, sums, spreads, image):
+        '''
+        Returns the ssim between the given image and each of the given flags, using the
+        flags' window statistics.
+
+        Parameters
+        ----------
+        flags : array
+            A (n, height, width, 3) uint8 numpy array of flags
+
+        sums : array
+            The window sums of the flags
+
+        spreads : array
+            The window spreads of the flags
+
+        image : array
+            A (height, width, 3) uint8 numpy array of the image
+
+        Returns
+        -------
+        array
+            A float64 numpy array of the ssim between the image and each flag
+        '''
+        image = np.asarray(image, dtype = np.uint16)
+        image_sums, image_spreads = self.window_stats(image[None])
+        image_sums = image_sums[0].astype(np.float64)
+
+        # the parts of the formula that only depend on the image
+        image_mean_term = image_sums * image_sums + self.c1
+        image_var_term = self.cov_norm * image_spreads[0] + self.c2
+
+        scores = np.empty(len(flags), dtype = np.float64)
+        for start in range(0, len(flags), self.chunk):
+            stop = min(start + self.chunk, len(flags))
+            sx = sums[start:stop].astype(np.float64)
+            sxy = self.window_sums(np.asarray(flags[start:stop], dtype = np.uint16) * image).astype(np.float64)
+
+            # 2 * mean_x * mean_y + c1, times the same with the covariance
+            product = sx * image_sums
+            sxy *= self.area
+            sxy -= product
+            sxy *= 2 * self.cov_norm
+            sxy += self.c2
+            product *= 2
+            product += self.c1
+            numerator = product
+            numerator *= sxy
+
+            # mean_x^2 + mean_y^2 + c1, times the same with the variances
+            sx *= sx
+            sx += image_mean_term
+            denominator = spreads[start:stop] * self.cov_norm
+            denominator += image_var_term
+            denominator *= sx
+
+            numerator /= denominator
+            scores[start:stop] = numerator.reshape(stop - start, -1).mean(axis = 1)
+
+        return scores
+
+    def score(self, image, rows = None):
+        '''
+        Returns the ssim between the given image and every flag (or only the flags in
+        the given rows). The image's window statistics are computed once and shared by
+        all of the flags.
+
+        Parameters
+        ----------
+        image : array
+            A (height, width, 3) uint8 numpy array of the image to score
+
+        rows : array
+            The rows of the flags to score against, or None for every flag
+
+        Returns
+        -------
+        array
+            A float64 numpy array of the ssim between the image and each flag
+        '''
+        sums, spreads = self.get_stats()
+        if rows is None:
+            return self.__compare(self.flags, sums, spreads, image)
+
+        rows = np.asarray(rows, dtype = np.intp)
+        return self.__compare(self.flags[rows], sums[rows], spreads[rows], image)
+
+    def score_pair(self, imageA, imageB):
+        '''
+        Returns the ssim between the two given images, neither of which has to be one
+        of the flags.
+
+        Parameters
+        ----------
+        imageA : array
+            A (height, width, 3) uint8 numpy array of the first image
+
+        imageB : array
+            A (height, width, 3) uint8 numpy array of the second image
+
+        Returns
+        -------
+        float
+            The ssim between the two images
+        '''
+        flags = np.asarray(imageB)[None]
+        sums, spreads = self.window_stats(flags)
+        return self.__compare(flags, sums, spreads, imageA)[0]
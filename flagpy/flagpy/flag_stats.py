@@ -0,0 +1,265 @@
+import threading
+import cProfile
+import pstats
+import time
+import io
+
+class StageTimer:
+
+    def __init__(self, stats, name):
+        '''
+        Initializes a StageTimer object, which times the code in its with block and
+        records it under the given name.
+
+        Parameters
+        ----------
+        stats : Instrumentation
+            The instrumentation the time is recorded in
+
+        name : str
+            The name of the stage being timed
+        '''
+        self.stats = stats
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stats.record(self.name, time.perf_counter() - self.start)
+
+class NullTimer:
+    '''
+    Stands in for a StageTimer while instrumentation is turned off, and does nothing.
+    '''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+# shared by every disabled Instrumentation, so that timing a stage allocates nothing
+NULL_TIMER = NullTimer()
+
+class Instrumentation:
+
+    def __init__(self, enabled = False):
+        '''
+        Initializes an Instrumentation object, which keeps the total time spent in each
+        named stage (ie. download, decode, or score) and cumulative counters (ie. calls
+        or bytes downloaded). It is turned off by default, and costs next to nothing
+        until it is turned on.
+
+        Parameters
+        ----------
+        enabled : bool
+            Whether or not to start recording right away
+        '''
+        self.enabled = enabled
+        self.lock = threading.Lock()
+
+        # turns recording on for only the calling thread, while profile is running
+        self.local = threading.local()
+        self.timers = {}
+        self.counters = {}
+        self.exporters = []
+
+    def enable(self, enabled = True):
+        '''
+        Turns recording on (or off).
+
+        Parameters
+        ----------
+        enabled : bool
+            Whether or not to record
+        '''
+        self.enabled = enabled
+
+    def is_recording(self):
+        '''
+        Returns whether or not the calling thread records anything, which it does if
+        recording is turned on or if it is running a call given to profile.
+
+        Returns
+        -------
+        bool
+            Whether or not to record
+        '''
+        return self.enabled or getattr(self.local, "profiling", False)
+
+    def timer(self, name):
+        '''
+        Returns a context manager that records how long its with block takes as the
+        given stage.
+
+        Parameters
+        ----------
+        name : str
+            The name of the stage
+
+        Returns
+        -------
+        object
+            A StageTimer, or a timer that does nothing if recording is turned off
+        '''
+        if not self.is_recording():
+            return NULL_TIMER
+        return StageTimer(self, name)
+
+    def record(self, name, seconds):
+        '''
+        Records one run of the given stage.
+
+        Parameters
+        ----------
+        name : str
+            The name of the stage
+
+        seconds : float
+            How long the stage took
+        '''
+        if not self.is_recording():
+            return
+
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = [0, 0.0, 0.0]
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+        for exporter in self.exporters:
+            exporter("timer", name, seconds)
+
+    def count(self, name, amount = 1):
+        '''
+        Adds the given amount to the given counter.
+
+        Parameters
+        ----------
+        name : str
+            The name of the counter (counters named x.hits and x.misses also get an
+            x.hit_rate in snapshot)
+
+        amount : int
+            How much to add
+        '''
+        if not self.is_recording():
+            return
+
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+        for exporter in self.exporters:
+            exporter("counter", name, amount)
+
+    def add_exporter(self, exporter):
+        '''
+        Adds a function that is called with every timing and count as it is recorded,
+        ie. to forward them to a metrics system. It is called as exporter(kind, name,
+        value), where kind is "timer" (and value is in seconds) or "counter" (and value
+        is the amount added), from whichever thread recorded it.
+
+        Parameters
+        ----------
+        exporter : function
+            The function to call
+        '''
+        with self.lock:
+            self.exporters = self.exporters + [exporter]
+
+    def remove_exporter(self, exporter):
+        '''
+        Removes a function added with add_exporter.
+
+        Parameters
+        ----------
+        exporter : function
+            The function to remove
+        '''
+        with self.lock:
+            self.exporters = [other for other in self.exporters if other is not exporter]
+
+    def snapshot(self):
+        '''
+        Returns everything recorded so far.
+
+        Returns
+        -------
+        dict
+            Whether recording is "enabled", the "timers" (the calls, total_ms, mean_ms,
+            and max_ms of each stage), and the "counters"
+        '''
+        with self.lock:
+            timers = {name: list(timer) for name, timer in self.timers.items()}
+            counters = dict(self.counters)
+
+        for name in list(counters):
+            if name.endswith(".hits"):
+                prefix = name[:-len(".hits")]
+                lookups = counters[name] + counters.get(prefix + ".misses", 0)
+                counters[prefix + ".hit_rate"] = counters[name] / lookups if lookups else None
+
+        return {
+            "enabled": self.enabled,
+            "timers": {name: {
+                "calls": calls,
+                "total_ms": total * 1000.0,
+                "mean_ms": total * 1000.0 / calls,
+                "max_ms": longest * 1000.0
+            } for name, (calls, total, longest) in timers.items()},
+            "counters": counters
+        }
+
+    def reset(self):
+        '''
+        Forgets everything recorded so far (exporters are kept).
+        '''
+        with self.lock:
+            self.timers = {}
+            self.counters = {}
+
+    def profile(self, function, *args, sort = "cumulative", limit = 25, **kwargs):
+        '''
+        Calls the given function under cProfile and returns its result along with a
+        report of where the time went. The stages of the call are also recorded, even if
+        recording is turned off, but what other threads do meanwhile is only recorded if
+        it is turned on.
+
+        Parameters
+        ----------
+        function : function
+            The function to profile
+
+        args : tuple
+            The arguments to call it with
+
+        sort : str
+            What the report is sorted by (any sort key of pstats.Stats)
+
+        limit : int
+            The most functions listed in the report
+
+        kwargs : dict
+            The keyword arguments to call it with
+
+        Returns
+        -------
+        tuple
+            The function's result, and the report (a str)
+        '''
+        profiling = getattr(self.local, "profiling", False)
+        self.local.profiling = True
+        profiler = cProfile.Profile()
+        try:
+            result = profiler.runcall(function, *args, **kwargs)
+        finally:
+            self.local.profiling = profiling
+
+        report = io.StringIO()
+        pstats.Stats(profiler, stream = report).sort_stats(sort).print_stats(limit)
+        return result, report.getvalue()
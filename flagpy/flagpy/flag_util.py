@@ -1,36 +1,104 @@
 from PIL import Image
-import requests
-from io import BytesIO
+from io import BytesIO, RawIOBase, SEEK_SET, SEEK_CUR, SEEK_END
+from .flag_cache import LRUCache, content_key
+from .flag_http_cache import HTTPCache
+from .flag_stats import Instrumentation
 import numpy as np
-import pickle
+import threading
+import asyncio
 import os
 
+def import_aiohttp():
+    '''
+    Imports and returns aiohttp, or returns None if it is not installed. Without
+    aiohttp, asynchronous downloads fall back to a thread.
+
+    Returns
+    -------
+    module
+        The aiohttp module, or None
+    '''
+    try:
+        import aiohttp
+        return aiohttp
+    except ImportError:
+        return None
+
+# the cache of downloaded files shared by every FlagUtil, created the first time
+# something is downloaded
+http_cache = None
+http_cache_lock = threading.Lock()
+
+class BufferReader(RawIOBase):
+
+    def __init__(self, buffer):
+        '''
+        Initializes a BufferReader object, a read-only file over the given buffer that
+        reads straight out of it instead of copying the whole buffer up front (which is
+        what BytesIO does with anything other than bytes).
+
+        Parameters
+        ----------
+        buffer : object
+            A bytes-like object, such as a bytearray or memoryview
+        '''
+        self.buffer = memoryview(buffer).cast("B")
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = max(0, min(len(b), len(self.buffer) - self.position))
+        b[:n] = self.buffer[self.position:self.position + n]
+        self.position += n
+        return n
+
+    def seek(self, offset, whence = SEEK_SET):
+        if whence == SEEK_CUR:
+            offset += self.position
+        elif whence == SEEK_END:
+            offset += len(self.buffer)
+
+        self.position = max(0, offset)
+        return self.position
+
+    def tell(self):
+        return self.position
+
 class FlagUtil:
 
-    def __init__(self):
+    def __init__(self, http_cache = None):
         '''
         Initializes a FlagUtil object with a color dictionary to be used for memoization.
         It stores RGB colors as keys and their respective 'web safe' colors as the values.
         This speeds up the process for converting flags to 'web safe' colors. It is also
         initialized with a list of all 216 'web safe' colors.
+
+        Parameters
+        ----------
+        http_cache : HTTPCache
+            A cache of downloaded files used only by this FlagUtil, instead of the one
+            shared by every FlagUtil
         '''
         self.color_dict = {}
         self.web_safe_colors = self.get_web_safe_colors()
+        self.color_lut = self.get_color_lut()
 
-    def pickle_numpy(self, arr, country_filename):
-        '''
-        Loads the given numpy array into a file with the given file name.
+        # a pooled session that reuses connections, created the first time it is needed
+        self.session = None
+        self.session_lock = threading.Lock()
+        self.pool_size = 32
+        self.http_cache = http_cache
 
-        Parameters
-        ----------
-        arr : array
-            A 2D array representing an image of a country's flag
+        # the most recently processed images, by the digest of their contents
+        self.image_cache = LRUCache(256)
 
-        country_filename : str
-            The name of the file used to store the image of the country's flag
-        '''
-        with open('flags/' + country_filename + '.pkl','wb') as f:
-            pickle.dump(arr, f)
+        # stage timers and counters, which record nothing until they are enabled
+        self.stats = Instrumentation()
 
     def get_web_safe_colors(self):
         '''
@@ -50,6 +118,45 @@ class FlagUtil:
                     
         return lst
 
+    def get_color_lut(self):
+        '''
+        Returns a lookup table that maps every possible channel value (0 - 255) to
+        the closest 'web safe' channel value. Since the distance used by find_nearest_color
+        is the sum of the per-channel differences and the 'web safe' colors are every
+        combination of the 'web safe' channel values, the nearest color can be found one
+        channel at a time. 51 is odd, so no channel value is ever tied between two levels.
+
+        Returns
+        -------
+        array
+            A numpy array of 256 uint8 values, where index i holds the 'web safe'
+            channel value closest to i
+        '''
+        levels = np.arange(0, 256, 51)
+        values = np.arange(256)
+
+        # picking the first (lowest) level on a tie, just like find_nearest_color
+        nearest = np.argmin(np.abs(values[:, None] - levels[None, :]), axis = 1)
+        return levels[nearest].astype(np.uint8)
+
+    def quantize_array(self, arr):
+        '''
+        Returns a copy of the given RGB array where every pixel's color has been changed
+        to its closest 'web safe' color. This gives exactly the same colors as calling
+        find_nearest_color on each pixel, but does it in one pass over the whole array.
+
+        Parameters
+        ----------
+        arr : array
+            A uint8 numpy array of RGB pixels (the last axis being the color channels)
+
+        Returns
+        -------
+        array
+            A uint8 numpy array of the same shape with only 'web safe' colors
+        '''
+        return self.color_lut[np.asarray(arr, dtype = np.uint8)]
+
     def find_nearest_color(self, color):
         '''
         Returns the 'web safe' color that is closest to the given
@@ -68,8 +175,10 @@ class FlagUtil:
         '''
         # if this color's been processed before, get its stored value
         if color in self.color_dict:
+            self.stats.count("color_memo.hits")
             return self.color_dict[color]
-                
+
+        self.stats.count("color_memo.misses")
         min_dist = 1000
         nearest_color = (0, 0, 0)
         for cur_col in self.web_safe_colors:
@@ -93,70 +202,334 @@ class FlagUtil:
         img : Image
             The image whose colors are being standardized
         '''
-        width, height = img.size
+        # replacing every pixel with its 'web safe' version at once
+        img.paste(Image.fromarray(self.quantize_array(np.asarray(img))))
 
-        for x in range(width):
-            for y in range(height):
-                # get the current color of the pixel
-                # and replace it with the 'web safe' version
-                current_color = img.getpixel((x, y))
-                new_color = self.find_nearest_color(current_color)
-                img.putpixel((x, y), new_color)
+    def get_session(self):
+        '''
+        Returns the requests Session used to download images. It keeps connections
+        open between downloads, and it can be shared by several threads at once.
 
-    def process_img(self, url):
+        Returns
+        -------
+        Session
+            The session used to download images
         '''
-        Loads in an image from the given url and then converts it to RGB,
-        standardizes its colors, and resizes it appropriately.
+        with self.session_lock:
+            if self.session is None:
+                # requests is only imported once something is downloaded
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections = self.pool_size, pool_maxsize = self.pool_size)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self.session = session
+
+        return self.session
+
+    def get_http_cache(self):
+        '''
+        Returns the on-disk cache of downloaded files used by this FlagUtil: its own if
+        it was given one, and otherwise the one shared by every FlagUtil, which is created
+        the first time. The shared cache is only used in offline mode (only serving cached
+        files) if the FLAGPY_OFFLINE environment variable is set to 1. If the cache
+        directory can't be created, files are downloaded without being cached.
+
+        Returns
+        -------
+        HTTPCache
+            The cache of downloaded files, or None if there isn't one
+        '''
+        if self.http_cache is not None:
+            return self.http_cache
+
+        global http_cache
+        with http_cache_lock:
+            if http_cache is None:
+                try:
+                    http_cache = HTTPCache(self.get_cache_dir("http"), offline = os.environ.get("FLAGPY_OFFLINE") == "1")
+                except OSError:
+                    http_cache = False
+
+        return http_cache or None
+
+    def set_http_cache(self, cache):
+        '''
+        Replaces the cache of downloaded files shared by every FlagUtil, ie. to change its
+        size or turn on offline mode.
+
+        Parameters
+        ----------
+        cache : HTTPCache
+            The new cache, or None to download files without caching them
+        '''
+        global http_cache
+        with http_cache_lock:
+            http_cache = cache if cache is not None else False
+
+    def fetch(self, url):
+        '''
+        Downloads the given url using the pooled session. Files are kept in the shared
+        cache of downloaded files, so a file that hasn't changed since it was last
+        downloaded isn't downloaded again.
 
         Parameters
         ----------
         url : str
-            A url linking to an image to be processed
+            The url to download
 
         Returns
         -------
-        array
-            A numpy array representing the processed image from the
-            given url
+        bytes
+            The body of the response
         '''
-        # getting the image from the url
-        response = requests.get(url)
-        image_bytes = BytesIO(response.content)
+        cache = self.get_http_cache()
+        with self.stats.timer("download"):
+            if cache is None:
+                body = self.get_session().get(url).content
+            else:
+                body = cache.fetch(self.get_session(), url)
+
+        self.stats.count("download.calls")
+        self.stats.count("download.bytes", len(body))
+        return body
+
+    def make_async_session(self, limit):
+        '''
+        Returns a new aiohttp ClientSession for downloading images asynchronously, or
+        None if aiohttp is not installed. It must be created (and closed) inside a
+        running event loop.
+
+        Parameters
+        ----------
+        limit : int
+            The most connections the session keeps open at once
+
+        Returns
+        -------
+        ClientSession
+            A new aiohttp session, or None if aiohttp is not installed
+        '''
+        aiohttp = import_aiohttp()
+        if aiohttp is None:
+            return None
+
+        return aiohttp.ClientSession(connector = aiohttp.TCPConnector(limit = limit))
+
+    async def afetch(self, url, session = None):
+        '''
+        Downloads the given url without blocking the event loop. Like fetch, it goes
+        through the shared cache of downloaded files (and only serves cached files in
+        offline mode). If aiohttp is not installed, the pooled session is used in a
+        thread instead.
+
+        Parameters
+        ----------
+        url : str
+            The url to download
+
+        session : ClientSession
+            The aiohttp session to download with (a new one is used if not given)
+
+        Returns
+        -------
+        bytes
+            The body of the response
+        '''
+        aiohttp = import_aiohttp()
+        if aiohttp is None:
+            return await asyncio.get_running_loop().run_in_executor(None, self.fetch, url)
+
+        if session is None:
+            async with aiohttp.ClientSession() as session:
+                return await self.afetch(url, session)
+
+        # going through the same cache of downloaded files as fetch
+        cache = self.get_http_cache()
+        with self.stats.timer("download"):
+            if cache is None:
+                async with session.get(url) as response:
+                    body = await response.read()
+            else:
+                body = await cache.afetch(session, url)
+
+        self.stats.count("download.calls")
+        self.stats.count("download.bytes", len(body))
+        return body
+
+    def is_url(self, source):
+        '''
+        Returns whether the given image source is a url that has to be downloaded.
+
+        Parameters
+        ----------
+        source : object
+            An image source, as accepted by process_img
+
+        Returns
+        -------
+        bool
+            True if the source is an http or https url
+        '''
+        return isinstance(source, str) and source.startswith(("http://", "https://"))
+
+    def open_image(self, source):
+        '''
+        Opens the image from the given source without processing it. The source can be
+        a url, a file path, the contents of an image file (as bytes, a bytearray, or a
+        memoryview), an open binary file, a PIL Image, or a numpy array of pixels. Only
+        urls are downloaded; in-memory sources are read in place.
+
+        Parameters
+        ----------
+        source : object
+            Where the image comes from
+
+        Returns
+        -------
+        Image or array
+            The opened image (numpy arrays are returned as they are)
+        '''
+        if isinstance(source, np.ndarray) or isinstance(source, Image.Image):
+            return source
+
+        if self.is_url(source):
+            source = self.fetch(source)
+
+        if isinstance(source, bytes):
+            # BytesIO shares the bytes object instead of copying it
+            source = BytesIO(source)
+        elif isinstance(source, (bytearray, memoryview)):
+            source = BufferReader(source)
 
         try:
-            img = Image.open(image_bytes)
+            return Image.open(source)
+        except (FileNotFoundError, IsADirectoryError):
+            raise
         except:
             raise IOError("Unable to open up image")
-        
-        # converting it to RGB
-        img = img.convert("RGB")
-        
-        # resizing to 180 x 90
-        img = img.resize((180, 90))
-        
-        # standardizing the colors to 'web safe' colors
-        self.fix_image_color(img)
-        
-        # converting an array of pixels
-        img = np.array(img)
-        return img
-
-    def makeArray(self, npy_file):
-        '''
-        Loads in a file of the given file name and returns the numpy array
-        that was stored in the file.
+
+    def process_image(self, img):
+        '''
+        Converts the given opened image to RGB, resizes it to 180 x 90, and standardizes
+        its colors. Images that are already 180 x 90 RGB aren't resized.
 
         Parameters
         ----------
-        npy_file : str 
-            The name of the file being read
+        img : Image or array
+            An opened image, as returned by open_image
 
         Returns
         -------
         array
-            A numpy array that was being stored in the given file
+            A numpy array representing the processed image
+        '''
+        if isinstance(img, np.ndarray):
+            if img.dtype != np.uint8:
+                raise ValueError("image arrays must be uint8")
+
+            # arrays that are already the right size skip PIL entirely
+            if img.shape == (90, 180, 3):
+                with self.stats.timer("quantize"):
+                    return self.quantize_array(img)
+            img = Image.fromarray(img)
+        else:
+            # opened images are only decoded once their pixels are needed
+            with self.stats.timer("decode"):
+                img.load()
+
+        with self.stats.timer("resize"):
+            # converting it to RGB
+            if img.mode != "RGB":
+                img = img.convert("RGB")
+
+            # resizing to 180 x 90
+            if img.size != (180, 90):
+                img = img.resize((180, 90))
+
+        # converting to an array of pixels and standardizing
+        # the colors to 'web safe' colors
+        with self.stats.timer("quantize"):
+            return self.quantize_array(np.asarray(img))
+
+    def process_img(self, source, cache = True):
+        '''
+        Loads in an image from the given source and then converts it to RGB,
+        standardizes its colors, and resizes it appropriately. Images that arrive as
+        bytes (including every downloaded image) are cached by the digest of their
+        contents, so the same image is only processed once no matter how many urls
+        it comes from. Cached images are returned as read-only arrays.
+
+        Parameters
+        ----------
+        source : object
+            A url linking to an image to be processed, or any other image source
+            accepted by open_image (a file path, bytes, a memoryview, a PIL Image,
+            a numpy array, ...)
+
+        cache : bool
+            Whether or not to look up and store the processed image in the cache
+
+        Returns
+        -------
+        array
+            A numpy array representing the processed image from the
+            given source
+        '''
+        if self.is_url(source):
+            source = self.fetch(source)
+
+        if not cache or not isinstance(source, (bytes, bytearray, memoryview)):
+            return self.process_image(self.open_image(source))
+
+        key = content_key(source)
+        flag = self.image_cache.get(key)
+        if flag is None:
+            flag = self.process_image(self.open_image(source))
+            flag.flags.writeable = False
+            self.image_cache.put(key, flag)
+
+        return flag
+
+    def process_bytes(self, image_bytes):
+        '''
+        Opens the image stored in the given bytes and then converts it to RGB,
+        standardizes its colors, and resizes it appropriately.
+
+        Parameters
+        ----------
+        image_bytes : bytes
+            The contents of an image file
+
+        Returns
+        -------
+        array
+            A numpy array representing the processed image
+        '''
+        return self.process_image(self.open_image(image_bytes))
+
+    def get_cache_dir(self, name):
+        '''
+        Returns the directory that flagpy caches the given kind of data in, creating it
+        if it does not exist yet. The cache lives in the FLAGPY_CACHE_DIR environment
+        variable if it is set, and in the user's cache directory otherwise.
+
+        Parameters
+        ----------
+        name : str
+            The name of the kind of data being cached (ie. "distances")
+
+        Returns
+        -------
+        str
+            The path of the cache directory
         '''
-        with open(os.path.join(os.path.dirname(__file__), npy_file), 'rb') as npy:
-            arr = pickle.load(npy)
-            return arr
+        root = os.environ.get("FLAGPY_CACHE_DIR")
+        if not root:
+            root = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser(os.path.join("~", ".cache")), "flagpy")
 
+        directory = os.path.join(root, name)
+        os.makedirs(directory, exist_ok = True)
+        return directory
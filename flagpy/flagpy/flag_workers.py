@@ -0,0 +1,357 @@
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import os
+
+# the state of a worker process, set up once by init_worker when the worker starts
+worker = None
+
+class GalleryChanged(Exception):
+    '''
+    Raised by a worker whose gallery on disk isn't the one its parent process scores
+    against, ie. because the gallery was saved again after the parent loaded it.
+    '''
+    pass
+
+def init_worker(directory, flags, palette, version):
+    '''
+    Sets up a worker process. The gallery is memory mapped from the directory it is
+    stored in, so every worker shares the same pages of it instead of getting its own
+    copy. Galleries that only exist in memory are sent to each worker once instead.
+
+    Parameters
+    ----------
+    directory : str
+        The directory that the gallery is stored in, or None
+
+    flags : array
+        The flags of the gallery if it isn't stored anywhere, or None
+
+    palette : bool
+        Whether or not the flags are kept as palette indices (see FlagGallery.to_palette)
+
+    version : str
+        The version of the parent process's gallery, which the gallery loaded from the
+        directory has to match
+    '''
+    global worker
+    from .flag_gallery import FlagGallery
+    from .flag_metrics import MSEScorer, SSIMScorer
+    from .flag_palette import PaletteImages, PaletteScorer
+
+    if flags is None:
+        gallery = FlagGallery.load(directory, palette = palette)
+        if gallery.version != version:
+            # every task is refused, since its rows and ssim statistics are the parent's
+            worker = {"changed": "the gallery in " + directory + " is version " + gallery.version +
+                ", but the parent process has version " + version}
+            return
+        flags = gallery.flags
+
+    worker = {
+        "flags": flags,
+        "mse": PaletteScorer(flags.indices, flags.palette) if isinstance(flags, PaletteImages) else MSEScorer(flags),
+        "ssim": SSIMScorer(flags),
+        "ssim_stats": None
+    }
+
+def get_scorer(method, stats):
+    '''
+    Returns the worker's scorer for the given method. The ssim scorer uses the window
+    statistics that the parent process saved, which are memory mapped (and so shared
+    between the workers) rather than computed again by every worker.
+
+    Parameters
+    ----------
+    method : str
+        The method (mse or ssim) to score with
+
+    stats : tuple
+        The paths of the saved ssim window sums and spreads, or None for mse
+
+    Returns
+    -------
+    object
+        The MSEScorer or SSIMScorer of this worker
+    '''
+    if "changed" in worker:
+        raise GalleryChanged(worker["changed"])
+
+    scorer = worker[method]
+    if method == "ssim" and worker["ssim_stats"] != stats:
+        scorer.sums = np.load(stats[0], mmap_mode = "r", allow_pickle = False)
+        scorer.spreads = np.load(stats[1], mmap_mode = "r", allow_pickle = False)
+        worker["ssim_stats"] = stats
+
+    return scorer
+
+def score_images(method, stats, images, start, stop):
+    '''
+    Scores each of the given images against the flags from start to stop. This is run
+    in a worker process.
+
+    Parameters
+    ----------
+    method : str
+        The method (mse or ssim) to score with
+
+    stats : tuple
+        The paths of the saved ssim window statistics, or None for mse
+
+    images : array
+        A (Q, height, width, 3) uint8 numpy array of the images
+
+    start : int
+        The first flag to score against
+
+    stop : int
+        One past the last flag to score against
+
+    Returns
+    -------
+    array
+        A (Q, stop - start) float64 numpy array of scores
+    '''
+    scorer = get_scorer(method, stats)
+    rows = np.arange(start, stop)
+    if method == "mse":
+        return scorer.score_many(images, rows)
+
+    return np.stack([scorer.score(image, rows) for image in images])
+
+def score_rows(method, stats, rows):
+    '''
+    Scores each of the given flags of the gallery against every flag. This is run in
+    a worker process.
+
+    Parameters
+    ----------
+    method : str
+        The method (mse or ssim) to score with
+
+    stats : tuple
+        The paths of the saved ssim window statistics, or None for mse
+
+    rows : list
+        The rows of the flags to score
+
+    Returns
+    -------
+    array
+        A (len(rows), N) float64 numpy array of scores
+    '''
+    scorer = get_scorer(method, stats)
+    images = np.asarray(worker["flags"][rows])
+    if method == "mse":
+        return scorer.score_many(images)
+
+    return np.stack([scorer.score(image) for image in images])
+
+class WorkerPool:
+
+    def __init__(self, gallery, workers, cache_dir = None):
+        '''
+        Initializes a WorkerPool object that spreads scoring across several processes.
+        The processes aren't started until the pool is first used. Work is split into
+        contiguous shards that are put back together in order, so the results are always
+        exactly the same as scoring everything in one process.
+
+        Parameters
+        ----------
+        gallery : FlagGallery
+            The gallery that the workers score against
+
+        workers : int
+            The number of worker processes
+
+        cache_dir : str
+            The directory that the ssim window statistics are saved to so that the
+            workers can share them, or None to let each worker compute its own
+        '''
+        self.gallery = gallery
+        self.workers = workers
+        self.cache_dir = cache_dir
+        self.executor = None
+
+        # whether the gallery is sent to the workers even if it is stored on disk, which
+        # happens once the gallery on disk has changed since it was loaded
+        self.send_flags = not gallery.saved
+
+        # the paths of the saved ssim window statistics, once they have been saved
+        self.ssim_stats = None
+
+    def get_executor(self):
+        '''
+        Returns the pool of worker processes, starting it the first time.
+
+        Returns
+        -------
+        ProcessPoolExecutor
+            The pool of worker processes
+        '''
+        if self.executor is None:
+            # a gallery stored on disk is memory mapped by each worker instead of being sent
+            directory = None if self.send_flags else self.gallery.directory
+            flags = self.gallery.flags if self.send_flags else None
+            self.executor = ProcessPoolExecutor(max_workers = self.workers, initializer = init_worker,
+                initargs = (directory, flags, self.gallery.is_palette(), self.gallery.version))
+
+        return self.executor
+
+    def run(self, submit):
+        '''
+        Submits work to the workers and returns the results of every future. If the
+        workers found a different gallery on disk than this process's, they are started
+        again with this process's gallery sent to them, and the work is submitted again.
+
+        Parameters
+        ----------
+        submit : function
+            A function that takes the executor, submits the work, and returns the list
+            of futures
+
+        Returns
+        -------
+        list
+            The result of each future, in order
+        '''
+        try:
+            return [future.result() for future in submit(self.get_executor())]
+        except GalleryChanged:
+            if self.send_flags:
+                raise
+            self.close()
+            self.send_flags = True
+            return [future.result() for future in submit(self.get_executor())]
+
+    def share_stats(self, method, ssim_scorer):
+        '''
+        Makes sure that the workers can load what the given method needs. For ssim, the
+        window statistics of every flag are saved once so that each worker can memory
+        map them.
+
+        Parameters
+        ----------
+        method : str
+            The method (mse or ssim) that is about to be used
+
+        ssim_scorer : SSIMScorer
+            The parent process's ssim scorer, whose statistics are saved
+
+        Returns
+        -------
+        tuple
+            The paths of the saved ssim window statistics, or None
+        '''
+        if method != "ssim" or not self.cache_dir:
+            return None
+
+        if self.ssim_stats is None:
+            sums, spreads = ssim_scorer.get_stats()
+            paths = tuple(os.path.join(self.cache_dir, self.gallery.version + "-" + name + ".npy")
+                for name in ("sums", "spreads"))
+
+            try:
+                for path, values in zip(paths, (sums, spreads)):
+                    if not os.path.exists(path):
+                        # writing to a temporary file first so that a worker never
+                        # loads half of the statistics
+                        tmp_path = path + ".tmp." + str(os.getpid())
+                        with open(tmp_path, "wb") as f:
+                            np.save(f, values)
+                        os.replace(tmp_path, path)
+            except OSError:
+                # each worker just computes its own statistics instead
+                return None
+
+            self.ssim_stats = paths
+
+        return self.ssim_stats
+
+    def shards(self, size, count):
+        '''
+        Splits range(size) into at most count contiguous (start, stop) shards of
+        nearly equal size.
+
+        Parameters
+        ----------
+        size : int
+            The number of items to split
+
+        count : int
+            The most shards to split them into
+
+        Returns
+        -------
+        list
+            A list of (start, stop) tuples in order
+        '''
+        bounds = np.linspace(0, size, min(count, size) + 1).astype(int)
+        return [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+    def score_images(self, method, images, ssim_scorer):
+        '''
+        Scores each of the given images against every flag in the gallery. A single image
+        is split up by flag, and a batch of images is split up by image.
+
+        Parameters
+        ----------
+        method : str
+            The method (mse or ssim) to score with
+
+        images : array
+            A (Q, height, width, 3) uint8 numpy array of the images
+
+        ssim_scorer : SSIMScorer
+            The parent process's ssim scorer
+
+        Returns
+        -------
+        array
+            A (Q, N) float64 numpy array of the score between each image and each flag
+        '''
+        stats = self.share_stats(method, ssim_scorer)
+        images = np.asarray(images)
+        n = len(self.gallery)
+
+        if len(images) < self.workers:
+            return np.concatenate(self.run(lambda executor: [executor.submit(score_images, method, stats,
+                images, start, stop) for start, stop in self.shards(n, self.workers)]), axis = 1)
+
+        return np.concatenate(self.run(lambda executor: [executor.submit(score_images, method, stats,
+            images[start:stop], 0, n) for start, stop in self.shards(len(images), self.workers)]))
+
+    def score_rows(self, method, rows, ssim_scorer):
+        '''
+        Scores each of the given flags of the gallery against every flag, splitting the
+        flags between the workers.
+
+        Parameters
+        ----------
+        method : str
+            The method (mse or ssim) to score with
+
+        rows : list
+            The rows of the flags to score
+
+        ssim_scorer : SSIMScorer
+            The parent process's ssim scorer
+
+        Returns
+        -------
+        array
+            A (len(rows), N) float64 numpy array of scores
+        '''
+        stats = self.share_stats(method, ssim_scorer)
+        rows = list(rows)
+
+        # smaller shards than workers keep every worker busy until the end
+        return np.concatenate(self.run(lambda executor: [executor.submit(score_rows, method, stats,
+            rows[start:stop]) for start, stop in self.shards(len(rows), self.workers * 4)]))
+
+    def close(self):
+        '''
+        Shuts down the worker processes, if they were started.
+        '''
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
@@ -0,0 +1,571 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from concurrent.futures import Future
+from .flag_hashes import HASH_FUNCTIONS
+import argparse
+import threading
+import queue
+import json
+import time
+
+# the methods that images can be identified with
+METHODS = ("mse", "ssim") + tuple(HASH_FUNCTIONS) + ("cascade",)
+
+# the endpoints that are answered even when the server is busy, so that it can still
+# be monitored while it is overloaded
+UNLIMITED_ENDPOINTS = ("health", "metrics")
+
+class Overloaded(Exception):
+    '''
+    Raised when the server has too much work queued up to accept another request.
+    '''
+    pass
+
+class UnknownCountry(Exception):
+    '''
+    Raised when a request names a country that isn't in the gallery.
+    '''
+    pass
+
+class DownloadFailed(Exception):
+    '''
+    Raised when the image at a request's url can't be downloaded.
+    '''
+    pass
+
+class ServerStats:
+
+    def __init__(self):
+        '''
+        Initializes a ServerStats object, the counters reported by the metrics endpoint.
+        Every counter can be updated by several request threads at once.
+        '''
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = {}
+        self.errors = {}
+        self.seconds = {}
+        self.rejected = 0
+        self.batches = 0
+        self.batched = 0
+        self.largest_batch = 0
+
+    def record_request(self, endpoint, status, seconds):
+        '''
+        Counts a finished request.
+
+        Parameters
+        ----------
+        endpoint : str
+            The endpoint that was requested
+
+        status : int
+            The HTTP status code of the response
+
+        seconds : float
+            How long the request took to answer
+        '''
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            self.seconds[endpoint] = self.seconds.get(endpoint, 0.0) + seconds
+            if status >= 400:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+            if status == 503:
+                self.rejected += 1
+
+    def record_batch(self, size):
+        '''
+        Counts a batch of images that were scored together.
+
+        Parameters
+        ----------
+        size : int
+            The number of images in the batch
+        '''
+        with self.lock:
+            self.batches += 1
+            self.batched += size
+            self.largest_batch = max(self.largest_batch, size)
+
+    def snapshot(self):
+        '''
+        Returns a copy of every counter, along with the average latency of each endpoint
+        and the average batch size.
+
+        Returns
+        -------
+        dict
+            The counters
+        '''
+        with self.lock:
+            return {
+                "uptime": time.time() - self.started,
+                "requests": dict(self.requests),
+                "errors": dict(self.errors),
+                "mean_latency": {endpoint: self.seconds[endpoint] / self.requests[endpoint]
+                    for endpoint in self.requests},
+                "rejected": self.rejected,
+                "batches": self.batches,
+                "batched_images": self.batched,
+                "mean_batch_size": self.batched / self.batches if self.batches else None,
+                "largest_batch": self.largest_batch
+            }
+
+class Batcher:
+
+    def __init__(self, identifier, stats, window = 0.005, max_batch = 32, queue_size = 256):
+        '''
+        Initializes a Batcher object, which gathers processed images submitted by many
+        request threads and scores them against the gallery together. Once an image
+        arrives, the batcher waits up to window seconds for more (or until max_batch
+        images have arrived) before scoring them all with one call.
+
+        Parameters
+        ----------
+        identifier : FlagIdentifier
+            The identifier that scores the images
+
+        stats : ServerStats
+            The counters that each batch is recorded in
+
+        window : float
+            The most seconds to wait for more images before scoring a batch
+
+        max_batch : int
+            The most images scored in one batch
+
+        queue_size : int
+            The most images that can be waiting to be scored before new ones are turned away
+        '''
+        self.identifier = identifier
+        self.stats = stats
+        self.window = window
+        self.max_batch = max_batch
+        self.queue = queue.Queue(maxsize = queue_size)
+        self.thread = threading.Thread(target = self.run, name = "flagpy-batcher", daemon = True)
+        self.thread.start()
+
+    def submit(self, flag, method):
+        '''
+        Queues up a processed image to be identified with the given method.
+
+        Parameters
+        ----------
+        flag : array
+            A processed image, as returned by FlagUtil.process_img
+
+        method : str
+            The method used to identify the image
+
+        Returns
+        -------
+        Future
+            A future that is set to the name of the identified country
+
+        Raises
+        ------
+        Overloaded
+            If the queue of images waiting to be scored is full
+        '''
+        future = Future()
+        try:
+            self.queue.put_nowait((flag, method, future))
+        except queue.Full:
+            raise Overloaded("too many images are waiting to be identified") from None
+
+        return future
+
+    def run(self):
+        '''
+        Scores batches of queued images until a None is queued.
+        '''
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            # collecting whatever else arrives within the window
+            batch = [item]
+            deadline = time.monotonic() + self.window
+            stopping = False
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout = remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            self.score(batch)
+            if stopping:
+                return
+
+    def score(self, batch):
+        '''
+        Identifies a batch of queued images, one call per method, and sets each of
+        their futures.
+
+        Parameters
+        ----------
+        batch : list
+            A list of (flag, method, future) tuples
+        '''
+        methods = {}
+        for flag, method, future in batch:
+            methods.setdefault(method, []).append((flag, future))
+
+        for method, items in methods.items():
+            try:
+                results = self.identifier.identify_flags([flag for flag, _ in items], method)
+            except Exception as e:
+                results = [e] * len(items)
+
+            for (_, future), result in zip(items, results):
+                if isinstance(result, BaseException):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+        self.stats.record_batch(len(batch))
+
+    def close(self):
+        '''
+        Stops the batcher once every image already queued has been scored.
+        '''
+        self.queue.put(None)
+        self.thread.join()
+
+class FlagRequestHandler(BaseHTTPRequestHandler):
+    # keeping connections open between requests
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.handle_request(None)
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            if length < 0:
+                raise ValueError
+        except ValueError:
+            # the body can't be found without its length, so the connection can't be reused
+            self.close_connection = True
+            self.send_json(400, {"error": "the Content-Length header must be a number of bytes"})
+            return
+
+        if length > self.server.max_body:
+            # the body is never read, so the connection can't be reused
+            self.close_connection = True
+            self.send_json(413, {"error": "the image is too large"})
+            return
+
+        self.handle_request(self.rfile.read(length))
+
+    def handle_request(self, body):
+        '''
+        Answers a request to any endpoint and records it in the server's counters.
+
+        Parameters
+        ----------
+        body : bytes
+            The body of a POST request, or None for a GET request
+        '''
+        start = time.perf_counter()
+        parts = urlsplit(self.path)
+        endpoint = parts.path.strip("/")
+        params = {key: values[-1] for key, values in parse_qs(parts.query).items()}
+
+        routes = {
+            "identify": self.identify,
+            "topk": self.topk,
+            "closest": self.closest,
+            "farthest": self.closest,
+            "dist": self.dist,
+            "health": self.health,
+            "metrics": self.metrics
+        }
+
+        limited = endpoint not in UNLIMITED_ENDPOINTS
+        if endpoint not in routes:
+            status, result = 404, {"error": "unknown endpoint: /" + endpoint}
+        elif limited and not self.server.slots.acquire(blocking = False):
+            status, result = 503, {"error": "the server is busy"}
+        else:
+            try:
+                status, result = 200, routes[endpoint](endpoint, params, body)
+            except Overloaded as e:
+                status, result = 503, {"error": str(e)}
+            except UnknownCountry as e:
+                status, result = 404, {"error": "unknown country: " + str(e)}
+            except DownloadFailed as e:
+                status, result = 502, {"error": str(e)}
+            except (ValueError, IOError) as e:
+                status, result = 400, {"error": str(e)}
+            except Exception as e:
+                status, result = 500, {"error": str(e)}
+            finally:
+                if limited:
+                    self.server.slots.release()
+
+        self.send_json(status, result, {"Retry-After": "1"} if status == 503 else None)
+        self.server.stats.record_request(endpoint if endpoint in routes else "unknown", status,
+            time.perf_counter() - start)
+
+    def send_json(self, status, result, headers = None):
+        '''
+        Sends the given result as a JSON response.
+
+        Parameters
+        ----------
+        status : int
+            The HTTP status code
+
+        result : object
+            The object to send as JSON
+
+        headers : dict
+            Any extra headers to send
+        '''
+        body = json.dumps(result).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def load_image(self, params, body):
+        '''
+        Returns the processed image of a request, which is either the body of a POST
+        request or the url in the url parameter.
+
+        Parameters
+        ----------
+        params : dict
+            The query parameters of the request
+
+        body : bytes
+            The body of a POST request, or None
+
+        Returns
+        -------
+        array
+            The processed image
+        '''
+        util = self.server.identifier.util
+        if body:
+            return util.process_img(body)
+
+        url = params.get("url")
+        # only urls are accepted, since a file path would read from the server's disk
+        if not util.is_url(url):
+            raise ValueError("an image must be posted or given as an http or https url")
+
+        # the url's server failing is answered with a 502, and a url that isn't an
+        # image with a 400
+        try:
+            image = util.fetch(url)
+        except Exception as e:
+            raise DownloadFailed("couldn't download " + url + ": " + str(e)) from e
+        return util.process_img(image)
+
+    def get_method(self, params):
+        '''
+        Returns the method of a request that identifies an image, checking it before
+        the image is downloaded or processed.
+
+        Parameters
+        ----------
+        params : dict
+            The query parameters of the request
+
+        Returns
+        -------
+        str
+            The method
+        '''
+        method = params.get("method", "mse")
+        if method not in METHODS:
+            raise ValueError("method must be one of: " + ", ".join(METHODS))
+        return method
+
+    def check_country(self, country):
+        '''
+        Makes sure that the given country is in the gallery, so that a misspelled
+        country is answered with a 404 (and any other error with a 500).
+
+        Parameters
+        ----------
+        country : str
+            The name of the country
+
+        Raises
+        ------
+        UnknownCountry
+            If the country isn't in the gallery
+        '''
+        if country not in self.server.identifier.gallery:
+            raise UnknownCountry(country)
+
+    def identify(self, endpoint, params, body):
+        method = self.get_method(params)
+        future = self.server.batcher.submit(self.load_image(params, body), method)
+        return {"country": future.result(), "method": method}
+
+    def topk(self, endpoint, params, body):
+        method = self.get_method(params)
+        k = int(params.get("k", 5))
+        results = self.server.identifier.identify_topk(self.load_image(params, body), k = k, method = method)
+        return {"results": [{"country": country, "score": score} for country, score in results], "method": method}
+
+    def closest(self, endpoint, params, body):
+        method = params.get("method", "mse")
+        if "country" not in params:
+            raise ValueError("a country must be given")
+        # countries are looked up by their title case names, like in dist
+        name = params["country"].title()
+        self.check_country(name)
+
+        identifier = self.server.identifier
+        if endpoint == "closest":
+            country = identifier.closest_flag(name, method = method)
+        else:
+            country = identifier.farthest_flag(name, method = method)
+        return {"country": country, "method": method}
+
+    def dist(self, endpoint, params, body):
+        method = params.get("method", "mse")
+        if "a" not in params or "b" not in params:
+            raise ValueError("two countries must be given as a and b")
+        # flag_dist looks countries up by their title case names
+        self.check_country(params["a"].title())
+        self.check_country(params["b"].title())
+
+        dist = self.server.identifier.flag_dist(params["a"], params["b"], method)
+        return {"dist": dist.item() if hasattr(dist, "item") else dist, "method": method}
+
+    def health(self, endpoint, params, body):
+        gallery = self.server.identifier.gallery
+        return {"status": "ok", "flags": len(gallery), "version": gallery.version}
+
+    def metrics(self, endpoint, params, body):
+        metrics = self.server.stats.snapshot()
+        metrics["queued_images"] = self.server.batcher.queue.qsize()
+
+        # the identifier's stage timings, if the server was started with --stats
+        if self.server.identifier.stats.enabled:
+            metrics["stages"] = self.server.identifier.stats.snapshot()
+        return metrics
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class FlagServer(ThreadingHTTPServer):
+    # not waiting on open keep-alive connections when shutting down
+    daemon_threads = True
+
+    def __init__(self, address, identifier = None, window = 0.005, max_batch = 32, queue_size = 256,
+        max_pending = 64, max_body = 10 << 20, quiet = False):
+        '''
+        Initializes a FlagServer object, an HTTP server that answers requests with one
+        FlagIdentifier that stays loaded. Images sent to /identify by requests that
+        arrive at about the same time are scored together in one batch.
+
+        Parameters
+        ----------
+        address : tuple
+            The (host, port) to listen on
+
+        identifier : FlagIdentifier
+            The identifier that answers requests (a new one is created if not given)
+
+        window : float
+            The most seconds that an image waits for others to be batched with
+
+        max_batch : int
+            The most images scored in one batch
+
+        queue_size : int
+            The most images that can be waiting to be scored before requests are turned
+            away with a 503
+
+        max_pending : int
+            The most requests that can be worked on at once before requests are turned
+            away with a 503 (/health and /metrics are always answered)
+
+        max_body : int
+            The largest image (in bytes) that can be posted
+
+        quiet : bool
+            Whether or not to stop logging every request
+        '''
+        if identifier is None:
+            from .flag_identifier import FlagIdentifier
+            identifier = FlagIdentifier()
+
+        self.identifier = identifier
+        self.stats = ServerStats()
+        self.batcher = Batcher(identifier, self.stats, window, max_batch, queue_size)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.max_body = max_body
+        self.quiet = quiet
+
+        # letting as many connections wait to be accepted as there can be requests worked
+        # on, so that the kernel doesn't refuse ones that would have been answered
+        self.request_queue_size = max(max_pending, ThreadingHTTPServer.request_queue_size)
+        ThreadingHTTPServer.__init__(self, address, FlagRequestHandler)
+
+    def server_close(self):
+        ThreadingHTTPServer.server_close(self)
+        self.batcher.close()
+
+def main(args = None):
+    '''
+    Runs a FlagServer until it is interrupted.
+
+    Parameters
+    ----------
+    args : list
+        The command line arguments (sys.argv is used if not given)
+    '''
+    parser = argparse.ArgumentParser(prog = "python -m flagpy.serve", description = "Serves flag identification over HTTP.")
+    parser.add_argument("--host", default = "127.0.0.1", help = "the address to listen on")
+    parser.add_argument("--port", type = int, default = 8000, help = "the port to listen on")
+    parser.add_argument("--window", type = float, default = 5.0, help = "milliseconds to wait for more images to batch")
+    parser.add_argument("--max-batch", type = int, default = 32, help = "the most images scored in one batch")
+    parser.add_argument("--queue-size", type = int, default = 256, help = "the most images waiting to be scored")
+    parser.add_argument("--max-pending", type = int, default = 64, help = "the most requests worked on at once")
+    parser.add_argument("--workers", type = int, default = 0, help = "the number of scoring processes")
+    parser.add_argument("--warmup", default = "mse,hash", help = "the methods to load before serving (comma separated)")
+    parser.add_argument("--quiet", action = "store_true", help = "don't log every request")
+    parser.add_argument("--stats", action = "store_true", help = "report the time spent in each stage in /metrics")
+    args = parser.parse_args(args)
+
+    from .flag_identifier import FlagIdentifier
+    identifier = FlagIdentifier(workers = args.workers)
+    identifier.stats.enable(args.stats)
+    if args.warmup:
+        identifier.warmup(tuple(args.warmup.split(",")))
+
+    server = FlagServer((args.host, args.port), identifier, window = args.window / 1000.0,
+        max_batch = args.max_batch, queue_size = args.queue_size, max_pending = args.max_pending,
+        quiet = args.quiet)
+    print("serving flagpy on http://" + args.host + ":" + str(server.server_address[1]))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        identifier.close()
+
+if __name__ == "__main__":
+    main()
@@ -20,14 +20,16 @@ setup(
     author_email = "kumar.saa@northeastern.edu",
     license = "MIT",
     packages = ["flagpy"],
-    package_data = {"": ["flag_df.csv", "flags/*.pkl"]},
+    package_data = {"": ["gallery.json", "flags*.npy", "palette*.npy", "flag_hashes.npz"]},
     include_package_data = True,
     install_requires = [
         "Pillow", 
         "requests",
         "numpy",
         "pandas",
-        "ImageHash",
-        "scikit-image"
-    ]
+        "ImageHash"
+    ],
+    extras_require = {
+        "async": ["aiohttp"]
+    }
 )
\ No newline at end of file
@@ -0,0 +1,52 @@
+import pytest
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    '''
+    Points flagpy's on-disk caches at a temporary directory, so that tests never use
+    (or leave behind) anything in the user's cache.
+    '''
+    monkeypatch.setenv("FLAGPY_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.delenv("FLAGPY_OFFLINE", raising = False)
+    return tmp_path / "cache"
+
+@pytest.fixture
+def identifier(cache_dir):
+    '''
+    A FlagIdentifier with its own caches.
+    '''
+    from flagpy.flag_identifier import FlagIdentifier
+    identifier = FlagIdentifier()
+    yield identifier
+    identifier.close()
+
+@pytest.fixture
+def image_server(tmp_path):
+    '''
+    Serves PNGs of a few of the gallery's flags from a local HTTP server, as a stand-in
+    for the sites that flag images are downloaded from. Yields the base url of the
+    server and the directory it serves, which holds <country>.png for each flag.
+    '''
+    from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+    from flagpy.flag_gallery import FlagGallery
+    from PIL import Image
+    import functools
+    import threading
+
+    directory = tmp_path / "images"
+    directory.mkdir()
+    gallery = FlagGallery.load()
+    for country in ("France", "Japan", "India"):
+        Image.fromarray(gallery.get(country)).save(directory / (country + ".png"))
+
+    class QuietHandler(SimpleHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietHandler, directory = str(directory)))
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    yield "http://127.0.0.1:" + str(server.server_address[1]) + "/", directory
+
+    server.shutdown()
+    server.server_close()
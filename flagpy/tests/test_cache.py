@@ -0,0 +1,26 @@
+from flagpy.flag_cache import LRUCache, content_key
+import numpy as np
+import os
+import time
+
+def test_disk_tier_is_bounded(tmp_path):
+    directory = str(tmp_path)
+    value = np.zeros(1000, dtype = np.uint8)
+    size = 1000 + 128
+    cache = LRUCache(2, directory, max_disk_bytes = 5 * size)
+
+    keys = [content_key(str(i)) for i in range(8)]
+    for i, key in enumerate(keys):
+        cache.put(key, value)
+        # keeping the first value in use, so that it is never the least recently used
+        os.utime(os.path.join(directory, keys[0] + ".npy"), (time.time() + 1000, time.time() + 1000))
+
+    files = sorted(name for name in os.listdir(directory) if name.endswith(".npy"))
+    assert len(files) <= 5
+    assert keys[0] + ".npy" in files and keys[-1] + ".npy" in files
+    assert keys[1] + ".npy" not in files
+
+    # evicted values are missed, and kept ones are still found on disk
+    fresh = LRUCache(2, directory, max_disk_bytes = 5 * size)
+    assert fresh.get(keys[1]) is None
+    assert np.array_equal(fresh.get(keys[-1]), value)
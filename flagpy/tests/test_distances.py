@@ -0,0 +1,19 @@
+from flagpy.flag_distances import DistanceMatrix
+import numpy as np
+
+def test_rows_computed_across_an_update_are_recomputed():
+    matrix = DistanceMatrix(3)
+    calls = []
+
+    def compute_rows(rows):
+        calls.append(len(matrix.values))
+        # the gallery gains a flag while the first rows are computed
+        if len(calls) == 1:
+            matrix.update(3, "add")
+        size = len(matrix.values)
+        return [np.arange(size, dtype = np.float64) + 10 * i for i in rows]
+
+    values = matrix.rows([0], compute_rows)
+    assert calls == [3, 4]
+    assert values.shape == (1, 4)
+    assert matrix.has_row(0)
@@ -0,0 +1,80 @@
+from flagpy.flag_gallery import FlagGallery, INDEX_FILE
+import numpy as np
+import json
+import os
+
+def read_index(directory):
+    with open(os.path.join(directory, INDEX_FILE)) as f:
+        return json.load(f)
+
+def test_save_keeps_the_replaced_flags(tmp_path):
+    gallery = FlagGallery.load(mmap = False)
+    directory = str(tmp_path)
+
+    names = []
+    for country in ("Chad", "India", "Japan"):
+        gallery.remove(country)
+        gallery.save(directory)
+        names.append(read_index(directory)["flags"])
+
+    # only the flags of the newest gallery and the one it replaced are kept
+    assert not os.path.exists(os.path.join(directory, names[0]))
+    assert os.path.exists(os.path.join(directory, names[1]))
+    assert read_index(directory)["previous"] == [names[1]]
+
+def test_load_retries_with_the_new_index(tmp_path, monkeypatch):
+    gallery = FlagGallery.load(mmap = False)
+    directory = str(tmp_path)
+    gallery.save(directory)
+    stale = read_index(directory)
+    gallery.remove("Chad")
+    gallery.save(directory)
+    os.remove(os.path.join(directory, stale["flags"]))
+
+    # the first read of the index is the one from before the last save
+    reads = []
+    load = json.load
+    def stale_load(f):
+        reads.append(f.name)
+        return stale if len(reads) == 1 else load(f)
+    monkeypatch.setattr(json, "load", stale_load)
+
+    loaded = FlagGallery.load(directory)
+    assert len(reads) == 2
+    assert loaded.names == gallery.names
+    assert np.array_equal(loaded.get("India"), gallery.get("India"))
+
+def test_changes_match_a_rebuilt_gallery(identifier):
+    from flagpy.flag_hashes import HashIndex, HASH_FUNCTIONS
+    from flagpy.flag_metrics import MSEScorer, SSIMScorer
+
+    # loading every index first so that each one has to be updated in place
+    identifier.get_hashes()
+    identifier.ssim_scorer.get_stats()
+    identifier.mse_pyramid.get_pyramid()
+    identifier.flag_dist_matrix(["India", "Libya"], identifier.gallery.names)
+
+    india = identifier.gallery.get("India")
+    identifier.add_flag("atlantis", india[::-1])
+    identifier.replace_flag("libya", india[:, ::-1])
+    identifier.remove_flag("chad")
+
+    flags = np.asarray(identifier.gallery.flags)
+    names = identifier.gallery.names
+    assert "Atlantis" in names and "Chad" not in names
+
+    hashes = HashIndex.build(flags)
+    for method in HASH_FUNCTIONS:
+        assert np.array_equal(identifier.get_hashes().hashes[method], hashes.hashes[method])
+
+    rebuilt = SSIMScorer(flags).get_stats()
+    for stats, expected in zip(identifier.ssim_scorer.get_stats(), rebuilt):
+        assert np.array_equal(stats, expected)
+
+    scorer = MSEScorer(flags)
+    for country in ("Atlantis", "Libya", "India"):
+        scores = scorer.score(identifier.gallery.get(country))
+        assert np.array_equal(identifier.mse_scorer.score(identifier.gallery.get(country)), scores)
+        assert np.allclose(identifier.flag_dist_matrix([country], names)[0], scores)
+
+    assert identifier.mse_pyramid.search(india[::-1]) == (names.index("Atlantis"), 0.0)
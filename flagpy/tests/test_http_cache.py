@@ -0,0 +1,71 @@
+from flagpy.flag_http_cache import HTTPCache
+from flagpy.flag_util import FlagUtil
+import asyncio
+import os
+import pytest
+
+@pytest.fixture
+def util(cache_dir, tmp_path):
+    '''
+    A FlagUtil whose downloads go through a cache of their own.
+    '''
+    util = FlagUtil()
+    previous = util.get_http_cache()
+    (tmp_path / "http").mkdir()
+    util.set_http_cache(HTTPCache(str(tmp_path / "http")))
+    yield util
+    util.set_http_cache(previous)
+
+def test_fetch_revalidates(util, image_server):
+    url, directory = image_server
+    body = util.fetch(url + "France.png")
+    assert body == (directory / "France.png").read_bytes()
+    assert util.fetch(url + "France.png") == body
+    assert util.get_http_cache().stats()["revalidated"] == 1
+
+def test_afetch_uses_cache(util, image_server):
+    url, directory = image_server
+    body = asyncio.run(util.afetch(url + "Japan.png"))
+    assert body == (directory / "Japan.png").read_bytes()
+
+    # the second download is only a revalidation, for both fetch and afetch
+    assert asyncio.run(util.afetch(url + "Japan.png")) == body
+    assert util.fetch(url + "Japan.png") == body
+    stats = util.get_http_cache().stats()
+    assert stats["downloaded"] == 1 and stats["revalidated"] == 2
+
+def test_offline_only_serves_cached_files(util, image_server):
+    url, _ = image_server
+    body = util.fetch(url + "India.png")
+    util.get_http_cache().offline = True
+
+    assert util.fetch(url + "India.png") == body
+    assert asyncio.run(util.afetch(url + "India.png")) == body
+    with pytest.raises(IOError):
+        util.fetch(url + "France.png")
+    with pytest.raises(IOError):
+        asyncio.run(util.afetch(url + "France.png"))
+
+def test_store_only_lists_the_cache_when_needed(tmp_path, image_server, monkeypatch):
+    url, directory = image_server
+    size = (directory / "France.png").stat().st_size
+    cache = HTTPCache(str(tmp_path), max_bytes = 2 * size + 1)
+    util = FlagUtil(http_cache = cache)
+
+    listings = []
+    listdir = os.listdir
+    def counting_listdir(path):
+        listings.append(path)
+        return listdir(path)
+    monkeypatch.setattr(os, "listdir", counting_listdir)
+
+    util.fetch(url + "France.png")
+    assert len(listings) == 1 and cache.cached_bytes == size
+    util.fetch(url + "France.png")
+    assert len(listings) == 1
+
+    # going over max_bytes lists the cache again and evicts the oldest file
+    util.fetch(url + "Japan.png")
+    util.fetch(url + "India.png")
+    assert len(listings) >= 2
+    assert cache.cached_bytes <= cache.max_bytes
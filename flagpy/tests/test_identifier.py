@@ -0,0 +1,176 @@
+import asyncio
+import pytest
+import numpy as np
+import os
+
+def test_closest_flag_caches_rows(identifier):
+    countries = identifier.get_country_list()
+    first = [identifier.closest_flag(country) for country in countries]
+
+    # every row is now cached, so a second pass never scores anything
+    def fail(rows, method):
+        raise AssertionError("scored rows " + str(rows) + " again")
+    identifier._FlagIdentifier__reference_rows = fail
+
+    assert [identifier.closest_flag(country) for country in countries] == first
+
+def test_closest_flag_matches_full_row(identifier):
+    for country in ("India", "Chad", "Japan"):
+        i = identifier.gallery.row(country)
+        dists = identifier.flag_dist_matrix([country], identifier.get_country_list())[0]
+        dists[i] = np.inf
+        assert identifier.closest_flag(country) == identifier.gallery.names[int(np.argmin(dists))]
+
+def test_identify_many_returns_exceptions(identifier, image_server):
+    url, _ = image_server
+    urls = [url + "France.png", url + "Atlantis.png", url + "Japan.png", url]
+    results = identifier.identify_many(urls, max_workers = 2)
+
+    assert results[0] == "France" and results[2] == "Japan"
+    # a missing image and a directory listing can't be opened as images
+    assert isinstance(results[1], Exception) and isinstance(results[3], Exception)
+
+def test_aidentify_many_returns_exceptions(identifier, image_server):
+    url, _ = image_server
+    urls = [url + "India.png", url + "Atlantis.png", url + "France.png"]
+    results = asyncio.run(identifier.aidentify_many(urls, concurrency = 2))
+
+    assert results[0] == "India" and results[2] == "France"
+    assert isinstance(results[1], Exception)
+
+def test_cascade_audit_rate(identifier):
+    with pytest.raises(ValueError):
+        identifier.set_cascade_audit_rate(1.5)
+
+    identifier.set_cascade_audit_rate(1.0)
+    for country in ("India", "Japan"):
+        assert identifier.identify(identifier.gallery.get(country), "cascade", cache = False) == country
+    stats = identifier.get_cascade_stats()
+    assert stats["calls"] == stats["audited"] == 2
+
+def test_workers_never_score_a_changed_gallery(cache_dir, tmp_path):
+    from flagpy.flag_identifier import FlagIdentifier
+    from flagpy.flag_gallery import FlagGallery
+
+    directory = str(tmp_path / "gallery")
+    os.mkdir(directory)
+    gallery = FlagGallery.load(mmap = False)
+    gallery.save(directory)
+
+    identifier = FlagIdentifier(directory = directory, workers = 2)
+    try:
+        # the gallery on disk changes after the identifier loaded it
+        gallery.remove("Chad")
+        gallery.save(directory)
+
+        flag = identifier.gallery.get("Chad")
+        assert identifier.identify(flag, "ssim", cache = False) == "Chad"
+        assert identifier.get_pool().send_flags
+    finally:
+        identifier.close()
+
+def noisy_flag(identifier, country, seed):
+    '''
+    Returns the given country's flag with some of its pixels changed to random 'web safe'
+    colors, as an image that isn't in the gallery.
+    '''
+    rng = np.random.default_rng(seed)
+    flag = np.array(identifier.gallery.get(country))
+    mask = rng.random(flag.shape[:2]) < 0.2
+    flag[mask] = identifier.util.quantize_array(rng.integers(0, 256, (int(mask.sum()), 3), dtype = np.uint8))
+    return flag
+
+def test_quantize_array_matches_find_nearest_color(identifier):
+    util = identifier.util
+    pixels = np.random.default_rng(0).integers(0, 256, (40, 50, 3), dtype = np.uint8)
+    expected = np.array([[util.find_nearest_color(tuple(int(c) for c in pixel)) for pixel in row] for row in pixels],
+        dtype = np.uint8)
+    assert np.array_equal(util.quantize_array(pixels), expected)
+
+def test_mse_scorer_matches_pairwise_mse(identifier):
+    mse = identifier._FlagIdentifier__mse
+    for seed, country in enumerate(("India", "Brazil")):
+        image = noisy_flag(identifier, country, seed)
+        expected = np.array([mse(image, np.asarray(identifier.gallery.flags[i])) for i in range(len(identifier.gallery))])
+        assert np.array_equal(identifier.mse_scorer.score(image), expected)
+
+def test_packed_hashes_match_imagehash(identifier):
+    import imagehash
+    from flagpy.flag_hashes import HashIndex, HASH_FUNCTIONS
+    from PIL import Image
+
+    image = noisy_flag(identifier, "Japan", 0)
+    hashes = identifier.get_hashes()
+    for method, name in HASH_FUNCTIONS.items():
+        hash_function = getattr(imagehash, name)
+        query = hash_function(Image.fromarray(image))
+        expected = [query - hash_function(Image.fromarray(np.asarray(flag))) for flag in identifier.gallery.flags]
+        assert np.array_equal(hashes.distances(HashIndex.hash_image(image, method), method), expected)
+
+def test_identify_topk_order_and_ties(identifier):
+    from flagpy.flag_hashes import HashIndex
+
+    image = noisy_flag(identifier, "Chad", 0)
+    names = identifier.gallery.names
+    scores = {
+        "mse": identifier.mse_scorer.score(image),
+        "ssim": -identifier.ssim_scorer.score(image),
+        "hash": identifier.get_hashes().distances(HashIndex.hash_image(image, "hash"), "hash")
+    }
+    for method, keys in scores.items():
+        # best first, and ties in gallery order
+        expected = [names[i] for i in sorted(range(len(names)), key = lambda i: (keys[i], i))]
+        for k in (1, 5, 40):
+            assert [country for country, _ in identifier.identify_topk(image, k, method)] == expected[:k]
+        assert identifier.identify(image, method, cache = False) == expected[0]
+
+    # the best hash distances tie, so this checks that ties are broken in gallery order
+    assert len(set(np.sort(scores["hash"])[:40])) < 40
+
+def test_every_input_type_gives_the_same_flag(identifier, tmp_path):
+    from PIL import Image
+
+    image = Image.fromarray(noisy_flag(identifier, "Brazil", 0)).resize((300, 200))
+    path = tmp_path / "flag.png"
+    image.save(path)
+    data = path.read_bytes()
+
+    expected = identifier.util.process_img(str(path), cache = False)
+    sources = [str(path), data, bytearray(data), memoryview(data), Image.open(path), np.asarray(Image.open(path))]
+    for source in sources:
+        assert np.array_equal(identifier.util.process_img(source), expected), type(source)
+        assert identifier.identify(source, cache = False) == "Brazil"
+
+def test_ssim_matches_scikit_image(identifier):
+    metrics = pytest.importorskip("skimage.metrics")
+
+    image = noisy_flag(identifier, "Romania", 0)
+    rows = [identifier.gallery.row(country) for country in ("Chad", "Romania", "Japan", "Nepal")]
+    expected = [metrics.structural_similarity(image, np.asarray(identifier.gallery.flags[i]), channel_axis = 2,
+        data_range = 255) for i in rows]
+    assert np.allclose(identifier.ssim_scorer.score(image, rows), expected, rtol = 0, atol = 1e-9)
+
+def test_pyramid_search_matches_argmin(identifier):
+    rng = np.random.default_rng(0)
+    images = [noisy_flag(identifier, country, seed) for seed, country in enumerate(("India", "Niger", "Ireland"))]
+    images.append(identifier.util.quantize_array(rng.integers(0, 256, (90, 180, 3), dtype = np.uint8)))
+    images.append(np.asarray(identifier.gallery.get("Monaco")))
+
+    for image in images:
+        scores = identifier.mse_scorer.score(image)
+        row, mse = identifier.mse_pyramid.search(image)
+        assert (row, mse) == (int(np.argmin(scores)), scores.min())
+
+def test_palette_mse_matches_rgb_mse(identifier):
+    from flagpy.flag_identifier import FlagIdentifier
+
+    palette = FlagIdentifier(representation = "palette")
+    try:
+        rows = [palette.gallery.row(country) for country in ("Chad", "Peru", "Gabon")]
+        for seed, country in enumerate(("Peru", "Sweden", "Kenya")):
+            image = noisy_flag(identifier, country, seed)
+            assert np.array_equal(palette.mse_scorer.score(image), identifier.mse_scorer.score(image))
+            assert np.array_equal(palette.mse_scorer.score(image, rows), identifier.mse_scorer.score(image, rows))
+            assert palette.identify(image, cache = False) == identifier.identify(image, cache = False) == country
+    finally:
+        palette.close()
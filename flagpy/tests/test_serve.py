@@ -0,0 +1,116 @@
+from flagpy.serve import FlagServer, Overloaded
+from http.client import HTTPConnection
+import threading
+import json
+import io
+import pytest
+
+@pytest.fixture
+def server(identifier):
+    '''
+    A FlagServer answering requests on a free localhost port.
+    '''
+    server = FlagServer(("127.0.0.1", 0), identifier, max_pending = 4, quiet = True)
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+def request(server, method, path, body = None, headers = None):
+    connection = HTTPConnection("127.0.0.1", server.server_address[1], timeout = 30)
+    try:
+        connection.request(method, path, body = body, headers = headers or {})
+        response = connection.getresponse()
+        return response.status, json.loads(response.read()), response
+    finally:
+        connection.close()
+
+def png(identifier, country):
+    data = io.BytesIO()
+    identifier.get_flag_img(country).save(data, format = "PNG")
+    return data.getvalue()
+
+def test_health(server):
+    status, result, _ = request(server, "GET", "/health")
+    assert status == 200
+    assert result["status"] == "ok" and result["flags"] == len(server.identifier.gallery)
+
+def test_identify_and_topk(server):
+    image = png(server.identifier, "Japan")
+    status, result, _ = request(server, "POST", "/identify?method=mse", image)
+    assert (status, result) == (200, {"country": "Japan", "method": "mse"})
+
+    status, result, _ = request(server, "POST", "/topk?k=3&method=hash", image)
+    assert status == 200
+    assert len(result["results"]) == 3 and result["results"][0]["country"] == "Japan"
+
+def test_error_statuses(server, monkeypatch):
+    assert request(server, "GET", "/nowhere")[0] == 404
+    assert request(server, "GET", "/closest?country=Atlantis")[0] == 404
+    assert request(server, "POST", "/identify?method=nope", png(server.identifier, "Chad"))[0] == 400
+    assert request(server, "GET", "/dist?a=India&b=Atlantis")[0] == 404
+    assert request(server, "GET", "/identify")[0] == 400
+    assert request(server, "POST", "/identify", b"not an image")[0] == 400
+
+    # a KeyError that isn't about the requested country is the server's fault
+    def broken(country, method = "mse"):
+        raise KeyError("cache")
+    monkeypatch.setattr(server.identifier, "closest_flag", broken)
+    assert request(server, "GET", "/closest?country=India")[0] == 500
+
+def test_lowercase_countries(server):
+    status, result, _ = request(server, "GET", "/closest?country=chad")
+    assert (status, result["country"]) == (200, server.identifier.closest_flag("Chad"))
+    status, result, _ = request(server, "GET", "/farthest?country=india&method=hash")
+    assert (status, result["country"]) == (200, server.identifier.farthest_flag("India", method = "hash"))
+
+def test_bad_method_isnt_downloaded(server, monkeypatch):
+    def fetch(url):
+        raise AssertionError("downloaded " + url)
+    monkeypatch.setattr(server.identifier.util, "fetch", fetch)
+    assert request(server, "GET", "/identify?method=nope&url=http://127.0.0.1:1/x.png")[0] == 400
+    assert request(server, "GET", "/topk?method=nope&url=http://127.0.0.1:1/x.png")[0] == 400
+
+def test_failed_downloads(server, image_server):
+    url, _ = image_server
+    # nothing listens on port 1
+    assert request(server, "GET", "/identify?url=http://127.0.0.1:1/flag.png")[0] == 502
+    # a page that isn't an image
+    assert request(server, "GET", "/identify?url=" + url)[0] == 400
+    status, result, _ = request(server, "GET", "/identify?url=" + url + "France.png")
+    assert (status, result["country"]) == (200, "France")
+
+def test_malformed_content_length(server):
+    connection = HTTPConnection("127.0.0.1", server.server_address[1], timeout = 30)
+    try:
+        connection.putrequest("POST", "/identify")
+        connection.putheader("Content-Length", "lots")
+        connection.endheaders()
+        assert connection.getresponse().status == 400
+    finally:
+        connection.close()
+
+def test_backpressure(server, monkeypatch):
+    assert server.request_queue_size >= 4
+
+    # every slot for a request is taken
+    for _ in range(4):
+        server.slots.acquire()
+    try:
+        status, _, response = request(server, "GET", "/dist?a=India&b=Chad")
+        assert status == 503 and response.getheader("Retry-After") == "1"
+
+        # the server can still be monitored
+        assert request(server, "GET", "/health")[0] == 200
+        assert request(server, "GET", "/metrics")[0] == 200
+    finally:
+        for _ in range(4):
+            server.slots.release()
+
+    # too many images are waiting to be scored
+    def overloaded(flag, method):
+        raise Overloaded("too many images are waiting to be identified")
+    monkeypatch.setattr(server.batcher, "submit", overloaded)
+    assert request(server, "POST", "/identify", png(server.identifier, "Chad"))[0] == 503
@@ -0,0 +1,36 @@
+from flagpy.flag_stats import Instrumentation
+import threading
+
+def test_profile_only_records_its_own_call():
+    stats = Instrumentation()
+    started = threading.Event()
+    done = threading.Event()
+
+    def other_thread():
+        started.wait()
+        with stats.timer("other"):
+            stats.count("other.calls")
+        done.set()
+
+    def profiled():
+        started.set()
+        done.wait()
+        with stats.timer("profiled"):
+            stats.count("profiled.calls")
+        return "result"
+
+    thread = threading.Thread(target = other_thread)
+    thread.start()
+    result, report = stats.profile(profiled)
+    thread.join()
+
+    snapshot = stats.snapshot()
+    assert result == "result" and report
+    assert list(snapshot["timers"]) == ["profiled"]
+    assert snapshot["counters"] == {"profiled.calls": 1}
+    assert not snapshot["enabled"]
+
+    # recording is still off once the profiled call is over
+    with stats.timer("after"):
+        pass
+    assert "after" not in stats.snapshot()["timers"]